@@ -10,7 +10,8 @@ mongosh -- "$MONGO_INITDB_DATABASE" <<EOF
 
     var user = '$MONGO_USER';
     var passwd = '$MONGO_PASSWORD';
-    db.createUser({user: user, pwd: passwd, roles: ["readWrite"]});
+    // The tests of the async repository load their data into a database of their own
+    db.createUser({user: user, pwd: passwd, roles: ["readWrite", {role: "readWrite", db: "${MONGO_INITDB_DATABASE}_test"}]});
 
     db.createCollection('User');
     db.createCollection('Activity');
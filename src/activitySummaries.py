@@ -0,0 +1,40 @@
+import time
+from pymongo import UpdateOne
+from datasetGeneration import new_generation
+from layoutRepository import create_repository
+from trajectory import summarize, summarize_trackpoints
+
+
+def recompute_summaries(batch_size=1000):
+    """
+    Computes the summary of every activity again from the stored trackpoints,
+    used for databases loaded before the summaries existed
+    """
+    repository = create_repository()
+    db = repository.db
+
+    print(f"\n{time.strftime('%H:%M:%S')} Recomputing activity summaries...")
+
+    updates = []
+    summarized_ids = set()
+    for activity in repository.iter_activity_arrays():
+        updates.append(UpdateOne({'id': activity.activity_id}, {'$set': summarize(activity)}))
+        summarized_ids.add(activity.activity_id)
+
+        if len(updates) >= batch_size:
+            db.Activity.bulk_write(updates, ordered=False)
+            updates = []
+            print(f"{time.strftime('%H:%M:%S')} Summarized {len(summarized_ids):,} activities")
+
+    if updates:
+        db.Activity.bulk_write(updates, ordered=False)
+
+    # Activities without trackpoints, like labels without a plot file, get an empty summary
+    res = db.Activity.update_many({'id': {'$nin': list(summarized_ids)}}, {'$set': summarize_trackpoints([])})
+
+    print(f"{time.strftime('%H:%M:%S')} Summarized {len(summarized_ids):,} activities, "
+          f"{res.modified_count:,} without trackpoints")
+
+    new_generation(db)
+
+    repository.connection.close_connection()
@@ -0,0 +1,806 @@
+import argparse
+import asyncio
+import contextvars
+import functools
+import time
+from collections import defaultdict
+import numpy as np
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import ExecutionTimeout
+from tabulate import tabulate
+from columnarResults import FLOAT, INTEGER, STRING, concatenate_columns, decode_batch, schema_projection
+from dbConnector import acquire_client, client_options, connection_uri, release_client
+from layoutRepository import (SERIES_SCHEMA, bucket_activity_arrays, bucket_area_query, bucket_batch_size,
+                              bucket_box_pipeline, bucket_cell_points, bucket_cell_values_pipeline,
+                              bucket_count_pipeline, bucket_pairs_stages, bucket_period_query, bucket_projection,
+                              bucket_trackpoint_modes_pipeline, epoch_bounds, from_series_columns)
+from repository import (FORBIDDEN_CITY, LABELED_ACTIVITIES, TRACKPOINT_SCHEMA, WALKED_IN_2008_BY_112,
+                        activities_per_user_pipeline, add_distances, altitude_gain_stages, box_area, box_query,
+                        cell_value_pairs, cell_values_pipeline, circle_area, combine_matches, compare_years,
+                        consecutive_trackpoints_pipeline, distance_activity_query, distance_selection,
+                        forbidden_city_messages, invalid_activity_stages, labeled_selection, location_area_query,
+                        match_stage, mode_count_pairs, mode_count_pipeline, most_used_modes, polygon_area,
+                        sum_invalid_activities, sum_partial_totals, summary_altitude_pipeline,
+                        summary_invalid_pipeline, taxi_users_pipeline, top_altitude_users, top_users_pipeline,
+                        trackpoint_modes_pipeline, trackpoint_query, user_ranges, year_activities_pipeline,
+                        year_hours_pipeline)
+from spatialGrid import assign_edge, assign_inside, cell_batches, cell_field, plan_lookup
+from trackpointLayouts import BUCKET, DOCUMENT, TIMESERIES, TRACKPOINT_COLLECTIONS, bucket_cell_field
+from trajectory import ARRAY_FIELDS, columns_to_activity_arrays, split_complete_activities
+
+# The monotonic time the query running in the current task has to finish by, or None without a timeout.
+# Every server operation of the query is limited to the time left, so it stops in the server as well
+deadline = contextvars.ContextVar("deadline", default=None)
+
+
+def remaining_ms():
+    """
+    Returns the milliseconds left until the deadline of the current query, or None without a deadline
+    """
+    end = deadline.get()
+    return None if end is None else max(1, int((end - time.monotonic()) * 1000))
+
+
+def time_limit():
+    """
+    Returns the maxTimeMS option of a command of the current query
+    """
+    milliseconds = remaining_ms()
+    return {'maxTimeMS': milliseconds} if milliseconds is not None else dict()
+
+
+def stream_time_limit(timeout):
+    """
+    Returns the milliseconds a streamed result may take in the server, the smaller of the timeout in seconds and the
+    time left of the current query. The time the consumer spends between batches does not count
+    """
+    limits = [limit for limit in (remaining_ms(), int(timeout * 1000) if timeout is not None else None)
+              if limit is not None]
+    return min(limits) if limits else None
+
+
+def query(method):
+    """
+    Lets a query of the repository be called with a timeout in seconds, the timeout of the repository by default.
+    A query that runs out of time is cancelled together with the partitions it runs, its server operations are
+    limited to the time left with maxTimeMS, and asyncio.TimeoutError is raised either way.
+    A query called by another query keeps the deadline of the outer one unless its own timeout is shorter
+    """
+    @functools.wraps(method)
+    async def run_query(self, *args, timeout=None, **kwargs):
+        outer_deadline = deadline.get()
+        if timeout is None and outer_deadline is None:
+            timeout = self.timeout
+        if timeout is None:
+            return await method(self, *args, **kwargs)
+
+        end = time.monotonic() + timeout
+        if outer_deadline is not None:
+            end = min(end, outer_deadline)
+
+        token = deadline.set(end)
+        try:
+            return await asyncio.wait_for(method(self, *args, **kwargs), max(end - time.monotonic(), 0))
+        except ExecutionTimeout as e:
+            raise asyncio.TimeoutError(f"{method.__name__} ran out of time in the server") from e
+        finally:
+            deadline.reset(token)
+
+    return run_query
+
+
+async def read_all(cursor):
+    """
+    Returns all documents of a cursor. The cursor is killed in the server when the query is cancelled
+    """
+    try:
+        return await cursor.to_list(length=None)
+    finally:
+        await cursor.close()
+
+
+async def iter_column_batches(collection, query, schema, sort=None, batch_size=10_000, max_time_ms=None):
+    """
+    Yields the result of a find as one set of columns per raw BSON batch, like columnarResults.iter_column_batches
+    """
+    cursor = collection.find_raw_batches(query, schema_projection(schema), sort=sort, batch_size=batch_size,
+                                        max_time_ms=max_time_ms)
+    try:
+        async for batch in cursor:
+            columns = decode_batch(batch, schema)
+            if columns is not None:
+                yield columns
+    finally:
+        await cursor.close()
+
+
+async def group_activity_trackpoints(trackpoints, fields, user_of, activity_of):
+    """
+    Groups consecutive trackpoints of the same activity into columns, like repository.group_activity_trackpoints
+    """
+    user_id = None
+    activity_id = None
+    columns = None
+
+    async for trackpoint in trackpoints:
+        next_activity_id = activity_of(trackpoint)
+
+        # A new activity starts, the previous one is complete
+        if next_activity_id != activity_id:
+            if columns is not None:
+                yield user_id, activity_id, columns
+
+            user_id = user_of(trackpoint)
+            activity_id = next_activity_id
+            columns = {field: [] for field in fields}
+
+        for field in fields:
+            columns[field].append(trackpoint[field])
+
+    if columns is not None:
+        yield user_id, activity_id, columns
+
+
+class AsyncDbConnector:
+    """
+    Connects to the MongoDB server like DbConnector, with a motor client for asyncio.
+    Connectors created on the same event loop with the same settings share one client and its connection pool,
+    so a connector has to be created while the event loop runs
+    """
+
+    def __init__(self,
+                 HOST=None,
+                 PORT=None,
+                 DATABASE=None,
+                 USER=None,
+                 PASSWORD=None):
+        uri, DATABASE = connection_uri(HOST, PORT, DATABASE, USER, PASSWORD)
+        self.client_key, self.client = acquire_client(uri, client_options(), AsyncIOMotorClient,
+                                                      asyncio.get_running_loop())
+        self.db = self.client[DATABASE]
+
+    def close_connection(self):
+        # The shared client is closed when no other connector uses it
+        release_client(self.client_key)
+        self.client_key = None
+
+
+class AsyncRepository:
+    """
+    Queries the MongoDB database like Repository without blocking the event loop, so one process can serve
+    many concurrent requests. Every query is a coroutine with the same name and arguments as in Repository,
+    and takes an optional timeout in seconds, see query. A query is cancelled like any other task,
+    which also closes its cursors in the server. The trackpoints are streamed as async iterators.
+    With more than one partition the heavy trackpoint queries run their user id ranges concurrently
+
+    Example:
+    query = await create_async_repository(timeout=30)
+    rows = await query.top_twenty_users()
+    rows = await query.invalid_activities_per_user(timeout=5)
+    async for activity in query.iter_activity_arrays():
+        ...
+    """
+
+    # The fields of the trackpoints that hold the user and activity ids
+    user_field = 'user_id'
+    activity_field = 'activity_id'
+
+    # The collection of the trackpoints and the schema of their columns
+    collection = TRACKPOINT_COLLECTIONS[DOCUMENT]
+    schema = TRACKPOINT_SCHEMA
+
+    def __init__(self, connection=None, partitions=1, timeout=None):
+        self.connection = connection or AsyncDbConnector()
+        self.client = self.connection.client
+        self.db = self.connection.db
+        self.trackpoints = self.db[self.collection]
+        self.partitions = partitions
+        self.timeout = timeout
+
+    async def aggregate(self, collection, pipeline, **kwargs):
+        """
+        Returns all results of the pipeline on the collection, limited to the time left of the query
+        """
+        return await read_all(collection.aggregate(pipeline, **kwargs, **time_limit()))
+
+    @query
+    async def sum_user_activity_trackpoint(self):
+        """
+        Query 1 - Finding how many users, activities and trackpoints are there in the dataset
+        """
+        user_sum, activity_sum, trackpoint_sum = await asyncio.gather(
+            self.db.User.estimated_document_count(**time_limit()),
+            self.db.Activity.estimated_document_count(**time_limit()),
+            self.count_trackpoints()
+        )
+        return "There are {} users, {:,} activities and {:,} trackpoints in the dataset".format(
+            user_sum, activity_sum, trackpoint_sum).replace(",", " ")
+
+    @query
+    async def average_number_of_activities_per_user(self):
+        """
+        Query 2 - Find the average number of activities per user.
+        """
+        res = await self.aggregate(self.db.Activity, activities_per_user_pipeline())
+
+        return 'The average number of activities per user is {:.2f}'.format(res[0]['avg'])
+
+    @query
+    async def top_twenty_users(self):
+        """
+        Query 3 - Find the top 20 users with the highest number of activities.
+        """
+        res = await self.aggregate(self.db.Activity, top_users_pipeline())
+
+        return [[i + 1, row['_id'], row['count']] for i, row in enumerate(res)]
+
+    @query
+    async def users_taken_taxi(self):
+        """
+        Query 4 - Find all users who have taken a taxi.
+        """
+        res = await self.aggregate(self.db.Activity, taxi_users_pipeline())
+
+        return [[row['_id']] for row in res]
+
+    @query
+    async def activity_transport_mode_count(self):
+        """
+        Query 5 - Find all types of transportation modes and count how many activities
+        that are tagged with these transportation mode labels.
+        """
+        res = await self.aggregate(self.db.Activity, mode_count_pipeline())
+
+        return [[row['_id'], row['count']] for row in res]
+
+    @query
+    async def year_with_most_activities(self):
+        """
+        Query 6 - Find the year with the most activities. Testing if this also is the year with most recorded hours
+        """
+        obj_res_6a, obj_res_6b = await asyncio.gather(
+            self.aggregate(self.db.Activity, year_activities_pipeline()),
+            self.aggregate(self.db.Activity, year_hours_pipeline())
+        )
+
+        return compare_years(obj_res_6a, obj_res_6b)
+
+    @query
+    async def total_distance_in_km_walked_in_2008_by_userid_112(self):
+        """
+        Query 7 - Find the total distance (in km) walked in 2008, by user with id = 112
+        """
+        rows = await self.distance_per_user_mode_year(*WALKED_IN_2008_BY_112)
+        return float(sum(distance for _, _, _, distance in rows))
+
+    @query
+    async def distance_per_user_mode_year(self, user_ids=None, transportation_modes=None, start=None, end=None):
+        """
+        Returns the distance in km covered by every combination of user, transportation mode and year
+        as [user_id, transportation_mode, year, distance] rows, see Repository.distance_per_user_mode_year
+        """
+        activities = await read_all(self.db.Activity.find(
+            distance_activity_query(user_ids, transportation_modes),
+            {'_id': False, 'id': True, 'transportation_mode': True}
+        ).max_time_ms(remaining_ms()))
+        modes = {activity['id']: activity['transportation_mode'] for activity in activities}
+        selection = distance_selection(self.user_field, self.activity_field, modes, user_ids, transportation_modes)
+
+        async def run(match):
+            totals = defaultdict(float)
+            activities_arrays = self.iter_activity_arrays(start=start, end=end,
+                                                          match=combine_matches(match, *selection))
+            try:
+                async for activity in activities_arrays:
+                    add_distances(totals, activity, modes.get(activity.activity_id))
+            finally:
+                await activities_arrays.aclose()
+            return totals
+
+        return sum_partial_totals(await self.fan_out(run))
+
+    @query
+    async def top_20_users_gained_most_altitude_meters(self):
+        """
+        Query 8 - Find the top 20 users who have gained the most altitude meters.
+        """
+        # The altitude gain of every activity is summarized at ingest
+        if await self.has_activity_summaries():
+            return top_altitude_users([await self.aggregate(self.db.Activity, summary_altitude_pipeline())])
+
+        return top_altitude_users(await self.fan_out(
+            lambda match: self.aggregate_consecutive_trackpoints('altitude', altitude_gain_stages(), match)))
+
+    @query
+    async def invalid_activities_per_user(self):
+        """
+        Query 9 - Find all users who have invalid activities, and the number of invalid activities per user
+        """
+        # The largest time gap of every activity is summarized at ingest
+        if await self.has_activity_summaries():
+            return sum_invalid_activities([await self.aggregate(self.db.Activity, summary_invalid_pipeline())])
+
+        return sum_invalid_activities(await self.fan_out(
+            lambda match: self.aggregate_consecutive_trackpoints('date_time', invalid_activity_stages(), match)))
+
+    @query
+    async def users_tracked_activity_in_the_forbidden_city_beijing(self):
+        """
+        Query 10 - Find the users who have tracked an activity in the Forbidden City of Beijing.
+        """
+        return forbidden_city_messages(await self.users_with_trackpoints_in_box(*FORBIDDEN_CITY))
+
+    @query
+    async def has_activity_summaries(self):
+        """
+        Checks if the activities carry the summaries computed at ingest, see trajectory.summarize
+        """
+        activity = await self.db.Activity.find_one({'point_count': {'$exists': True}}, {'_id': True},
+                                                   max_time_ms=remaining_ms())
+        return activity is not None
+
+    @query
+    async def count_trackpoints(self):
+        """
+        Returns the number of trackpoints in the dataset
+        """
+        return await self.trackpoints.estimated_document_count(**time_limit())
+
+    def consecutive_trackpoints_pipeline(self, field):
+        """
+        Returns the pipeline stages that pair every trackpoint with the next one in the same activity, sorted by time
+        """
+        return consecutive_trackpoints_pipeline(field, self.activity_field, self.user_field)
+
+    async def aggregate_consecutive_trackpoints(self, field, stages, match=None):
+        """
+        Runs the stages inside the server on every pair of consecutive trackpoints of the same activity
+        and returns all results. With a match only the trackpoints of one partition are read
+        """
+        return await self.aggregate(self.trackpoints,
+                                    match_stage(match) + self.consecutive_trackpoints_pipeline(field) + stages,
+                                    allowDiskUse=True)
+
+    async def user_ranges(self):
+        """
+        Splits the user ids into contiguous ranges with about the same number of users, one for each partition
+        """
+        return user_ranges(sorted(await self.db.User.distinct('id', **time_limit())), self.partitions)
+
+    async def fan_out(self, run):
+        """
+        Awaits run with the match of every user range partition concurrently and returns their results in order.
+        When a partition fails, or the query is cancelled or times out, the other partitions are cancelled
+        and their cursors closed before the error is raised. With a single partition run is awaited once without a match
+        """
+        if self.partitions <= 1:
+            return [await run(None)]
+
+        matches = [{self.user_field: user_range} if user_range else None for user_range in await self.user_ranges()]
+        tasks = [asyncio.ensure_future(run(match)) for match in matches]
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    def trackpoint_field(self, field):
+        """
+        Returns the field of the trackpoint documents that holds the user_id, activity_id or other field
+        """
+        return field
+
+    async def iter_activity_trackpoints(self, fields, activity_ids=None, batch_size=10_000, timeout=None):
+        """
+        Yields the trackpoints of one activity at a time as (user_id, activity_id, trackpoints),
+        where trackpoints maps each of the fields to the list of its values in time order.
+        The timeout in seconds limits the time the stream takes in the server
+        """
+        query = {} if activity_ids is None else {'activity_id': {'$in': activity_ids}}
+
+        # Sorting on the (activity_id, date_time) index keeps the trackpoints of an activity together
+        cursor = self.trackpoints.find(query, {
+            '_id': False,
+            'user_id': True,
+            'activity_id': True,
+            **{field: True for field in fields}
+        }).sort([('activity_id', 1), ('date_time', 1)]).batch_size(batch_size) \
+            .max_time_ms(stream_time_limit(timeout if timeout is not None else self.timeout))
+
+        try:
+            async for group in group_activity_trackpoints(cursor, fields, lambda x: x['user_id'],
+                                                          lambda x: x['activity_id']):
+                yield group
+        finally:
+            await cursor.close()
+
+    async def iter_activity_arrays(self, activity_ids=None, batch_size=10_000, start=None, end=None, match=None,
+                                   timeout=None):
+        """
+        Yields the trackpoints of one activity at a time as trajectory.ActivityArrays, read as columns one batch at
+        a time, see Repository.iter_activity_arrays. The timeout in seconds limits the time the stream takes in the server
+        """
+        query = combine_matches(trackpoint_query(start, end, match),
+                                {self.activity_field: {'$in': activity_ids}} if activity_ids is not None else None)
+        batches = iter_column_batches(self.trackpoints, query or {}, self.schema,
+                                      [(self.activity_field, 1), ('date_time', 1)], batch_size,
+                                      stream_time_limit(timeout if timeout is not None else self.timeout))
+
+        pending = None
+        try:
+            async for columns in batches:
+                complete, pending = split_complete_activities(pending, from_series_columns(columns))
+                for activity in columns_to_activity_arrays(complete):
+                    yield activity
+        finally:
+            await batches.aclose()
+
+        if pending is not None:
+            for activity in columns_to_activity_arrays(pending):
+                yield activity
+
+    async def find_columns(self, collection, query, schema, sort=None, batch_size=10_000):
+        """
+        Returns the result of a find on the collection as NumPy columns instead of documents, see columnarResults
+        """
+        batches = iter_column_batches(self.db[collection], query, schema, sort, batch_size, remaining_ms())
+        try:
+            return concatenate_columns([columns async for columns in batches], schema)
+        finally:
+            await batches.aclose()
+
+    @query
+    async def users_with_trackpoints_in_box(self, min_lat, max_lat, min_lon, max_lon):
+        """
+        Returns the ids of the users with at least one trackpoint inside the box, edges included,
+        see Repository.users_with_trackpoints_in_box
+        """
+        box = (min_lat, max_lat, min_lon, max_lon)
+        return sorted(set().union(*await self.fan_out(lambda match: self.distinct_in_box(box, 'user_id', match))))
+
+    async def distinct_in_box(self, box, field, match=None):
+        """
+        Returns the distinct values of the field among the trackpoints inside the box that also match
+        """
+        return await self.trackpoints.distinct(self.trackpoint_field(field), box_query(*box, match), **time_limit())
+
+    async def distinct_in_area(self, area, field):
+        """
+        Returns the sorted distinct values of the field among the trackpoints inside the $geoWithin area,
+        joined over the partitions
+        """
+        return sorted(set().union(*await self.fan_out(lambda match: self.distinct_in_partition(area, field, match))))
+
+    async def distinct_in_partition(self, area, field, match=None):
+        """
+        Returns the distinct values of the field among the trackpoints inside the area that also match
+        """
+        return await self.trackpoints.distinct(self.trackpoint_field(field), location_area_query(area, match),
+                                               **time_limit())
+
+    @query
+    async def users_in_box(self, min_lat, max_lat, min_lon, max_lon):
+        """
+        Returns the ids of the users with trackpoints inside the box
+        """
+        return await self.distinct_in_area(box_area(min_lat, max_lat, min_lon, max_lon), 'user_id')
+
+    @query
+    async def users_near(self, lat, lon, radius_km):
+        """
+        Returns the ids of the users with trackpoints within radius_km of the point
+        """
+        return await self.distinct_in_area(circle_area(lat, lon, radius_km), 'user_id')
+
+    @query
+    async def users_in_polygon(self, points):
+        """
+        Returns the ids of the users with trackpoints inside the polygon given as a list of (lat, lon) points
+        """
+        return await self.distinct_in_area(polygon_area(points), 'user_id')
+
+    @query
+    async def activities_in_box(self, min_lat, max_lat, min_lon, max_lon):
+        """
+        Returns the ids of the activities with trackpoints inside the box
+        """
+        return await self.distinct_in_area(box_area(min_lat, max_lat, min_lon, max_lon), 'activity_id')
+
+    @query
+    async def activities_near(self, lat, lon, radius_km):
+        """
+        Returns the ids of the activities with trackpoints within radius_km of the point
+        """
+        return await self.distinct_in_area(circle_area(lat, lon, radius_km), 'activity_id')
+
+    @query
+    async def activities_in_polygon(self, points):
+        """
+        Returns the ids of the activities with trackpoints inside the polygon given as a list of (lat, lon) points
+        """
+        return await self.distinct_in_area(polygon_area(points), 'activity_id')
+
+    @query
+    async def values_in_areas(self, areas, field):
+        """
+        Returns the sorted distinct values of the field among the trackpoints inside each of the areas, in one pass,
+        see Repository.values_in_areas
+        """
+        plan = plan_lookup(areas)
+
+        async def run(match):
+            results = [set() for _ in areas]
+            for resolution, (inside, edge) in plan.items():
+                for cells in cell_batches(inside):
+                    assign_inside(results, inside, await self.values_in_cells(resolution, cells, field, match))
+                for cells in cell_batches(edge):
+                    assign_edge(results, areas, edge, *await self.points_in_cells(resolution, cells, field, match))
+            return results
+
+        partial_results = await self.fan_out(run)
+        return [sorted(set().union(*(results[index] for results in partial_results))) for index in range(len(areas))]
+
+    async def values_in_cells(self, resolution, cells, field, match=None):
+        """
+        Returns the distinct (cell, value) pairs of the field among the trackpoints in the cells
+        """
+        return cell_value_pairs(await self.aggregate(
+            self.trackpoints, cell_values_pipeline(resolution, cells, self.trackpoint_field(field), match)))
+
+    async def points_in_cells(self, resolution, cells, field, match=None):
+        """
+        Returns the cells, coordinates and values of the field of the trackpoints in the cells, as columns
+        """
+        value_field = self.trackpoint_field(field)
+        schema = {cell_field(resolution): INTEGER, 'lat': FLOAT, 'lon': FLOAT, value_field: STRING}
+        columns = await self.find_columns(self.collection,
+                                          {cell_field(resolution): {'$in': cells}, **(match or dict())}, schema)
+        return columns[cell_field(resolution)], columns['lat'], columns['lon'], columns[value_field]
+
+    @query
+    async def users_in_areas(self, areas):
+        """
+        Returns the ids of the users with trackpoints inside each of the areas, in the order of the areas
+        """
+        return await self.values_in_areas(areas, 'user_id')
+
+    @query
+    async def activities_in_areas(self, areas):
+        """
+        Returns the ids of the activities with trackpoints inside each of the areas, in the order of the areas
+        """
+        return await self.values_in_areas(areas, 'activity_id')
+
+    @query
+    async def labeled_trackpoints_per_user_mode(self, user_ids=None, transportation_modes=None):
+        """
+        Returns the number of trackpoints every user recorded in each transportation mode as
+        [user_id, transportation_mode, trackpoints] rows, see Repository.labeled_trackpoints_per_user_mode
+        """
+        selection = labeled_selection(self.user_field, user_ids, transportation_modes)
+
+        async def run(match):
+            return dict(await self.count_trackpoint_modes(combine_matches(match, selection), transportation_modes))
+
+        return sum_partial_totals(await self.fan_out(run))
+
+    async def count_trackpoint_modes(self, match, transportation_modes=None):
+        """
+        Returns the number of matching trackpoints per user and transportation mode as ((user_id, mode), count) pairs
+        """
+        return mode_count_pairs(await self.aggregate(self.trackpoints,
+                                                     trackpoint_modes_pipeline(match, self.user_field)))
+
+    @query
+    async def most_used_transportation_mode_per_user(self):
+        """
+        Query 11 - Find all users who have registered transportation_mode and their most used transportation_mode
+        """
+        activities = await read_all(self.db.Activity.find(LABELED_ACTIVITIES, {
+            '_id': False,
+            'user_id': True,
+            'transportation_mode': True
+        }).max_time_ms(remaining_ms()))
+
+        return most_used_modes(activities)
+
+
+class AsyncBucketRepository(AsyncRepository):
+    """
+    Queries a database where the trackpoints are stored as one bucket document per activity, see BucketRepository
+    """
+
+    collection = TRACKPOINT_COLLECTIONS[BUCKET]
+
+    @query
+    async def count_trackpoints(self):
+        res = await self.aggregate(self.trackpoints, bucket_count_pipeline())
+
+        return res[0]['count'] if res else 0
+
+    def consecutive_trackpoints_pipeline(self, field):
+        return bucket_pairs_stages(field)
+
+    async def iter_buckets(self, query, fields, batch_size, timeout):
+        cursor = self.trackpoints.find(query, bucket_projection(fields)).sort('activity_id', 1) \
+            .batch_size(bucket_batch_size(batch_size)) \
+            .max_time_ms(stream_time_limit(timeout if timeout is not None else self.timeout))
+        try:
+            async for bucket in cursor:
+                yield bucket
+        finally:
+            await cursor.close()
+
+    async def iter_activity_trackpoints(self, fields, activity_ids=None, batch_size=10_000, timeout=None):
+        query = {} if activity_ids is None else {'activity_id': {'$in': activity_ids}}
+
+        # Every bucket already holds the columns of one activity
+        buckets = self.iter_buckets(query, fields, batch_size, timeout)
+        try:
+            async for bucket in buckets:
+                yield bucket['user_id'], bucket['activity_id'], {field: bucket[field] for field in fields}
+        finally:
+            await buckets.aclose()
+
+    async def iter_activity_arrays(self, activity_ids=None, batch_size=10_000, start=None, end=None, match=None,
+                                   timeout=None):
+        # The buckets outside the period are skipped, the points of the others are cut to it
+        buckets = self.iter_buckets(bucket_period_query(activity_ids, start, end, match) or {}, ARRAY_FIELDS,
+                                    batch_size, timeout)
+        lower, upper = epoch_bounds(start, end)
+        try:
+            async for bucket in buckets:
+                yield bucket_activity_arrays(bucket, lower, upper)
+        finally:
+            await buckets.aclose()
+
+    async def distinct_in_partition(self, area, field, match=None):
+        # A bucket matches when any of its points is inside the area
+        return await self.trackpoints.distinct(field, bucket_area_query(area, match), **time_limit())
+
+    async def distinct_in_box(self, box, field, match=None):
+        return [row['_id'] for row in await self.aggregate(self.trackpoints, bucket_box_pipeline(box, field, match))]
+
+    async def values_in_cells(self, resolution, cells, field, match=None):
+        return cell_value_pairs(await self.aggregate(
+            self.trackpoints, bucket_cell_values_pipeline(resolution, cells, field, match)))
+
+    async def points_in_cells(self, resolution, cells, field, match=None):
+        # The cells of the points are computed from the arrays of the buckets that share a cell with the lookup
+        buckets = await read_all(self.trackpoints.find({bucket_cell_field(resolution): {'$in': cells},
+                                                        **(match or dict())}, {
+            '_id': False,
+            'lat': True,
+            'lon': True,
+            field: True
+        }).max_time_ms(remaining_ms()))
+
+        return bucket_cell_points(buckets, resolution, cells, field)
+
+    async def count_trackpoint_modes(self, match, transportation_modes=None):
+        return mode_count_pairs(await self.aggregate(
+            self.trackpoints, bucket_trackpoint_modes_pipeline(match, transportation_modes)))
+
+
+class AsyncTimeSeriesRepository(AsyncRepository):
+    """
+    Queries a database where the trackpoints are stored in a time series collection, see TimeSeriesRepository
+    """
+
+    # The user and activity are stored in the metadata field
+    user_field = 'meta.user_id'
+    activity_field = 'meta.activity_id'
+
+    collection = TRACKPOINT_COLLECTIONS[TIMESERIES]
+    schema = SERIES_SCHEMA
+
+    @query
+    async def count_trackpoints(self):
+        return await self.trackpoints.count_documents({}, **time_limit())
+
+    def trackpoint_field(self, field):
+        return 'meta.' + field if field in ('user_id', 'activity_id') else field
+
+    async def iter_activity_trackpoints(self, fields, activity_ids=None, batch_size=10_000, timeout=None):
+        query = {} if activity_ids is None else {'meta.activity_id': {'$in': activity_ids}}
+
+        # Time series collections have no meaningful natural order, so the points are sorted explicitly
+        cursor = self.trackpoints.find(query, {
+            '_id': False,
+            'meta': True,
+            **{field: True for field in fields}
+        }).sort([('meta.activity_id', 1), ('date_time', 1)]).batch_size(batch_size) \
+            .max_time_ms(stream_time_limit(timeout if timeout is not None else self.timeout))
+
+        try:
+            async for group in group_activity_trackpoints(cursor, fields, lambda x: x['meta']['user_id'],
+                                                          lambda x: x['meta']['activity_id']):
+                yield group
+        finally:
+            await cursor.close()
+
+
+ASYNC_REPOSITORIES = {
+    DOCUMENT: AsyncRepository,
+    BUCKET: AsyncBucketRepository,
+    TIMESERIES: AsyncTimeSeriesRepository
+}
+
+
+async def create_async_repository(partitions=1, timeout=None):
+    """
+    Returns an async repository for the trackpoint layout the database was loaded with
+    """
+    connection = AsyncDbConnector()
+    document = await connection.db.Metadata.find_one({"_id": "trackpoint_layout"})
+    layout = document["value"] if document else DOCUMENT
+
+    return ASYNC_REPOSITORIES[layout](connection, partitions, timeout)
+
+
+# The queries of runQueries, as the methods of the repository
+QUERY_NAMES = [
+    "sum_user_activity_trackpoint",
+    "average_number_of_activities_per_user",
+    "top_twenty_users",
+    "users_taken_taxi",
+    "activity_transport_mode_count",
+    "year_with_most_activities",
+    "total_distance_in_km_walked_in_2008_by_userid_112",
+    "top_20_users_gained_most_altitude_meters",
+    "invalid_activities_per_user",
+    "users_tracked_activity_in_the_forbidden_city_beijing",
+    "most_used_transportation_mode_per_user",
+]
+
+
+async def serve_queries(requests, partitions=1, timeout=None):
+    """
+    Runs every query as many times as the given number of requests, all at once on one event loop and one client,
+    and reports the latency of every query and how many timed out
+    """
+    repository = await create_async_repository(partitions, timeout)
+
+    async def timed(name):
+        start = time.perf_counter()
+        try:
+            await getattr(repository, name)()
+        except asyncio.TimeoutError:
+            return None
+        return time.perf_counter() - start
+
+    print(f"{time.strftime('%H:%M:%S')} Running {len(QUERY_NAMES) * requests} concurrent queries...")
+    start = time.perf_counter()
+    latencies = await asyncio.gather(*(timed(name) for name in QUERY_NAMES for _ in range(requests)))
+    total = time.perf_counter() - start
+
+    repository.connection.close_connection()
+
+    rows = []
+    for index, name in enumerate(QUERY_NAMES):
+        finished = [latency for latency in latencies[index * requests:(index + 1) * requests] if latency is not None]
+        rows.append([
+            index + 1,
+            name,
+            round(float(np.median(finished)), 3) if finished else "",
+            round(max(finished), 3) if finished else "",
+            requests - len(finished)
+        ])
+
+    print(tabulate(rows, headers=['query', 'method', 'median seconds', 'max seconds', 'timed out'], tablefmt='github'))
+    print(f"{len(latencies)} queries in {total:.2f} seconds")
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--concurrency", type=int, default=10,
+                        help="Number of concurrent requests of every query")
+    parser.add_argument("-p", "--partitions", type=int, default=1,
+                        help="Number of user id ranges the heavy trackpoint queries are split into")
+    parser.add_argument("-t", "--timeout", type=float, help="Timeout of every query in seconds")
+    args = parser.parse_args()
+
+    asyncio.run(serve_queries(args.concurrency, args.partitions, args.timeout))
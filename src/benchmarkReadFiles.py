@@ -0,0 +1,197 @@
+import argparse
+import os
+import time
+from datetime import datetime
+from tabulate import tabulate
+from readFiles import (list_user_ids, read_labels_file, read_plot_file,
+                       build_label_activities, build_trackpoints)
+from labelJoin import build_label_intervals
+from spatialGrid import RESOLUTIONS, cell_field, cell_ids
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def build_label_activities_rowwise(user_id, df):
+    """
+    The original row by row construction of the label activities, kept as the baseline
+    """
+    activities = dict()
+
+    for _, row in df.iterrows():
+        stripped_start_date = row["start_date_time"].split(" ")[0].replace("/", "")
+        stripped_start_time = row["start_date_time"].split(" ")[1].replace(":", "")
+
+        activity_id = user_id + "_" + stripped_start_date + stripped_start_time
+
+        formatted_start_date = row["start_date_time"].replace("/", "-")
+        formatted_end_date = row["end_date_time"].replace("/", "-")
+
+        activities[activity_id] = {
+            "user_id": user_id,
+            "transportation_mode": row["transportation_mode"],
+            "start_date_time": datetime.strptime(str(formatted_start_date), "%Y-%m-%d %H:%M:%S"),
+            "end_date_time": datetime.strptime(str(formatted_end_date), "%Y-%m-%d %H:%M:%S")
+        }
+
+    return activities
+
+
+def label_mode_rowwise(labels, date_time):
+    """
+    Finds the label covering one point by scanning the labels of the user, the nested scan the join replaced.
+    The latest label starting at or before the point wins when it covers the point, and otherwise the earlier
+    label that reaches farthest
+    """
+    moment = (date_time - EPOCH).total_seconds()
+    latest = reach = None
+    for start, end, mode in zip(labels.starts, labels.ends, labels.modes):
+        if start > moment:
+            break
+        latest = (end, mode)
+        if reach is None or end >= reach[0]:
+            reach = latest
+
+    if latest is None:
+        return ""
+    if moment <= latest[0]:
+        return latest[1]
+    return reach[1] if moment <= reach[0] else ""
+
+
+def build_trackpoints_rowwise(user_id, activity_id, df):
+    """
+    The original row by row construction of the trackpoints, kept as the baseline
+    """
+    trackpoints = dict()
+
+    for _, row in df.iterrows():
+        stripped_start_date = row["date"].replace("/", "")
+        stripped_start_time = row["date_time"].replace(":", "")
+
+        trackpoint_id = activity_id + "_" + stripped_start_date + stripped_start_time
+
+        trackpoints[trackpoint_id] = {
+            "activity_id": activity_id,
+            "user_id": user_id,
+            "lat": row["lat"],
+            "lon": row["long"],
+            "altitude": "" if row["altitude"] == -777 else row["altitude"],
+            "date_days": row["date"].replace("-", ""),
+            "date_time": datetime.strptime(str(row["date"] + " " + row["date_time"]), "%Y-%m-%d %H:%M:%S")
+        }
+
+        if -90 <= row["lat"] <= 90 and -180 <= row["long"] <= 180:
+            trackpoints[trackpoint_id]["location"] = {"type": "Point", "coordinates": [row["long"], row["lat"]]}
+
+    return trackpoints
+
+
+def build_trackpoints_reference(user_id, activity_id, df, labels=None):
+    """
+    The baseline trackpoints with the grid cells and transportation modes the import added since, computed row by row.
+    It is only used to check the output of the vectorized construction and is not timed
+    """
+    trackpoints = build_trackpoints_rowwise(user_id, activity_id, df)
+
+    for trackpoint in trackpoints.values():
+        if "location" in trackpoint:
+            for resolution in RESOLUTIONS:
+                trackpoint[cell_field(resolution)] = int(cell_ids(trackpoint["lat"], trackpoint["lon"], resolution))
+
+        mode = label_mode_rowwise(labels, trackpoint["date_time"]) if labels is not None else ""
+        if mode:
+            trackpoint["transportation_mode"] = mode
+
+    return trackpoints
+
+
+def load_sample(number_of_users):
+    """
+    Reads the labels and plot files of the first users into dataframes, so only the document construction is timed.
+    The label intervals are sorted here too, as the import does that once per user before the plot files
+    """
+    sample = []
+    for user_id in list_user_ids()[:number_of_users]:
+        user_path = os.path.join("../dataset/Data", user_id)
+        labels_path = os.path.join(user_path, "labels.txt")
+        labels = read_labels_file(labels_path) if os.path.exists(labels_path) else None
+        intervals = build_label_intervals(labels) if labels is not None else None
+
+        trajectory_path = os.path.join(user_path, "Trajectory")
+        plots = []
+        for name in sorted(os.listdir(trajectory_path)):
+            df = read_plot_file(os.path.join(trajectory_path, name))
+            plots.append((user_id + "_" + name.split(".")[0], df))
+
+        sample.append((user_id, labels, intervals, plots))
+    return sample
+
+
+def build_documents(sample, label_builder, trackpoint_builder, labeled=True):
+    """
+    Builds the documents of the sample. The trackpoint builder gets the label intervals of the user when labeled
+    """
+    activities = dict()
+    trackpoints = dict()
+    for user_id, labels, intervals, plots in sample:
+        if labels is not None:
+            activities.update(label_builder(user_id, labels))
+        for activity_id, df in plots:
+            if labeled:
+                trackpoints.update(trackpoint_builder(user_id, activity_id, df, intervals))
+            else:
+                trackpoints.update(trackpoint_builder(user_id, activity_id, df))
+    return activities, trackpoints
+
+
+def time_builders(sample, label_builder, trackpoint_builder, repeat, labeled=True):
+    """
+    Returns the best time out of repeat runs together with the documents built
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        documents = build_documents(sample, label_builder, trackpoint_builder, labeled)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, documents
+
+
+def documents_equal(a, b):
+    # NaN labels are not equal to themselves, so they are compared through their string form
+    return repr(a) == repr(b)
+
+
+def main(number_of_users, repeat):
+    sample = load_sample(number_of_users)
+
+    # The original construction never labeled the trackpoints
+    rowwise_time, _ = time_builders(sample, build_label_activities_rowwise, build_trackpoints_rowwise, repeat,
+                                    labeled=False)
+    vectorized_time, vectorized_documents = time_builders(
+        sample, build_label_activities, build_trackpoints, repeat)
+
+    # The vectorized construction also adds fields the baseline never had, they are checked against a reference
+    reference_documents = build_documents(sample, build_label_activities_rowwise, build_trackpoints_reference)
+
+    number_of_trackpoints = len(vectorized_documents[1])
+
+    headers = ['construction', 'seconds', 'trackpoints/s']
+    print(tabulate([
+        ['row by row (before)', round(rowwise_time, 3), round(number_of_trackpoints / rowwise_time)],
+        ['vectorized (after)', round(vectorized_time, 3), round(number_of_trackpoints / vectorized_time)],
+    ], headers=headers, tablefmt='github'))
+
+    print("\n{} users, {:,} trackpoints, speedup {:.1f}x".format(
+        len(sample), number_of_trackpoints, rowwise_time / vectorized_time))
+    print("Identical output:", documents_equal(reference_documents, vectorized_documents))
+
+
+if __name__ == "__main__":
+    # Benchmarks the document construction on a sample of user directories
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-u", "--users", type=int, default=10, help="Number of user directories in the sample")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="Number of runs, the best one is reported")
+    args = parser.parse_args()
+
+    main(args.users, args.repeat)
@@ -0,0 +1,204 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import time
+from tabulate import tabulate
+from generateDataset import generate_dataset
+from insertData import insert_data, peak_memory_mb
+from layoutRepository import create_repository
+from runQueries import QUERIES, timed_query
+from trackpointLayouts import DOCUMENT, LAYOUTS
+from pipelineMetrics import METRICS, enable_command_monitoring
+
+
+def use_benchmark_root(root):
+    """
+    Makes root/dataset the dataset every module reads.
+    The modules read the dataset relative to the working directory, so the benchmark works from root/src
+    """
+    working_directory = os.path.join(root, "src")
+    os.makedirs(working_directory, exist_ok=True)
+    os.chdir(working_directory)
+
+
+def benchmark_ingest(workers, writer_threads, layout):
+    """
+    Loads the dataset into the database and returns the load time and throughput
+    """
+    with METRICS.phase("total"):
+        insert_data(workers, writer_threads, layout=layout)
+    seconds = METRICS.durations["total"]
+
+    repository = create_repository()
+    trackpoints = repository.count_trackpoints()
+    activities = repository.db.Activity.count_documents({})
+    repository.connection.close_connection()
+
+    return {
+        "seconds": seconds,
+        "activities": activities,
+        "trackpoints": trackpoints,
+        "trackpoints_per_second": trackpoints / seconds if seconds else 0.0,
+        "peak_memory_mb": peak_memory_mb()
+    }
+
+
+def benchmark_queries(repeats):
+    """
+    Runs every query the given number of times and returns the median and minimum latency of each, in seconds
+    """
+    repository = create_repository()
+    results = dict()
+    for query_function in QUERIES:
+        latencies = [timed_query(query_function, repository)[1] for _ in range(repeats)]
+        results[query_function.__name__] = {
+            "median_seconds": statistics.median(latencies),
+            "min_seconds": min(latencies)
+        }
+        print(f"{time.strftime('%H:%M:%S')} {query_function.__name__}: {results[query_function.__name__]['median_seconds']:.3f} s")
+    repository.connection.close_connection()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Prints the results next to the baseline and returns the names of the measurements that regressed
+    by more than the tolerance, a share of the baseline value
+    """
+    rows = []
+    regressions = []
+
+    # Throughput should not drop, latencies should not grow
+    measurements = []
+    if "ingest" in results:
+        measurements.append(("ingest trackpoints/s", results["ingest"]["trackpoints_per_second"],
+                             baseline.get("ingest", dict()).get("trackpoints_per_second"), True))
+    for name, query in results["queries"].items():
+        baseline_query = baseline.get("queries", dict()).get(name, dict())
+        measurements.append((name, query["median_seconds"], baseline_query.get("median_seconds"), False))
+
+    for name, value, baseline_value, higher_is_better in measurements:
+        if not baseline_value:
+            rows.append([name, "-", "{:.4g}".format(value), "-", "new"])
+            continue
+
+        change = (value - baseline_value) / baseline_value
+        regressed = change < -tolerance if higher_is_better else change > tolerance
+        if regressed:
+            regressions.append(name)
+        rows.append([name, "{:.4g}".format(baseline_value), "{:.4g}".format(value), "{:+.1%}".format(change),
+                     "REGRESSION" if regressed else "ok"])
+
+    print(tabulate(rows, headers=['measurement', 'baseline', 'current', 'change', 'status'], tablefmt='github'))
+    return regressions
+
+
+def baseline_file(root, layout):
+    """
+    Returns the default baseline of a layout, kept in the root folder next to the generated dataset.
+    Timings depend on the machine, so every machine keeps its own baseline instead of sharing one
+    """
+    return os.path.join(root, f"baseline_{layout}.json")
+
+
+def differing_setup(results, baseline):
+    """
+    Returns the dataset and settings keys in which the results and the baseline differ,
+    the timings of such runs can not be compared
+    """
+    return [f"{section}.{key}" for section in ("dataset", "settings")
+            for key in sorted(set(results[section]) | set(baseline.get(section, dict())))
+            if results[section].get(key) != baseline.get(section, dict()).get(key)]
+
+
+def run_benchmark(root, users, files, points, seed, repeats, workers, writer_threads, layout,
+                  generate=True, skip_ingest=False):
+    """
+    Generates a synthetic dataset in root, loads it and times every query.
+    Returns the results as a dictionary that can be written to JSON
+    """
+    if generate:
+        # Files of an earlier, larger dataset would otherwise be loaded as well
+        shutil.rmtree(os.path.join(root, "dataset"), ignore_errors=True)
+        generate_dataset(os.path.join(root, "dataset"), users, files, points, seed=seed)
+    use_benchmark_root(root)
+    enable_command_monitoring()
+
+    results = {
+        "dataset": {"users": users, "files": files, "points": points, "seed": seed},
+        "settings": {"workers": workers, "writer_threads": writer_threads, "layout": layout, "repeats": repeats},
+        "environment": {"python": platform.python_version(), "machine": platform.machine(),
+                        "cpus": os.cpu_count(), "time": time.strftime('%Y-%m-%dT%H:%M:%S')}
+    }
+
+    if not skip_ingest:
+        results["ingest"] = benchmark_ingest(workers, writer_threads, layout)
+    results["queries"] = benchmark_queries(repeats)
+    results["metrics"] = METRICS.to_dict()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the ingest and the queries on a synthetic dataset. "
+                    "The configured database is cleared, point MONGO_INITDB_DATABASE at a benchmark database")
+    parser.add_argument("--root", default="../benchmark", help="Folder the synthetic dataset is generated in")
+    parser.add_argument("-u", "--users", type=int, default=20, help="Number of users")
+    parser.add_argument("-f", "--files", type=int, default=20, help="Number of plot files per user")
+    parser.add_argument("-p", "--points", type=int, default=1000, help="Average number of points per plot file")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the dataset")
+    parser.add_argument("-r", "--repeats", type=int, default=3, help="Number of times every query is run")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Number of worker processes parsing the dataset")
+    parser.add_argument("--writers", type=int, default=4, help="Number of threads writing to the database")
+    parser.add_argument("--layout", choices=LAYOUTS, default=DOCUMENT, help="How the trackpoints are stored")
+    parser.add_argument("--no-generate", action="store_true", help="Reuse the dataset already in the root folder")
+    parser.add_argument("--skip-ingest", action="store_true", help="Only time the queries on the loaded database")
+    parser.add_argument("-o", "--output", default="benchmark.json", help="File the results are written to")
+    parser.add_argument("--baseline",
+                        help="Results of an earlier run to compare against, ../benchmark/baseline_<layout>.json by default")
+    parser.add_argument("--update-baseline", action="store_true",
+                        help="Write the results to the baseline instead of comparing against it")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Allowed change before a measurement counts as a regression, as a share of the baseline")
+    args = parser.parse_args()
+
+    # Paths given on the command line are relative to where the benchmark was started
+    root = os.path.abspath(args.root)
+    output = os.path.abspath(args.output)
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else baseline_file(root, args.layout)
+
+    # The baseline is read first, the results may be written over it
+    baseline = None
+    if not args.update_baseline and os.path.exists(baseline_path):
+        with open(baseline_path) as file:
+            baseline = json.load(file)
+
+    results = run_benchmark(root, args.users, args.files, args.points, args.seed, args.repeats, args.workers,
+                            args.writers, args.layout, not args.no_generate, args.skip_ingest)
+
+    with open(output, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"\n{time.strftime('%H:%M:%S')} Results written to {output}\n")
+
+    # The first run on a machine becomes its baseline
+    if baseline is None:
+        with open(baseline_path, "w") as file:
+            json.dump(results, file, indent=2)
+        print(f"{time.strftime('%H:%M:%S')} Baseline written to {baseline_path}")
+        sys.exit(0)
+
+    differences = differing_setup(results, baseline)
+    if differences:
+        print(f"The baseline {baseline_path} was taken with a different " + ", ".join(differences) +
+              ", run with --update-baseline to replace it")
+        sys.exit(2)
+
+    print(f"Compared to the baseline {baseline_path}")
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print("\nRegressed: " + ", ".join(regressions))
+        sys.exit(1)
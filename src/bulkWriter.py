@@ -0,0 +1,153 @@
+import queue
+import threading
+import time
+import bson
+from bson.raw_bson import RawBSONDocument
+from pymongo.write_concern import WriteConcern
+
+# Room left in every message for the insert command itself
+MESSAGE_OVERHEAD_BYTES = 16 * 1024
+
+# The server never accepts more documents than this in one write batch
+MAX_BATCH_DOCUMENTS = 100_000
+
+
+class BulkWriter:
+    """
+    Writes documents with unordered insert_many calls from several writer threads.
+    Documents are encoded once, grouped into batches that fit in a single server message,
+    and handed to the writers through a bounded queue, so the producer blocks when the writers fall behind.
+
+    Example:
+    with BulkWriter(db, threads=4) as writer:
+        writer.insert('TrackPoint', trackpoints)
+    writer.report()
+    """
+
+    def __init__(self, db, threads=4, max_queued_batches=16, write_concern=WriteConcern(w=1), max_batch_bytes=None):
+        self.db = db
+        self.write_concern = write_concern
+
+        if max_batch_bytes is None:
+            max_batch_bytes = db.command("isMaster")["maxMessageSizeBytes"] - MESSAGE_OVERHEAD_BYTES
+        self.max_batch_bytes = max_batch_bytes
+
+        self.buffers = dict()
+        self.buffer_bytes = dict()
+        self.counts = dict()
+        self.written = dict()
+        self.lock = threading.Lock()
+        self.errors = []
+
+        self.batches = queue.Queue(maxsize=max_queued_batches)
+        self.threads = [threading.Thread(target=self.write_batches, daemon=True) for _ in range(threads)]
+        self.start_time = time.perf_counter()
+        self.end_time = None
+        for thread in self.threads:
+            thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(raise_errors=exc_type is None)
+
+    def write_batches(self):
+        """
+        Writes the batches put on the queue until it receives None
+        """
+        while True:
+            batch = self.batches.get()
+            if batch is None:
+                return
+
+            # After a failed write the remaining batches are drained so the producer never blocks
+            if self.errors:
+                continue
+
+            collection, documents = batch
+            try:
+                self.db[collection].with_options(write_concern=self.write_concern) \
+                    .insert_many(documents, ordered=False)
+            except Exception as e:
+                self.errors.append(e)
+                continue
+
+            with self.lock:
+                self.written[collection] = self.written.get(collection, 0) + len(documents)
+
+    def insert(self, collection, documents):
+        """
+        Adds the documents to the collection's current batch and queues every batch that is full
+        """
+        if self.errors:
+            raise self.errors[0]
+
+        buffer = self.buffers.setdefault(collection, [])
+        self.counts[collection] = self.counts.get(collection, 0) + len(documents)
+
+        for document in documents:
+            raw = RawBSONDocument(bson.encode(document))
+            size = len(raw.raw)
+
+            if buffer and (self.buffer_bytes.get(collection, 0) + size > self.max_batch_bytes
+                           or len(buffer) >= MAX_BATCH_DOCUMENTS):
+                self.flush(collection)
+                buffer = self.buffers[collection]
+
+            buffer.append(raw)
+            self.buffer_bytes[collection] = self.buffer_bytes.get(collection, 0) + size
+
+    def flush(self, collection=None):
+        """
+        Queues the partial batch of the collection, or of every collection
+        """
+        collections = list(self.buffers) if collection is None else [collection]
+        for name in collections:
+            if self.buffers.get(name):
+                self.batches.put((name, self.buffers[name]))
+            self.buffers[name] = []
+            self.buffer_bytes[name] = 0
+
+    def close(self, raise_errors=True):
+        """
+        Writes the remaining documents and waits for the writer threads to finish
+        """
+        if self.end_time is not None:
+            return
+
+        if not self.errors:
+            self.flush()
+
+        for _ in self.threads:
+            self.batches.put(None)
+        for thread in self.threads:
+            thread.join()
+
+        self.end_time = time.perf_counter()
+
+        if self.errors and raise_errors:
+            raise self.errors[0]
+
+    def report(self):
+        """
+        Prints the number of documents written and the throughput per collection
+        """
+        elapsed = (self.end_time or time.perf_counter()) - self.start_time
+        for collection, count in self.written.items():
+            print("Wrote {:,} {} documents in {:.1f} s, {:,.0f} documents/s".format(
+                count, collection, elapsed, count / elapsed if elapsed else 0))
+
+    def verify(self, expected_counts=None):
+        """
+        Checks that every collection holds as many documents as were given to the writer.
+        Only valid when the collections were empty before the writer started
+        """
+        expected_counts = expected_counts or self.counts
+        valid = True
+        for collection, expected in expected_counts.items():
+            actual = self.db[collection].count_documents({})
+            if actual != expected:
+                print("WARNING: {} has {:,} documents, expected {:,}".format(collection, actual, expected))
+                valid = False
+        return valid
@@ -0,0 +1,560 @@
+import json
+import os
+import time
+import numpy as np
+from layoutRepository import create_repository
+from repository import FORBIDDEN_CITY, WALKED_IN_2008_BY_112, forbidden_city_messages
+from spatialGrid import cell_ids, contains, cover, lookup_resolution, points_in_polygon, within_radius
+from trajectory import altitude_differences, haversine_distances, time_gaps, to_epoch_seconds, years_of
+
+STORE_PATH = "../column_store"
+
+# Every trackpoint column is a flat file of float64 values, in the order of the activities and in time order
+TRACKPOINT_COLUMNS = ["lat", "lon", "altitude", "epoch"]
+
+# The transportation mode of every trackpoint is a flat file of int16 codes in the same order,
+# 0 for unlabeled trackpoints and i for the i-th mode listed in the metadata
+MODE_COLUMN = "transportation_mode.i2"
+
+
+def export_column_store(path=STORE_PATH, batch_size=10_000):
+    """
+    Writes all trackpoints of the database into memory-mappable column files, sorted by user, activity and time,
+    along with a table of the activities and their range of trackpoints and a table of the users.
+    The trackpoints are written one activity at a time, so memory only grows with the largest activity
+    """
+    repository = create_repository()
+    os.makedirs(path, exist_ok=True)
+
+    print(f"\n{time.strftime('%H:%M:%S')} Exporting trackpoints to {path}...")
+
+    # The metadata is written last, an interrupted export is not mistaken for a complete one
+    metadata_path = os.path.join(path, "metadata.json")
+    if os.path.exists(metadata_path):
+        os.remove(metadata_path)
+
+    ranges = dict()
+    offset = 0
+    previous_activity_id = None
+    files = {column: open(os.path.join(path, column + ".f8"), "wb") for column in TRACKPOINT_COLUMNS}
+    try:
+        for activity in repository.iter_activity_arrays(batch_size=batch_size):
+            # The activity ids start with the user id, so activity order is also user order
+            if previous_activity_id is not None and activity.activity_id <= previous_activity_id:
+                raise ValueError(f"Trackpoints are not sorted by activity at {activity.activity_id}")
+            previous_activity_id = activity.activity_id
+
+            for column in TRACKPOINT_COLUMNS:
+                files[column].write(np.ascontiguousarray(getattr(activity, column), dtype=np.float64).tobytes())
+
+            ranges[activity.activity_id] = (offset, offset + len(activity.epoch))
+            offset += len(activity.epoch)
+
+            if len(ranges) % 1000 == 0:
+                print(f"{time.strftime('%H:%M:%S')} Exported {len(ranges):,} activities")
+    finally:
+        for file in files.values():
+            file.close()
+
+    transportation_modes = export_trackpoint_modes(repository, path, ranges, offset, batch_size)
+
+    activities = list(repository.db.Activity.find({}, {
+        '_id': False,
+        'id': True,
+        'user_id': True,
+        'transportation_mode': True,
+        'start_date_time': True,
+        'end_date_time': True
+    }).sort('id', 1))
+
+    # Activities without trackpoints get an empty range where their trackpoints would have been
+    first, last, end = [], [], 0
+    for activity in activities:
+        start, end = ranges.get(activity['id'], (end, end))
+        first.append(start)
+        last.append(end)
+
+    activity_table = np.array(list(zip(
+        [activity['id'] for activity in activities],
+        [activity['user_id'] for activity in activities],
+        [activity['transportation_mode'] for activity in activities],
+        [activity['start_date_time'] for activity in activities],
+        [activity['end_date_time'] for activity in activities],
+        first,
+        last
+    )), dtype=[
+        ('id', 'U32'), ('user_id', 'U8'), ('transportation_mode', 'U16'),
+        ('start_date_time', 'datetime64[s]'), ('end_date_time', 'datetime64[s]'),
+        ('first', np.int64), ('last', np.int64)
+    ])
+    np.save(os.path.join(path, "activities.npy"), activity_table)
+
+    users = list(repository.db.User.find({}, {'_id': False, 'id': True, 'has_labels': True}).sort('id', 1))
+    user_table = np.array([(user['id'], user['has_labels']) for user in users],
+                          dtype=[('id', 'U8'), ('has_labels', np.bool_)])
+    np.save(os.path.join(path, "users.npy"), user_table)
+
+    with open(metadata_path, "w") as file:
+        json.dump({
+            "trackpoints": offset,
+            "activities": len(activity_table),
+            "users": len(user_table),
+            "columns": TRACKPOINT_COLUMNS,
+            "transportation_modes": transportation_modes,
+            "exported": time.strftime('%Y-%m-%dT%H:%M:%S')
+        }, file, indent=2)
+
+    repository.connection.close_connection()
+
+    print(f"{time.strftime('%H:%M:%S')} Exported {offset:,} trackpoints of {len(ranges):,} activities "
+          f"and {len(user_table)} users")
+
+
+def export_trackpoint_modes(repository, path, ranges, count, batch_size=10_000):
+    """
+    Writes the transportation mode codes of the exported trackpoints and returns the modes the codes stand for.
+    Every labeled trackpoint is found in the range of its activity by a binary search on its time,
+    which is unique within an activity
+    """
+    epoch = np.fromfile(os.path.join(path, "epoch.f8"), dtype=np.float64)
+    codes = np.zeros(count, dtype=np.int16)
+    transportation_modes = []
+
+    for columns in repository.iter_trackpoint_modes(batch_size):
+        point_epoch = columns["date_time"].astype("datetime64[us]").astype(np.int64) / 1_000_000
+        for activity_id in np.unique(columns["activity_id"]).tolist():
+            if activity_id not in ranges:
+                continue
+            first, last = ranges[activity_id]
+            of_activity = columns["activity_id"] == activity_id
+            positions = first + np.searchsorted(epoch[first:last], point_epoch[of_activity])
+
+            for mode in np.unique(columns["transportation_mode"][of_activity]).tolist():
+                if mode not in transportation_modes:
+                    transportation_modes.append(mode)
+                in_mode = columns["transportation_mode"][of_activity] == mode
+                codes[positions[in_mode]] = transportation_modes.index(mode) + 1
+
+    codes.tofile(os.path.join(path, MODE_COLUMN))
+    return transportation_modes
+
+
+def consecutive_pairs(activities, count):
+    """
+    Returns a mask over the pairs of consecutive trackpoints that is True where both points are in the same activity
+    """
+    same_activity = np.ones(max(count - 1, 0), dtype=bool)
+    # The pair ending at the first point of an activity crosses from the previous activity
+    starts = activities['first'][(activities['first'] > 0) & (activities['first'] < activities['last'])]
+    same_activity[starts - 1] = False
+    return same_activity
+
+
+def per_activity(pair_values, activities, reduce, empty):
+    """
+    Reduces the values of the consecutive pairs of every activity with a ufunc such as np.add or np.maximum.
+    Activities with fewer than two trackpoints get the empty value
+    """
+    # The sentinel lets reduceat read a slice for an activity that starts at the last trackpoint
+    values = np.append(pair_values, empty)
+    first = activities['first']
+    result = np.full(len(activities), empty, dtype=np.float64)
+
+    with_pairs = activities['last'] - first >= 2
+    if with_pairs.any():
+        # Every slice runs into the pair crossing to the next activity, which holds the empty value
+        result[with_pairs] = reduce.reduceat(values, first[with_pairs])
+    return result
+
+
+class ColumnStore:
+    """
+    The memory-mapped files of an exported column store.
+    Mapping the files is instant, the pages are only read when a query touches them
+    """
+
+    def __init__(self, path=STORE_PATH):
+        metadata_path = os.path.join(path, "metadata.json")
+        if not os.path.exists(metadata_path):
+            raise FileNotFoundError(f"No complete column store in {path}, export one with --export-column-store")
+
+        with open(metadata_path) as file:
+            self.metadata = json.load(file)
+
+        count = self.metadata["trackpoints"]
+        self.columns = {
+            column: np.memmap(os.path.join(path, column + ".f8"), dtype=np.float64, mode="r", shape=(count,))
+            if count else np.array([], dtype=np.float64)
+            for column in self.metadata["columns"]
+        }
+        # Stores exported before the modes were joined onto the trackpoints have no mode column
+        self.modes = None
+        if "transportation_modes" in self.metadata:
+            self.modes = np.memmap(os.path.join(path, MODE_COLUMN), dtype=np.int16, mode="r", shape=(count,)) \
+                if count else np.array([], dtype=np.int16)
+        self.activities = np.load(os.path.join(path, "activities.npy"), mmap_mode="r")
+        self.users = np.load(os.path.join(path, "users.npy"), mmap_mode="r")
+
+
+class ColumnStoreRepository:
+    """
+    Answers the queries of Repository from an exported column store with vectorized NumPy, without a database.
+    The connection is the store itself, so the repository is closed like one that is connected to MongoDB.
+
+    Example:
+    query = ColumnStoreRepository()
+    query.top_twenty_users()
+    """
+
+    def __init__(self, path=STORE_PATH):
+        self.path = path
+        self.store = ColumnStore(path)
+        self.connection = self
+        self.cell_indexes = dict()
+
+        print("Using the column store in", path)
+        print("-----------------------------------------------\n")
+
+    def close_connection(self):
+        self.store = None
+        print("\n-----------------------------------------------")
+        print("Column store in %s is closed" % self.path)
+
+    @property
+    def activities(self):
+        return self.store.activities
+
+    def column(self, name):
+        return self.store.columns[name]
+
+    def activity_users(self):
+        """
+        Returns the index of the user of every activity in the user table
+        """
+        return np.searchsorted(self.store.users['id'], self.activities['user_id'])
+
+    def count_trackpoints(self):
+        return self.store.metadata["trackpoints"]
+
+    def sum_user_activity_trackpoint(self):
+        """
+        Query 1 - Finding how many users, activities and trackpoints are there in the dataset
+        """
+        return "There are {} users, {:,} activities and {:,} trackpoints in the dataset".format(
+            len(self.store.users), len(self.activities), self.count_trackpoints()).replace(",", " ")
+
+    def average_number_of_activities_per_user(self):
+        """
+        Query 2 - Find the average number of activities per user.
+        """
+        _, counts = np.unique(self.activities['user_id'], return_counts=True)
+        return 'The average number of activities per user is {:.2f}'.format(counts.mean())
+
+    def top_twenty_users(self):
+        """
+        Query 3 - Find the top 20 users with the highest number of activities.
+        """
+        user_ids, counts = np.unique(self.activities['user_id'], return_counts=True)
+        order = np.lexsort((user_ids, -counts))[:20]
+        return [[i + 1, str(user_ids[j]), int(counts[j])] for i, j in enumerate(order)]
+
+    def users_taken_taxi(self):
+        """
+        Query 4 - Find all users who have taken a taxi.
+        """
+        taxi = self.activities['transportation_mode'] == 'taxi'
+        return [[str(user_id)] for user_id in np.unique(self.activities['user_id'][taxi])]
+
+    def activity_transport_mode_count(self):
+        """
+        Query 5 - Find all types of transportation modes and count how many activities
+        that are tagged with these transportation mode labels.
+        Does not count the rows where the mode is null.
+        """
+        modes = self.activities['transportation_mode']
+        modes, counts = np.unique(modes[modes != ''], return_counts=True)
+        order = np.lexsort((modes, -counts))
+        return [[str(modes[i]), int(counts[i])] for i in order]
+
+    def year_with_most_activities(self):
+        """
+        Query 6 - Find the year with the most activities. Testing if this also is the year with most recorded hours
+        """
+        start = self.activities['start_date_time']
+        years = start.astype('datetime64[Y]').astype(np.int64) + 1970
+        hours = (self.activities['end_date_time'] - start).astype(np.int64) / 3600
+
+        unique_years, counts = np.unique(years, return_counts=True)
+        year_a = int(unique_years[np.argmax(counts)])
+        print("The year {} has the most activities with {:,} activities".format(
+            year_a, int(counts.max())).replace(",", " "))
+
+        index = np.searchsorted(unique_years, years)
+        sums = np.bincount(index, weights=hours, minlength=len(unique_years))
+        order = np.argsort(-sums, kind="stable")[:5]
+        year_b = int(unique_years[order[0]])
+        print("The year {} has the most recorded hours with {:,} hours".format(
+            year_b, round(sums[order[0]])).replace(",", " "))
+
+        if year_a == year_b:
+            print("\nYes, this is also the year with most recorded hours!\n")
+        else:
+            print("\nNo, this is not the year with most recorded hours\n")
+
+        return [[int(unique_years[i]), round(sums[i])] for i in order]
+
+    def total_distance_in_km_walked_in_2008_by_userid_112(self):
+        """
+        Query 7 - Find the total distance (in km) walked in 2008, by user with id = 112
+        """
+        rows = self.distance_per_user_mode_year(*WALKED_IN_2008_BY_112)
+        return float(sum(distance for _, _, _, distance in rows))
+
+    def distance_per_user_mode_year(self, user_ids=None, transportation_modes=None, start=None, end=None):
+        """
+        Returns the distance in km covered by every combination of user, transportation mode and year,
+        the same rows as Repository.distance_per_user_mode_year, from one pass over the pairs of trackpoints
+        """
+        activities = self.activities
+        count = self.count_trackpoints()
+        epoch = self.column('epoch')
+
+        selected = np.ones(len(activities), dtype=bool)
+        if user_ids is not None:
+            selected &= np.isin(activities['user_id'], list(user_ids))
+        if transportation_modes is not None:
+            selected &= np.isin(activities['transportation_mode'], list(transportation_modes))
+
+        # The activity of a pair is the last activity with trackpoints that starts at or before its first point
+        with_points = np.flatnonzero(activities['last'] > activities['first'])
+        pair_activities = with_points[np.searchsorted(activities['first'][with_points], np.arange(max(count - 1, 0)),
+                                                      side='right') - 1]
+
+        pairs = consecutive_pairs(activities, count) & selected[pair_activities]
+        if start is not None:
+            pairs &= epoch[:-1] >= to_epoch_seconds([start])[0]
+        if end is not None:
+            pairs &= epoch[1:] < to_epoch_seconds([end])[0]
+
+        distances = haversine_distances(self.column('lat'), self.column('lon'))[pairs]
+        pair_activities = pair_activities[pairs]
+        years = years_of(epoch[:-1][pairs])
+
+        # Every combination is numbered so the distances are summed with a single bincount
+        users, user_codes = np.unique(activities['user_id'], return_inverse=True)
+        modes, mode_codes = np.unique(activities['transportation_mode'], return_inverse=True)
+        keys = (user_codes[pair_activities] * len(modes) + mode_codes[pair_activities]) * 10_000 + years
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+        sums = np.bincount(inverse, weights=distances, minlength=len(unique_keys))
+
+        return [[str(users[key // 10_000 // len(modes)]), str(modes[key // 10_000 % len(modes)]), int(key % 10_000),
+                 float(distance)] for key, distance in zip(unique_keys.tolist(), sums.tolist())]
+
+    def top_20_users_gained_most_altitude_meters(self):
+        """
+        Query 8 - Find the top 20 users who have gained the most altitude meters.
+        """
+        activities = self.activities
+        count = self.count_trackpoints()
+
+        differences = altitude_differences(self.column('altitude'))
+        gains = np.where(consecutive_pairs(activities, count) & (differences > 0), differences, 0.0)
+        activity_gains = per_activity(gains, activities, np.add, 0.0)
+
+        # Only users with an activity of two trackpoints or more are ranked
+        with_pairs = activities['last'] - activities['first'] >= 2
+        users = self.activity_users()
+        altitude = np.bincount(users[with_pairs], weights=activity_gains[with_pairs], minlength=len(self.store.users))
+        ranked = np.unique(users[with_pairs])
+
+        order = ranked[np.lexsort((self.store.users['id'][ranked], -altitude[ranked]))][:20]
+        return [[i + 1, str(self.store.users['id'][j]), round(altitude[j])] for i, j in enumerate(order)]
+
+    def invalid_activities_per_user(self):
+        """
+        Query 9 - Find all users who have invalid activities, and the number of invalid activities per user
+        """
+        activities = self.activities
+        count = self.count_trackpoints()
+
+        gaps = np.where(consecutive_pairs(activities, count), time_gaps(self.column('epoch')), -np.inf)
+        max_gaps = per_activity(gaps, activities, np.maximum, -np.inf)
+
+        with_pairs = activities['last'] - activities['first'] >= 2
+        users = self.activity_users()
+        invalid = np.bincount(users[with_pairs], weights=max_gaps[with_pairs] > 60 * 5, minlength=len(self.store.users))
+
+        return [[str(self.store.users['id'][j]), int(invalid[j])] for j in np.unique(users[with_pairs])]
+
+    def users_tracked_activity_in_the_forbidden_city_beijing(self):
+        """
+        Query 10 - Find the users who have tracked an activity in the Forbidden City of Beijing.
+        """
+        return forbidden_city_messages(self.users_with_trackpoints_in_box(*FORBIDDEN_CITY))
+
+    def users_with_trackpoints_in_box(self, min_lat, max_lat, min_lon, max_lon):
+        """
+        Returns the ids of the users with at least one trackpoint inside the box, edges included like the database
+        """
+        return self.users_in_box(min_lat, max_lat, min_lon, max_lon)
+
+    def distinct_in_mask(self, mask, field):
+        """
+        Returns the sorted distinct values of the activity field among the trackpoints in the mask
+        """
+        return self.distinct_at(np.flatnonzero(mask), field)
+
+    def distinct_at(self, points, field):
+        """
+        Returns the sorted distinct values of the activity field among the trackpoints at the positions
+        """
+        activities = self.activities
+        with_points = np.flatnonzero(activities['last'] > activities['first'])
+
+        # The activity of a trackpoint is the last activity with trackpoints that starts at or before it
+        positions = np.searchsorted(activities['first'][with_points], points, side='right') - 1
+        return [str(value) for value in np.unique(activities[field][with_points[positions]])]
+
+    def users_in_box(self, min_lat, max_lat, min_lon, max_lon):
+        """
+        Returns the ids of the users with trackpoints inside the box
+        """
+        lat = self.column('lat')
+        lon = self.column('lon')
+        return self.distinct_in_mask((lat >= min_lat) & (lat <= max_lat) & (lon >= min_lon) & (lon <= max_lon),
+                                     'user_id')
+
+    def activities_in_box(self, min_lat, max_lat, min_lon, max_lon):
+        """
+        Returns the ids of the activities with trackpoints inside the box
+        """
+        lat = self.column('lat')
+        lon = self.column('lon')
+        return self.distinct_in_mask((lat >= min_lat) & (lat <= max_lat) & (lon >= min_lon) & (lon <= max_lon), 'id')
+
+    def near_mask(self, lat, lon, radius_km):
+        """
+        Returns a mask of the trackpoints within radius_km of the point, with the same earth radius as circle_area
+        """
+        return within_radius(self.column('lat'), self.column('lon'), lat, lon, radius_km)
+
+    def users_near(self, lat, lon, radius_km):
+        """
+        Returns the ids of the users with trackpoints within radius_km of the point
+        """
+        return self.distinct_in_mask(self.near_mask(lat, lon, radius_km), 'user_id')
+
+    def activities_near(self, lat, lon, radius_km):
+        """
+        Returns the ids of the activities with trackpoints within radius_km of the point
+        """
+        return self.distinct_in_mask(self.near_mask(lat, lon, radius_km), 'id')
+
+    def users_in_polygon(self, points):
+        """
+        Returns the ids of the users with trackpoints inside the polygon given as a list of (lat, lon) points
+        """
+        return self.distinct_in_mask(points_in_polygon(self.column('lat'), self.column('lon'), points), 'user_id')
+
+    def activities_in_polygon(self, points):
+        """
+        Returns the ids of the activities with trackpoints inside the polygon given as a list of (lat, lon) points
+        """
+        return self.distinct_in_mask(points_in_polygon(self.column('lat'), self.column('lon'), points), 'id')
+
+    def cell_index(self, resolution):
+        """
+        Returns the cells of the trackpoints at the resolution in sorted order and the positions that sort them.
+        The index is computed on first use and kept for the next lookups
+        """
+        if resolution not in self.cell_indexes:
+            cells = cell_ids(self.column('lat'), self.column('lon'), resolution)
+            order = np.argsort(cells, kind='stable')
+            self.cell_indexes[resolution] = (cells[order], order)
+        return self.cell_indexes[resolution]
+
+    def points_in_cells(self, resolution, cells):
+        """
+        Returns the positions of the trackpoints in the cells
+        """
+        sorted_cells, order = self.cell_index(resolution)
+        starts = np.searchsorted(sorted_cells, cells, side='left')
+        ends = np.searchsorted(sorted_cells, cells, side='right')
+        return np.concatenate([np.array([], dtype=np.int64)] + [order[start:end] for start, end in zip(starts, ends)])
+
+    def values_in_areas(self, areas, field):
+        """
+        Returns the sorted distinct values of the activity field among the trackpoints inside each of the areas.
+        The points in cells completely inside an area are taken as they are, only those in edge cells are checked
+        """
+        results = []
+        for area in areas:
+            resolution = lookup_resolution(area)
+            inside, edge = cover(area, resolution)
+            edge_points = self.points_in_cells(resolution, edge)
+            edge_points = edge_points[contains(area, self.column('lat')[edge_points], self.column('lon')[edge_points])]
+            results.append(self.distinct_at(np.concatenate([self.points_in_cells(resolution, inside), edge_points]),
+                                            field))
+        return results
+
+    def users_in_areas(self, areas):
+        """
+        Returns the ids of the users with trackpoints inside each of the areas, in the order of the areas
+        """
+        return self.values_in_areas(areas, 'user_id')
+
+    def activities_in_areas(self, areas):
+        """
+        Returns the ids of the activities with trackpoints inside each of the areas, in the order of the areas
+        """
+        return self.values_in_areas(areas, 'id')
+
+    def labeled_trackpoints_per_user_mode(self, user_ids=None, transportation_modes=None):
+        """
+        Returns the number of trackpoints every user recorded in each transportation mode,
+        the same rows as Repository.labeled_trackpoints_per_user_mode, from the mode column
+        """
+        codes = self.store.modes
+        if codes is None:
+            raise ValueError(f"The column store in {self.path} has no transportation modes, "
+                             "export it again with --export-column-store")
+
+        activities = self.activities
+        modes = np.array([''] + self.store.metadata["transportation_modes"], dtype=object)
+
+        # The activity of a trackpoint is the last activity with trackpoints that starts at or before it
+        labeled = np.flatnonzero(codes > 0)
+        with_points = np.flatnonzero(activities['last'] > activities['first'])
+        point_activities = with_points[np.searchsorted(activities['first'][with_points], labeled, side='right') - 1]
+
+        users, user_codes = np.unique(activities['user_id'], return_inverse=True)
+        point_users = user_codes[point_activities]
+        point_codes = codes[labeled].astype(np.int64)
+
+        selected = np.ones(len(labeled), dtype=bool)
+        if user_ids is not None:
+            selected &= np.isin(users[point_users], list(user_ids))
+        if transportation_modes is not None:
+            selected &= np.isin(modes[point_codes], list(transportation_modes))
+
+        keys, counts = np.unique(point_users[selected] * len(modes) + point_codes[selected], return_counts=True)
+        return sorted([str(users[key // len(modes)]), str(modes[key % len(modes)]), int(count)]
+                      for key, count in zip(keys.tolist(), counts.tolist()))
+
+    def most_used_transportation_mode_per_user(self):
+        """
+        Query 11 - Find all users who have registered transportation_mode and their most used transportation_mode
+        """
+        activities = self.activities
+        labeled = activities[activities['transportation_mode'] != '']
+
+        pairs, first_seen, counts = np.unique(np.stack([labeled['user_id'], labeled['transportation_mode']]), axis=1,
+                                              return_index=True, return_counts=True)
+
+        result = []
+        for user_id in np.unique(pairs[0]):
+            of_user = np.flatnonzero(pairs[0] == user_id)
+            # Like the dictionary of the database version, ties go to the mode that was seen first
+            best = of_user[np.lexsort((first_seen[of_user], -counts[of_user]))[0]]
+            result.append([str(user_id), str(pairs[1][best]), int(counts[best])])
+        return result
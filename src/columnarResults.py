@@ -0,0 +1,116 @@
+import bson
+import numpy as np
+from bson.codec_options import CodecOptions
+
+try:
+    from pyarrow import float64, int64, string, timestamp
+    from pymongoarrow.api import Schema, find_arrow_all
+except ImportError:
+    # pymongoarrow is optional, without it the columns are built from the raw BSON batches of the cursor
+    find_arrow_all = None
+
+# Column types of a schema, which maps every field of the result to one of these
+FLOAT = "float64"
+INTEGER = "int64"
+DATETIME = "datetime64[ms]"
+STRING = "object"
+
+CODEC_OPTIONS = CodecOptions(tz_aware=False)
+
+
+def value_at(document, field):
+    """
+    Returns the value of a field that may be nested, such as meta.activity_id, or None when it is missing
+    """
+    for key in field.split("."):
+        if not isinstance(document, dict):
+            return None
+        document = document.get(key)
+    return document
+
+
+def to_column(values, kind):
+    """
+    Converts a list of values to a NumPy array of the column type.
+    Values of another type, like the empty string stored for an invalid altitude, become NaN, NaT or None
+    """
+    if kind == FLOAT:
+        return np.array([value if isinstance(value, (int, float)) else np.nan for value in values], dtype=np.float64)
+    if kind == INTEGER:
+        return np.array([value if isinstance(value, int) else 0 for value in values], dtype=np.int64)
+    if kind == DATETIME:
+        return np.array(values, dtype=DATETIME)
+    return np.array(values, dtype=object)
+
+
+def empty_columns(schema):
+    return {field: np.array([], dtype=kind) for field, kind in schema.items()}
+
+
+def concatenate_columns(batches, schema):
+    """
+    Joins batches of columns into one set of columns
+    """
+    batches = list(batches)
+    if not batches:
+        return empty_columns(schema)
+    return {field: np.concatenate([batch[field] for batch in batches]) for field in schema}
+
+
+def schema_projection(schema):
+    return {'_id': False, **{field: True for field in schema}}
+
+
+def decode_batch(batch, schema):
+    """
+    Decodes a raw BSON batch of a cursor to columns keyed by the fields of the schema, or None when it is empty
+    """
+    documents = bson.decode_all(batch, CODEC_OPTIONS)
+    if not documents:
+        return None
+    return {field: to_column([value_at(document, field) for document in documents], kind)
+            for field, kind in schema.items()}
+
+
+def iter_column_batches(collection, query, schema, sort=None, batch_size=10_000):
+    """
+    Yields the result of a find as one set of columns per batch the server returns, keyed by the fields of the schema.
+    The batches arrive as raw BSON and are decoded at once in C with only the fields of the schema,
+    so no cursor documents are built one at a time
+    """
+    cursor = collection.find_raw_batches(query, schema_projection(schema), sort=sort, batch_size=batch_size)
+
+    for batch in cursor:
+        columns = decode_batch(batch, schema)
+        if columns is not None:
+            yield columns
+
+
+def arrow_type(kind):
+    return {FLOAT: float64(), INTEGER: int64(), DATETIME: timestamp("ms"), STRING: string()}[kind]
+
+
+def to_arrow_column(column, kind):
+    """
+    Converts an Arrow column to NumPy, without a copy where the type and missing values allow it
+    """
+    array = column.to_numpy()
+    if kind == DATETIME:
+        return array.astype(DATETIME)
+    if kind == STRING:
+        return array.astype(object)
+    return array
+
+
+def find_columns(collection, query, schema, sort=None, batch_size=10_000):
+    """
+    Returns the whole result of a find as columns, keyed by the fields of the schema.
+    The result is read into Arrow by pymongoarrow when it is installed, otherwise it is built from the raw BSON batches
+    """
+    # pymongoarrow reads top level fields only
+    if find_arrow_all is not None and not any("." in field for field in schema):
+        table = find_arrow_all(collection, query, schema=Schema({field: arrow_type(kind) for field, kind in schema.items()}),
+                               sort=sort, batch_size=batch_size)
+        return {field: to_arrow_column(table.column(field), kind) for field, kind in schema.items()}
+
+    return concatenate_columns(iter_column_batches(collection, query, schema, sort, batch_size), schema)
@@ -0,0 +1,129 @@
+import json
+import os
+import time
+from functools import lru_cache
+
+CATALOG_PATH = "../dataset/catalog.json"
+DATA_PATH = "../dataset/Data"
+
+# Number of header lines at the top of every plot file
+HEADER_LINES = 6
+
+
+@lru_cache(maxsize=None)
+def read_labeled_ids():
+    """
+    Reads the ids of the users with labels once
+    """
+    with open("../dataset/labeled_ids.txt", "r") as file:
+        return frozenset(file.read().split())
+
+
+def timestamp_of_line(line):
+    """
+    Returns the 'YYYY-MM-DD HH:MM:SS' timestamp of a raw plot file line
+    """
+    fields = line.decode().strip().split(",")
+    return fields[5] + " " + fields[6]
+
+
+def scan_plot_file(path, user_id):
+    """
+    Collects the metadata of a plot file without parsing it, by counting newlines
+    and only decoding the first and last trackpoint
+    """
+    stat = os.stat(path)
+    with open(path, "rb") as f:
+        data = f.read().rstrip()
+
+    lines = data.count(b"\n") + 1 if data else 0
+    rows = max(lines - HEADER_LINES, 0)
+
+    start_date_time = None
+    end_date_time = None
+    if rows:
+        # The first trackpoint starts after the header lines
+        offset = 0
+        for _ in range(HEADER_LINES):
+            offset = data.index(b"\n", offset) + 1
+        first_line = data[offset:data.find(b"\n", offset) if rows > 1 else len(data)]
+        last_line = data[data.rfind(b"\n") + 1:]
+
+        start_date_time = timestamp_of_line(first_line)
+        end_date_time = timestamp_of_line(last_line)
+
+    return {
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "user_id": user_id,
+        "rows": rows,
+        "start_date_time": start_date_time,
+        "end_date_time": end_date_time,
+        "has_labels": user_id in read_labeled_ids()
+    }
+
+
+def load_cached_catalog():
+    if not os.path.exists(CATALOG_PATH):
+        return dict()
+
+    with open(CATALOG_PATH) as f:
+        return json.load(f)
+
+
+def save_catalog(catalog):
+    # Written to a temporary file first so an interrupted run never leaves a broken cache behind
+    temporary_path = CATALOG_PATH + ".tmp"
+    with open(temporary_path, "w") as f:
+        json.dump(catalog, f)
+    os.replace(temporary_path, CATALOG_PATH)
+
+
+def load_catalog():
+    """
+    Returns the metadata of every plot file in the dataset, keyed by path.
+    Files whose size and modification time match the cached catalog are not read again,
+    so later runs only scan new or changed files
+    """
+    cached = load_cached_catalog()
+    catalog = dict()
+    scanned = 0
+
+    print(f"\n{time.strftime('%H:%M:%S')} Scanning dataset catalog...")
+
+    for user_id in sorted(os.listdir(DATA_PATH)):
+        trajectory_path = os.path.join(DATA_PATH, user_id, "Trajectory")
+        if not os.path.isdir(trajectory_path):
+            continue
+
+        for name in sorted(os.listdir(trajectory_path)):
+            path = os.path.join(trajectory_path, name)
+            stat = os.stat(path)
+
+            entry = cached.get(path)
+            if entry is None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime:
+                entry = scan_plot_file(path, user_id)
+                scanned += 1
+            else:
+                # labeled_ids.txt may have changed even though the plot file did not
+                entry["has_labels"] = user_id in read_labeled_ids()
+
+            catalog[path] = entry
+
+    if scanned or len(catalog) != len(cached):
+        save_catalog(catalog)
+
+    print(f"{time.strftime('%H:%M:%S')} Catalog has {len(catalog):,} files, {scanned:,} scanned, "
+          f"{len(catalog) - scanned:,} reused from cache")
+
+    return catalog
+
+
+def group_by_user(catalog):
+    """
+    Splits the catalog into one catalog per user, so a worker only receives the files it parses
+    """
+    catalog_by_user = dict()
+    for path, entry in catalog.items():
+        catalog_by_user.setdefault(entry["user_id"], dict())[path] = entry
+    return catalog_by_user
@@ -0,0 +1,24 @@
+import uuid
+from datetime import datetime
+
+
+def new_generation(db):
+    """
+    Stamps the database with a new generation, which every change to the data must do
+    so results cached for an older generation are never served again
+    """
+    generation = uuid.uuid4().hex
+    db.Metadata.replace_one({"_id": "generation"}, {
+        "_id": "generation",
+        "value": generation,
+        "date_time": datetime.utcnow()
+    }, upsert=True)
+    return generation
+
+
+def load_generation(db):
+    """
+    Returns the current generation of the database, or None if it was loaded before generations existed
+    """
+    document = db.Metadata.find_one({"_id": "generation"})
+    return document["value"] if document else None
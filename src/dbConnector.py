@@ -1,11 +1,87 @@
+import os
+import threading
 from pymongo import MongoClient, version
 from decouple import config
 
+# One client per process and connection settings, with the number of connectors using it
+clients = dict()
+clients_lock = threading.Lock()
+
+
+def optional_int(value):
+    return int(value) if value not in (None, "") else None
+
+
+def client_options():
+    """
+    Reads the tuning of the client from .env or the environment.
+    The settings are read when a connector is created, so changes to the environment are picked up
+    """
+    options = {
+        "maxPoolSize": config('MONGO_MAX_POOL_SIZE', default=100, cast=int),
+        "minPoolSize": config('MONGO_MIN_POOL_SIZE', default=0, cast=int),
+        "socketTimeoutMS": config('MONGO_SOCKET_TIMEOUT_MS', default=None, cast=optional_int),
+        "connectTimeoutMS": config('MONGO_CONNECT_TIMEOUT_MS', default=20_000, cast=int),
+        "serverSelectionTimeoutMS": config('MONGO_SERVER_SELECTION_TIMEOUT_MS', default=30_000, cast=int),
+        "readPreference": config('MONGO_READ_PREFERENCE', default="primary"),
+    }
+
+    # A comma separated list in order of preference, such as zstd,snappy,zlib. The server picks the first it supports,
+    # and compressors whose python module is not installed are skipped with a warning
+    compressors = config('MONGO_COMPRESSORS', default="")
+    if compressors:
+        options["compressors"] = compressors
+        options["zlibCompressionLevel"] = config('MONGO_ZLIB_COMPRESSION_LEVEL', default=-1, cast=int)
+
+    return options
+
+
+def connection_uri(HOST=None, PORT=None, DATABASE=None, USER=None, PASSWORD=None):
+    """
+    Returns the uri and database name of the connection, the settings that are not given are read from .env
+    """
+    HOST = HOST or config('MONGO_DATABASE_HOST')
+    PORT = PORT or config('MONGO_DATABASE_PORT')
+    DATABASE = DATABASE or config('MONGO_INITDB_DATABASE')
+    USER = USER or config('MONGO_USER')
+    PASSWORD = PASSWORD or config('MONGO_PASSWORD')
+
+    return "mongodb://%s:%s@%s:%s/%s" % (USER, PASSWORD, HOST, PORT, DATABASE), DATABASE
+
+
+def acquire_client(uri, options, client_class=MongoClient, scope=None):
+    """
+    Returns the client of this process for the uri and options, creating it on first use.
+    A forked worker process gets its own client, since a client can not be shared across a fork.
+    Clients of another class, or bound to a scope such as an event loop, are kept apart
+    """
+    key = (os.getpid(), client_class, scope, uri, tuple(sorted(options.items())))
+    with clients_lock:
+        if key not in clients:
+            clients[key] = [client_class(uri, **options), 0]
+        clients[key][1] += 1
+        return key, clients[key][0]
+
+
+def release_client(key):
+    """
+    Closes the client once the last connector using it is closed
+    """
+    with clients_lock:
+        entry = clients.get(key)
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] <= 0:
+            entry[0].close()
+            del clients[key]
+
 
 class DbConnector:
     """
     Connects to the MongoDB server on the Ubuntu virtual machine.
     Connector needs HOST, USER and PASSWORD to connect.
+    Connectors with the same settings share one client and its connection pool within a process.
 
     Example:
     HOST = "tdt4225-00.idi.ntnu.no" // Your server IP address/domain name
@@ -14,15 +90,16 @@ class DbConnector:
     """
 
     def __init__(self,
-                 HOST=config('MONGO_DATABASE_HOST'),
-                 PORT=config('MONGO_DATABASE_PORT'),
-                 DATABASE=config('MONGO_INITDB_DATABASE'),
-                 USER=config('MONGO_USER'),
-                 PASSWORD=config('MONGO_PASSWORD')):
-        uri = "mongodb://%s:%s@%s:%s/%s" % (USER, PASSWORD, HOST, PORT, DATABASE)
+                 HOST=None,
+                 PORT=None,
+                 DATABASE=None,
+                 USER=None,
+                 PASSWORD=None):
+        uri, DATABASE = connection_uri(HOST, PORT, DATABASE, USER, PASSWORD)
+        self.client_key = None
         # Connect to the databases
         try:
-            self.client = MongoClient(uri)
+            self.client_key, self.client = acquire_client(uri, client_options())
             self.db = self.client[DATABASE]
         except Exception as e:
             print("ERROR: Failed to connect to db:", e)
@@ -33,7 +110,8 @@ class DbConnector:
 
     def close_connection(self):
         # close the cursor
-        # close the DB connection
-        self.client.close()
+        # close the DB connection, the shared client is closed when no other connector uses it
+        release_client(self.client_key)
+        self.client_key = None
         print("\n-----------------------------------------------")
-        print("Connection to %s-db is closed" % self.db.name)
\ No newline at end of file
+        print("Connection to %s-db is closed" % self.db.name)
@@ -0,0 +1,112 @@
+import argparse
+import os
+import random
+import time
+from datetime import datetime, timedelta
+
+# Header lines at the top of every Geolife plot file
+PLOT_HEADER = ["Geolife trajectory", "WGS 84", "Altitude is in Feet", "Reserved 3",
+               "0,2,255,My Track,0,0,2,8421376", "0"]
+
+TRANSPORTATION_MODES = ["walk", "bus", "taxi", "car", "subway", "train", "bike", "airplane", "boat", "run"]
+
+# Trajectories start somewhere around Beijing, like most of the real dataset
+BEIJING = (39.9, 116.4)
+FORBIDDEN_CITY = (39.9165, 116.3975)
+
+# The plot files store the date as days since 1899-12-30 in their fifth column
+DAYS_EPOCH = datetime(1899, 12, 30)
+
+
+def plot_lines(rng, start, points):
+    """
+    Returns the rows of a plot file with the given number of points, starting at the given time.
+    The position and altitude follow a random walk, with a few missing altitudes and long time gaps
+    """
+    if rng.random() < 0.05:
+        lat, lon = FORBIDDEN_CITY
+    else:
+        lat = BEIJING[0] + rng.uniform(-0.3, 0.3)
+        lon = BEIJING[1] + rng.uniform(-0.3, 0.3)
+    altitude = rng.uniform(0, 300)
+    date_time = start
+
+    lines = []
+    for _ in range(points):
+        days = (date_time - DAYS_EPOCH).total_seconds() / 86400
+        shown_altitude = -777 if rng.random() < 0.02 else round(altitude)
+        lines.append(f"{lat:.6f},{lon:.6f},0,{shown_altitude},{days:.10f},"
+                     f"{date_time:%Y-%m-%d},{date_time:%H:%M:%S}")
+
+        lat += rng.gauss(0, 0.0002)
+        lon += rng.gauss(0, 0.0002)
+        altitude = max(0.0, altitude + rng.gauss(0, 3))
+        # Mostly a point every few seconds, sometimes a gap long enough to make the activity invalid
+        date_time += timedelta(seconds=rng.choice([1, 2, 5, 5, 10]) if rng.random() > 0.001 else 600)
+
+    return lines, date_time
+
+
+def generate_user(root, user_id, files, points, seed, labeled):
+    """
+    Writes the plot files of one user, and a labels file covering some of them when the user is labeled.
+    Every user has its own random generator, so the output does not depend on the order users are written in
+    """
+    rng = random.Random(f"{seed}-{user_id}")
+    trajectory_path = os.path.join(root, "Data", user_id, "Trajectory")
+    os.makedirs(trajectory_path, exist_ok=True)
+
+    labels = []
+    start = datetime(2007, 4, 1) + timedelta(days=rng.randint(0, 365), seconds=rng.randint(0, 86399))
+    for _ in range(files):
+        lines, end = plot_lines(rng, start, rng.randint(max(1, points // 2), max(1, points * 3 // 2)))
+        with open(os.path.join(trajectory_path, f"{start:%Y%m%d%H%M%S}.plt"), "w") as file:
+            file.write("\n".join(PLOT_HEADER + lines) + "\n")
+
+        if labeled and rng.random() < 0.6:
+            labels.append(f"{start:%Y/%m/%d %H:%M:%S}\t{end:%Y/%m/%d %H:%M:%S}\t{rng.choice(TRANSPORTATION_MODES)}")
+
+        start = end + timedelta(hours=rng.randint(1, 72))
+
+    if labeled:
+        with open(os.path.join(root, "Data", user_id, "labels.txt"), "w") as file:
+            file.write("\n".join(["Start Time\tEnd Time\tTransportation Mode"] + labels) + "\n")
+
+    return files
+
+
+def generate_dataset(root="../dataset", users=182, files=100, points=1000, labeled_share=0.4, seed=0):
+    """
+    Writes a synthetic dataset shaped like Geolife to root: Data/<user>/Trajectory/*.plt, labels.txt for the labeled
+    users and labeled_ids.txt. The same arguments always produce the same dataset.
+    The number of points of each file is drawn between half and one and a half times the given points
+    """
+    print(f"\n{time.strftime('%H:%M:%S')} Generating {users} users with {files} files each in {root}...")
+
+    rng = random.Random(seed)
+    user_ids = [f"{user:03d}" for user in range(users)]
+    labeled_ids = sorted(rng.sample(user_ids, round(users * labeled_share)))
+    labeled = set(labeled_ids)
+
+    for i, user_id in enumerate(user_ids):
+        generate_user(root, user_id, files, points, seed, user_id in labeled)
+        if (i + 1) % 10 == 0 or i + 1 == users:
+            print(f"{time.strftime('%H:%M:%S')} Generated {i + 1} of {users} users")
+
+    with open(os.path.join(root, "labeled_ids.txt"), "w") as file:
+        file.write("\n".join(labeled_ids) + "\n")
+
+    return user_ids
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", "--output", default="../benchmark/dataset", help="Folder the dataset is written to")
+    parser.add_argument("-u", "--users", type=int, default=182, help="Number of users")
+    parser.add_argument("-f", "--files", type=int, default=100, help="Number of plot files per user")
+    parser.add_argument("-p", "--points", type=int, default=1000, help="Average number of points per plot file")
+    parser.add_argument("--labeled", type=float, default=0.4, help="Share of the users that have labels")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the random generator")
+    args = parser.parse_args()
+
+    generate_dataset(args.output, args.users, args.files, args.points, args.labeled, args.seed)
@@ -0,0 +1,115 @@
+import time
+from pymongo import ASCENDING, GEOSPHERE, IndexModel
+from dbConnector import DbConnector
+from spatialGrid import RESOLUTIONS, cell_field
+from trackpointLayouts import BUCKET, DOCUMENT, TIMESERIES, TRACKPOINT_COLLECTIONS, bucket_cell_field, load_layout
+
+# Only the trackpoints a label covers store a transportation mode, the other trackpoints are left out of its index
+LABELED = {"transportation_mode": {"$exists": True}}
+
+# The secondary indexes of every collection, together with the queries they serve.
+# They are built after the bulk load, since maintaining them while inserting slows the load down
+INDEXES = {
+    "User": [
+        # Upserts in incremental updates
+        IndexModel([("id", ASCENDING)]),
+    ],
+    "Activity": [
+        # Upserts in incremental updates
+        IndexModel([("id", ASCENDING)]),
+        # Queries 2, 3 and the per-user cleanup in incremental updates
+        IndexModel([("user_id", ASCENDING)]),
+        # Queries 4, 5, 7 and 11
+        IndexModel([("transportation_mode", ASCENDING), ("user_id", ASCENDING)]),
+        # Query 6
+        IndexModel([("start_date_time", ASCENDING)]),
+    ],
+}
+
+TRACKPOINT_INDEXES = {
+    DOCUMENT: [
+        # Upserts in incremental updates
+        IndexModel([("id", ASCENDING)]),
+        # Queries 7, 8 and 9 read the trackpoints of an activity in time order
+        IndexModel([("activity_id", ASCENDING), ("date_time", ASCENDING)]),
+        # Per-user queries and cleanup
+        IndexModel([("user_id", ASCENDING)]),
+        # Query 10 matches on a latitude and longitude range
+        IndexModel([("lat", ASCENDING), ("lon", ASCENDING)]),
+        # The spatial queries match on the location
+        IndexModel([("location", GEOSPHERE)]),
+        # Batch area lookups read the users and activities of the cells from the index alone
+        *[IndexModel([(cell_field(resolution), ASCENDING), ("user_id", ASCENDING), ("activity_id", ASCENDING)])
+          for resolution in RESOLUTIONS],
+        # Mode based queries match the labeled trackpoints directly
+        IndexModel([("transportation_mode", ASCENDING), ("user_id", ASCENDING)], partialFilterExpression=LABELED),
+    ],
+    BUCKET: [
+        # Query 7 reads the buckets of a list of activities
+        IndexModel([("activity_id", ASCENDING)]),
+        IndexModel([("user_id", ASCENDING)]),
+        # Query 10 first matches on the bounding box of the buckets
+        IndexModel([("min_lat", ASCENDING), ("max_lat", ASCENDING), ("min_lon", ASCENDING), ("max_lon", ASCENDING)]),
+        # The spatial queries match on the points of the buckets
+        IndexModel([("locations", GEOSPHERE)]),
+        # Batch area lookups match on the cells of the buckets
+        *[IndexModel([(bucket_cell_field(resolution), ASCENDING)]) for resolution in RESOLUTIONS],
+        # Mode based queries match the buckets with points in the modes
+        IndexModel([("transportation_mode", ASCENDING)], partialFilterExpression=LABELED),
+    ],
+    TIMESERIES: [
+        # Queries 7, 8 and 9 read the trackpoints of an activity in time order
+        IndexModel([("meta.activity_id", ASCENDING), ("date_time", ASCENDING)]),
+        IndexModel([("meta.user_id", ASCENDING)]),
+        # Query 10 matches on a latitude and longitude range
+        IndexModel([("lat", ASCENDING), ("lon", ASCENDING)]),
+        # The spatial queries match on the location
+        IndexModel([("location", GEOSPHERE)]),
+        # Batch area lookups match on the cells of the trackpoints
+        *[IndexModel([(cell_field(resolution), ASCENDING), ("meta.user_id", ASCENDING), ("meta.activity_id", ASCENDING)])
+          for resolution in RESOLUTIONS],
+        # Mode based queries match the labeled trackpoints directly
+        IndexModel([("transportation_mode", ASCENDING), ("meta.user_id", ASCENDING)], partialFilterExpression=LABELED),
+    ],
+}
+
+
+def declared_indexes(layout):
+    """
+    Returns the indexes of every collection used by the layout, keyed by collection name
+    """
+    return INDEXES | {TRACKPOINT_COLLECTIONS[layout]: TRACKPOINT_INDEXES[layout]}
+
+
+def drop_indexes(db, layout):
+    """
+    Drops the secondary indexes before a bulk load, so the inserts do not have to maintain them
+    """
+    for collection in declared_indexes(layout):
+        db[collection].drop_indexes()
+
+
+def build_indexes(db, layout):
+    """
+    Builds the declared indexes of the layout that do not exist yet and reports the build time and index sizes
+    """
+    print(f"\n{time.strftime('%H:%M:%S')} Building indexes...")
+
+    for collection, indexes in declared_indexes(layout).items():
+        start = time.perf_counter()
+        db[collection].create_indexes(indexes)
+        elapsed = time.perf_counter() - start
+
+        index_sizes = db.command("collStats", collection)["indexSizes"]
+        print("{:<18} built in {:6.2f} s".format(collection, elapsed))
+        for name, size in index_sizes.items():
+            print("    {:<30} {:10,.1f} MB".format(name, size / 1024 ** 2))
+
+
+def build_all_indexes():
+    """
+    Builds the indexes of an already loaded database
+    """
+    connection = DbConnector()
+    build_indexes(connection.db, load_layout(connection.db))
+    connection.close_connection()
@@ -1,6 +1,17 @@
+import sys
 import time
+from pymongo.write_concern import WriteConcern
+from bulkWriter import BulkWriter
 from dbConnector import DbConnector
-from readFiles import open_all_files
+from datasetGeneration import new_generation
+from datasetCatalog import load_catalog
+from readFiles import open_all_files, open_all_files_parallel, iter_file_documents
+from indexManager import build_indexes, drop_indexes
+from trackpointLayouts import DOCUMENT, TRACKPOINT_COLLECTIONS, prepare_trackpoint_collections, save_layout, to_layout
+from updateData import CHECKPOINTS, record_checkpoints
+from pipelineMetrics import METRICS
+from simplification import (SIMPLIFIED_COLLECTION, finish_simplified_collection, prepare_simplified_collection,
+                            simplify_trackpoints)
 
 
 def clear_db(db):
@@ -17,10 +28,40 @@ def clear_db(db):
     print(f"\n{time.strftime('%H:%M:%S')} Clearing existing users from database...\n")
     db.User.delete_many({})
 
+    db[CHECKPOINTS].delete_many({})
+    prepare_simplified_collection(db)
 
-def insert_data():
+
+def peak_memory_mb():
+    """
+    Returns the peak resident memory of the process in megabytes, or None where it is not available
+    """
+    try:
+        import resource
+    except ImportError:
+        # The resource module does not exist on Windows
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrss is given in bytes on macOS and in kilobytes on Linux
+    if sys.platform == 'darwin':
+        return peak / 1024 ** 2
+    return peak / 1024
+
+
+def print_peak_memory():
+    peak = peak_memory_mb()
+    if peak is not None:
+        print("Peak memory usage: {:,.1f} MB".format(peak))
+
+
+def insert_data(workers=1, writer_threads=4, write_concern=WriteConcern(w=1), layout=DOCUMENT, simplification=None):
     """
-    Insert data into the database
+    Insert data into the database.
+    With more than one worker the files are parsed on a pool of worker processes.
+    The layout decides how the trackpoints are stored, see trackpointLayouts.
+    A simplification, given as (method, tolerance), also stores the simplified trackpoints, see simplification
     """
     
     connection = DbConnector()
@@ -28,45 +69,121 @@ def insert_data():
 
     # Starts with clearing the database
     clear_db(db)
+    # Cached query results are invalid as soon as the old data is removed
+    new_generation(db)
+    prepare_trackpoint_collections(db, layout)
+    drop_indexes(db, layout)
+
+    # The catalog lets the parsing skip oversized files without reading them
+    with METRICS.phase("walk"):
+        catalog = load_catalog()
 
     # Opens all files and returns a dictionary with all the data
-    users_list, activities_list, trackpoints_list = open_all_files()
+    if workers > 1:
+        users_list, activities_list, trackpoints_list = open_all_files_parallel(workers, catalog)
+    else:
+        users_list, activities_list, trackpoints_list = open_all_files(catalog)
 
     # insert data into database
-    print(f"\n{time.strftime('%H:%M:%S')} inserting {len(users_list)} users...")
-    db.User.insert_many(users_list)
-
-    print(f"\n{time.strftime('%H:%M:%S')} inserted {len(users_list)} users")
-
-    print(f"\n{time.strftime('%H:%M:%S')} inserting {len(activities_list)} activities...")
-    db.Activity.insert_many(activities_list)
-    print(f"\n{time.strftime('%H:%M:%S')} inserted {len(activities_list)} activities")
-
-    # Iterates through all trackpoints and inserts them into the database in batches of 1000
-    counter = 0
-    increment = 1000
-    for i in range(0, int(len(trackpoints_list) / increment)):
-        counter += increment
-        print("{} Inserting trackpoints {:7.2f} % {:9,} / {:9,}".format(
-            time.strftime("%H:%M:%S"),
-            round(i / (len(trackpoints_list) / increment) * 100, 2),
-            counter,
-            len(trackpoints_list)
-        ))
-        
-        db.TrackPoint.insert_many(trackpoints_list[counter:counter + increment])
-
-    # We need to insert the rest of the trackpoints if the number of trackpoints is not divisible by 1000
-    print("{} Inserting trackpoints {:7.2f} % {:9,} / {:9,}".format(
-        time.strftime("%H:%M:%S"),
-        100.00,
-        len(trackpoints_list),
-        len(trackpoints_list)
-    )
-    )
-    db.TrackPoint.insert_many(trackpoints_list[:len(trackpoints_list) % increment])
+    print(f"\n{time.strftime('%H:%M:%S')} inserting {len(users_list)} users, "
+          f"{len(activities_list)} activities and {len(trackpoints_list):,} trackpoints...")
+
+    # The lower fidelity tier is simplified per plot file from the same documents
+    if simplification:
+        with METRICS.phase("simplify"):
+            simplified = simplify_trackpoints(trackpoints_list, *simplification)
+
+    with METRICS.phase("insert"):
+        writer = BulkWriter(db, threads=writer_threads, write_concern=write_concern)
+        with writer:
+            writer.insert('User', users_list)
+            writer.insert('Activity', activities_list)
+            writer.insert(TRACKPOINT_COLLECTIONS[layout], to_layout(layout, trackpoints_list))
+            if simplification:
+                writer.insert(SIMPLIFIED_COLLECTION, simplified)
+
+    writer.report()
+    writer.verify()
+    save_layout(db, layout)
+    new_generation(db)
+
+    # The indexes are built once all data is inserted
+    with METRICS.phase("index"):
+        build_indexes(db, layout)
+        if simplification:
+            finish_simplified_collection(db, *simplification)
+
+    # Later runs with --update only load what changed since this load
+    record_checkpoints(db, catalog)
+
+    # Close database connection after all data is inserted
+    connection.close_connection()
+
+    print("\nInserted {:,} trackpoints".format(len(trackpoints_list)))
+    print_peak_memory()
+
+
+def insert_data_streaming(max_batch_bytes=4 * 1024 * 1024, max_queued_batches=8, workers=1,
+                          writer_threads=4, write_concern=WriteConcern(w=1), layout=DOCUMENT, simplification=None):
+    """
+    Insert data into the database while the files are parsed.
+    Documents are grouped into batches of at most max_batch_bytes per collection and handed to the writer threads
+    through a bounded queue, so memory stays flat regardless of the size of the dataset
+    """
+
+    connection = DbConnector()
+    db = connection.db
+
+    # Starts with clearing the database
+    clear_db(db)
+    # Cached query results are invalid as soon as the old data is removed
+    new_generation(db)
+    prepare_trackpoint_collections(db, layout)
+    drop_indexes(db, layout)
+
+    with METRICS.phase("walk"):
+        catalog = load_catalog()
+
+    trackpoint_collection = TRACKPOINT_COLLECTIONS[layout]
+    trackpoint_count = 0
+
+    writer = BulkWriter(db, threads=writer_threads, max_queued_batches=max_queued_batches,
+                        write_concern=write_concern, max_batch_bytes=max_batch_bytes)
+    with writer:
+        for users, activities, trackpoints in iter_file_documents(workers, catalog):
+            # Blocks while the writers are behind, which keeps the number of documents in memory bounded
+            with METRICS.phase("insert"):
+                writer.insert('User', users)
+                writer.insert('Activity', activities)
+                writer.insert(trackpoint_collection, to_layout(layout, trackpoints))
+            if simplification:
+                with METRICS.phase("simplify"):
+                    simplified = simplify_trackpoints(trackpoints, *simplification)
+                with METRICS.phase("insert"):
+                    writer.insert(SIMPLIFIED_COLLECTION, simplified)
+            trackpoint_count += len(trackpoints)
+
+        # Waits for the writers to write the batches still queued
+        with METRICS.phase("insert"):
+            writer.close()
+
+    writer.report()
+    writer.verify()
+    save_layout(db, layout)
+    new_generation(db)
+
+    # The indexes are built once all data is inserted
+    with METRICS.phase("index"):
+        build_indexes(db, layout)
+        if simplification:
+            finish_simplified_collection(db, *simplification)
+
+    # Later runs with --update only load what changed since this load
+    record_checkpoints(db, catalog)
 
     # Close database connection after all data is inserted
     connection.close_connection()
 
-    print("\nInserted {:,} trackpoints".format(len(trackpoints_list)))
\ No newline at end of file
+    print("\nInserted {:,} users, {:,} activities and {:,} trackpoints".format(
+        writer.counts.get('User', 0), writer.counts.get('Activity', 0), trackpoint_count))
+    print_peak_memory()
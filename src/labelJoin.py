@@ -0,0 +1,63 @@
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+
+# The labels of one user sorted by start, with the times in seconds since the epoch.
+# reach is the latest end among the labels up to each one and reach_label the label it belongs to,
+# so a point after the end of the label just before it is still found in an earlier, longer label
+LabelIntervals = namedtuple("LabelIntervals", ["starts", "ends", "modes", "reach", "reach_label"])
+
+
+def to_seconds(series):
+    """
+    Parses a column of label date strings to seconds since the epoch
+    """
+    return (pd.to_datetime(series, format="%Y/%m/%d %H:%M:%S").to_numpy()
+            .astype("datetime64[us]").astype(np.int64) / 1_000_000)
+
+
+def build_label_intervals(df):
+    """
+    Sorts the labels of a labels file by start for the join with the trackpoints of the user,
+    or returns None when the file has no labels
+    """
+    if df.empty:
+        return None
+
+    starts = to_seconds(df["start_date_time"])
+    ends = to_seconds(df["end_date_time"])
+
+    # A stable sort keeps labels with the same start in file order, so the later one is found first like in the activities
+    order = np.argsort(starts, kind="stable")
+    starts = starts[order]
+    ends = ends[order]
+    modes = np.array(df["transportation_mode"].tolist(), dtype=object)[order]
+
+    reach = np.maximum.accumulate(ends)
+    reach_label = np.maximum.accumulate(np.where(ends == reach, np.arange(len(ends)), 0))
+    return LabelIntervals(starts, ends, modes, reach, reach_label)
+
+
+def label_modes(intervals, epoch):
+    """
+    Returns the transportation mode of the label covering each point, or '' for points no label covers.
+    The latest label starting at or before every point is found by a binary search on the sorted starts,
+    so joining n points with m labels costs O(n log m) instead of the O(n m) of a nested scan.
+    A point takes the mode of that label when it ends at or after the point, and otherwise the mode of the
+    earlier label that reaches farthest, if that one still covers the point
+    """
+    epoch = np.asarray(epoch, dtype=np.float64)
+    modes = np.full(len(epoch), "", dtype=object)
+    if intervals is None or len(epoch) == 0:
+        return modes
+
+    latest = np.searchsorted(intervals.starts, epoch, side="right") - 1
+    started = latest >= 0
+    latest = np.maximum(latest, 0)
+
+    covered = started & (epoch <= intervals.ends[latest])
+    reached = started & ~covered & (epoch <= intervals.reach[latest])
+
+    modes[covered] = intervals.modes[latest[covered]]
+    modes[reached] = intervals.modes[intervals.reach_label[latest[reached]]]
+    return modes
@@ -0,0 +1,474 @@
+import math
+import numpy as np
+from dbConnector import DbConnector
+from columnarResults import DATETIME, FLOAT, INTEGER, STRING, find_columns, iter_column_batches
+from repository import (MODE_SCHEMA, TRACKPOINT_SCHEMA, Repository, box_query, cell_value_pairs, cell_values_pipeline,
+                        combine_matches, group_activity_trackpoints, labeled_selection, location_area_query,
+                        match_stage, mode_count_pairs, trackpoint_modes_pipeline, trackpoint_query)
+from spatialGrid import cell_field, cell_ids
+from trackpointLayouts import BUCKET, TIMESERIES, TRACKPOINT_COLLECTIONS, bucket_cell_field, load_layout
+from trajectory import (ARRAY_FIELDS, columns_to_activity_arrays, iter_batches_to_activity_arrays, to_activity_arrays,
+                        to_epoch_seconds, within_period)
+
+# The user and activity of the time series layout are read from the metadata field
+SERIES_SCHEMA = {('meta.' + field if field in ('user_id', 'activity_id') else field): kind
+                 for field, kind in TRACKPOINT_SCHEMA.items()}
+SERIES_MODE_SCHEMA = {('meta.' + field if field == 'activity_id' else field): kind
+                      for field, kind in MODE_SCHEMA.items()}
+
+
+def circle_polygon(area, vertices=64):
+    """
+    Approximates a $centerSphere circle by a GeoJSON polygon with the given number of vertices
+    """
+    (lon, lat), radius = area['$centerSphere']
+    lat_radians = math.radians(lat)
+    lon_radians = math.radians(lon)
+
+    ring = []
+    for i in range(vertices):
+        bearing = 2 * math.pi * i / vertices
+        # The destination point at the given angular distance and bearing from the center
+        point_lat = math.asin(math.sin(lat_radians) * math.cos(radius)
+                              + math.cos(lat_radians) * math.sin(radius) * math.cos(bearing))
+        point_lon = lon_radians + math.atan2(math.sin(bearing) * math.sin(radius) * math.cos(lat_radians),
+                                             math.cos(radius) - math.sin(lat_radians) * math.sin(point_lat))
+        ring.append([math.degrees(point_lon), math.degrees(point_lat)])
+    ring.append(ring[0])
+
+    return {
+        'type': 'Polygon',
+        'coordinates': [ring]
+    }
+
+
+def bucket_count_pipeline():
+    return [
+        {
+            '$group': {
+                '_id': None,
+                'count': {
+                    '$sum': '$count'
+                }
+            }
+        }
+    ]
+
+
+def bucket_projection(fields):
+    return {
+        '_id': False,
+        'user_id': True,
+        'activity_id': True,
+        **{field: True for field in fields}
+    }
+
+
+def bucket_batch_size(batch_size):
+    # A bucket holds up to 2500 trackpoints, so far fewer buckets fit in a batch
+    return max(batch_size // 1000, 1)
+
+
+def bucket_period_query(activity_ids=None, start=None, end=None, match=None):
+    """
+    Returns the query of the buckets with points from start up to end that also match.
+    The time span of the buckets skips those outside the period
+    """
+    span = dict()
+    if start is not None:
+        span['end_date_time'] = {'$gte': start}
+    if end is not None:
+        span['start_date_time'] = {'$lt': end}
+    return combine_matches(match, span, {'activity_id': {'$in': activity_ids}} if activity_ids is not None else None)
+
+
+def epoch_bounds(start=None, end=None):
+    lower = to_epoch_seconds([start])[0] if start is not None else -np.inf
+    upper = to_epoch_seconds([end])[0] if end is not None else np.inf
+    return lower, upper
+
+
+def bucket_activity_arrays(bucket, lower=-np.inf, upper=np.inf):
+    """
+    Converts a bucket to the ActivityArrays of its points from lower up to upper in seconds since the epoch
+    """
+    return within_period(to_activity_arrays(bucket['user_id'], bucket['activity_id'], bucket), lower, upper)
+
+
+def bucket_pairs_stages(field):
+    """
+    Returns the stages that turn every bucket into its pairs of consecutive trackpoints.
+    The arrays of a bucket are sorted by time at ingest, see to_buckets, so zipping an array with itself shifted by one
+    gives every pair of consecutive trackpoints
+    """
+    return [
+        {
+            '$project': {
+                '_id': False,
+                'user_id': True,
+                'activity_id': True,
+                'pair': {
+                    '$zip': {
+                        'inputs': [
+                            '$' + field,
+                            {'$slice': ['$' + field, 1, {'$max': [{'$size': '$' + field}, 1]}]}
+                        ]
+                    }
+                }
+            }
+        },
+        {
+            '$unwind': '$pair'
+        },
+        {
+            '$project': {
+                'user_id': True,
+                'activity_id': True,
+                'value': {'$arrayElemAt': ['$pair', 0]},
+                'next_value': {'$arrayElemAt': ['$pair', 1]}
+            }
+        }
+    ]
+
+
+def bucket_area_query(area, match=None):
+    """
+    Returns the query of the buckets with any of their points inside the area. $geoIntersects only accepts
+    GeoJSON geometries, so circles are approximated by a polygon
+    """
+    return {
+        'locations': {
+            '$geoIntersects': {
+                '$geometry': area['$geometry'] if '$geometry' in area else circle_polygon(area)
+            }
+        },
+        **(match or dict())
+    }
+
+
+def bucket_box_pipeline(box, field, match=None):
+    """
+    Returns the pipeline of the distinct values of the field among the buckets with any point inside the box,
+    edges included like box_query. The bounding boxes of the buckets skip those that can not have such a point
+    """
+    min_lat, max_lat, min_lon, max_lon = box
+    return [
+        {
+            '$match': {
+                'min_lat': {'$lte': max_lat},
+                'max_lat': {'$gte': min_lat},
+                'min_lon': {'$lte': max_lon},
+                'max_lon': {'$gte': min_lon},
+                **(match or dict())
+            }
+        },
+        {
+            '$match': {
+                '$expr': {
+                    '$gt': [{
+                        '$size': {
+                            '$filter': {
+                                'input': {'$range': [0, {'$size': '$lat'}]},
+                                'as': 'index',
+                                'cond': {
+                                    '$and': [
+                                        {'$gte': [{'$arrayElemAt': ['$lat', '$$index']}, min_lat]},
+                                        {'$lte': [{'$arrayElemAt': ['$lat', '$$index']}, max_lat]},
+                                        {'$gte': [{'$arrayElemAt': ['$lon', '$$index']}, min_lon]},
+                                        {'$lte': [{'$arrayElemAt': ['$lon', '$$index']}, max_lon]}
+                                    ]
+                                }
+                            }
+                        }
+                    }, 0]
+                }
+            }
+        },
+        {
+            '$group': {
+                '_id': '$' + field
+            }
+        }
+    ]
+
+
+def bucket_cell_values_pipeline(resolution, cells, field, match=None):
+    """
+    Returns the pipeline of the distinct (cell, value) pairs of the field among the buckets in the cells.
+    A bucket stores the distinct cells of its trackpoints, so it is found in every cell it shares with the lookup
+    """
+    return [
+        {
+            '$match': {
+                bucket_cell_field(resolution): {
+                    '$in': cells
+                },
+                **(match or dict())
+            }
+        },
+        {
+            '$project': {
+                '_id': False,
+                'value': '$' + field,
+                'cell': '$' + bucket_cell_field(resolution)
+            }
+        },
+        {
+            '$unwind': '$cell'
+        },
+        {
+            '$match': {
+                'cell': {
+                    '$in': cells
+                }
+            }
+        },
+        {
+            '$group': {
+                '_id': {
+                    'cell': '$cell',
+                    'value': '$value'
+                }
+            }
+        }
+    ]
+
+
+def bucket_cell_points(buckets, resolution, cells, field):
+    """
+    Returns the cells, coordinates and values of the field of the points of the buckets that are in the cells,
+    with the cells of the points computed from the arrays of the buckets
+    """
+    point_cells, lat, lon, values = [np.array([], dtype=np.int64)], [np.array([])], [np.array([])], []
+    for bucket in buckets:
+        bucket_lat = np.array(bucket['lat'], dtype=np.float64)
+        bucket_lon = np.array(bucket['lon'], dtype=np.float64)
+        point_cells.append(cell_ids(bucket_lat, bucket_lon, resolution))
+        lat.append(bucket_lat)
+        lon.append(bucket_lon)
+        values += [bucket[field]] * len(bucket_lat)
+
+    point_cells = np.concatenate(point_cells)
+    wanted = np.isin(point_cells, cells)
+    return (point_cells[wanted], np.concatenate(lat)[wanted], np.concatenate(lon)[wanted],
+            np.array(values, dtype=object)[wanted])
+
+
+def bucket_trackpoint_modes_pipeline(match, transportation_modes=None):
+    """
+    Returns the pipeline counting the points of the matching buckets per user and transportation mode.
+    A bucket matches when any of its points is in the modes, the mode of every point is in its array
+    """
+    return [
+        {
+            '$match': match
+        },
+        {
+            '$project': {
+                '_id': False,
+                'user_id': True,
+                'transportation_mode': True
+            }
+        },
+        {
+            '$unwind': '$transportation_mode'
+        },
+        {
+            '$match': {
+                'transportation_mode': {
+                    '$in': list(transportation_modes)
+                } if transportation_modes is not None else {
+                    '$ne': ''
+                }
+            }
+        },
+        {
+            '$group': {
+                '_id': {
+                    'user_id': '$user_id',
+                    'transportation_mode': '$transportation_mode'
+                },
+                'count': {
+                    '$sum': 1
+                }
+            }
+        }
+    ]
+
+
+def bucket_mode_columns(bucket):
+    """
+    Returns the activity_id, date_time and transportation_mode columns of the labeled points of a bucket
+    """
+    modes = np.array(bucket['transportation_mode'], dtype=object)
+    labeled = modes != ''
+    return {
+        'activity_id': np.full(int(labeled.sum()), bucket['activity_id'], dtype=object),
+        'date_time': np.array(bucket['date_time'], dtype=DATETIME)[labeled],
+        'transportation_mode': modes[labeled]
+    }
+
+
+def from_series_columns(columns):
+    """
+    Renames the metadata columns of the time series layout to the columns of the other layouts
+    """
+    return {field.replace('meta.', ''): values for field, values in columns.items()}
+
+
+class BucketRepository(Repository):
+    """
+    Queries a database where the trackpoints are stored as one bucket document per activity
+    """
+
+    def __init__(self, connection=None, partitions=1):
+        super().__init__(connection, partitions)
+        self.buckets = self.db[TRACKPOINT_COLLECTIONS[BUCKET]]
+
+    def count_trackpoints(self):
+        res = list(self.buckets.aggregate(bucket_count_pipeline()))
+
+        return res[0]['count'] if res else 0
+
+    def iter_activity_trackpoints(self, fields, activity_ids=None, batch_size=10_000):
+        query = {} if activity_ids is None else {'activity_id': {'$in': activity_ids}}
+
+        res = self.buckets.find(query, bucket_projection(fields)).sort('activity_id', 1) \
+            .batch_size(bucket_batch_size(batch_size))
+
+        # Every bucket already holds the columns of one activity
+        for bucket in res:
+            yield bucket['user_id'], bucket['activity_id'], {field: bucket[field] for field in fields}
+
+    def iter_activity_arrays(self, activity_ids=None, batch_size=10_000, start=None, end=None, match=None):
+        # A bucket already is the arrays of one activity, it is converted as a whole
+        if start is None and end is None and match is None:
+            for user_id, activity_id, columns in self.iter_activity_trackpoints(ARRAY_FIELDS, activity_ids, batch_size):
+                yield to_activity_arrays(user_id, activity_id, columns)
+            return
+
+        # The buckets outside the period are skipped, the points of the others are cut to it
+        res = self.buckets.find(bucket_period_query(activity_ids, start, end, match) or {},
+                                bucket_projection(ARRAY_FIELDS)).sort('activity_id', 1) \
+            .batch_size(bucket_batch_size(batch_size))
+
+        lower, upper = epoch_bounds(start, end)
+        for bucket in res:
+            yield bucket_activity_arrays(bucket, lower, upper)
+
+    def aggregate_consecutive_trackpoints(self, field, stages, match=None):
+        return self.buckets.aggregate(match_stage(match) + bucket_pairs_stages(field) + stages, allowDiskUse=True)
+
+    def distinct_in_partition(self, area, field, match=None):
+        # A bucket matches when any of its points is inside the area
+        return self.buckets.distinct(field, bucket_area_query(area, match))
+
+    def distinct_in_box(self, box, field, match=None):
+        return [row['_id'] for row in self.buckets.aggregate(bucket_box_pipeline(box, field, match))]
+
+    def values_in_cells(self, resolution, cells, field, match=None):
+        return cell_value_pairs(self.buckets.aggregate(bucket_cell_values_pipeline(resolution, cells, field, match)))
+
+    def points_in_cells(self, resolution, cells, field, match=None):
+        # The cells of the points are computed from the arrays of the buckets that share a cell with the lookup
+        res = self.buckets.find({bucket_cell_field(resolution): {'$in': cells}, **(match or dict())}, {
+            '_id': False,
+            'lat': True,
+            'lon': True,
+            field: True
+        })
+
+        return bucket_cell_points(res, resolution, cells, field)
+
+    def count_trackpoint_modes(self, match, transportation_modes=None):
+        return mode_count_pairs(self.buckets.aggregate(bucket_trackpoint_modes_pipeline(match, transportation_modes)))
+
+    def iter_trackpoint_modes(self, batch_size=10_000):
+        res = self.buckets.find(labeled_selection('user_id'), bucket_projection(['date_time', 'transportation_mode'])) \
+            .batch_size(bucket_batch_size(batch_size))
+
+        for bucket in res:
+            yield bucket_mode_columns(bucket)
+
+
+class TimeSeriesRepository(Repository):
+    """
+    Queries a database where the trackpoints are stored in a time series collection
+    with the user and activity as metadata
+    """
+
+    # The user and activity are stored in the metadata field
+    user_field = 'meta.user_id'
+    activity_field = 'meta.activity_id'
+
+    def __init__(self, connection=None, partitions=1):
+        super().__init__(connection, partitions)
+        self.series = self.db[TRACKPOINT_COLLECTIONS[TIMESERIES]]
+
+    def count_trackpoints(self):
+        return self.series.count_documents({})
+
+    def iter_activity_trackpoints(self, fields, activity_ids=None, batch_size=10_000):
+        query = {} if activity_ids is None else {'meta.activity_id': {'$in': activity_ids}}
+
+        # Time series collections have no meaningful natural order, so the points are sorted explicitly
+        res = self.series.find(query, {
+            '_id': False,
+            'meta': True,
+            **{field: True for field in fields}
+        }).sort([('meta.activity_id', 1), ('date_time', 1)]).batch_size(batch_size)
+
+        return group_activity_trackpoints(res, fields, lambda x: x['meta']['user_id'],
+                                          lambda x: x['meta']['activity_id'])
+
+    def iter_activity_arrays(self, activity_ids=None, batch_size=10_000, start=None, end=None, match=None):
+        sort = [('meta.activity_id', 1), ('date_time', 1)]
+        query = trackpoint_query(start, end, match)
+
+        if activity_ids is not None:
+            columns = find_columns(self.series, combine_matches(query, {'meta.activity_id': {'$in': activity_ids}}),
+                                   SERIES_SCHEMA, sort, batch_size)
+            return columns_to_activity_arrays(from_series_columns(columns))
+
+        batches = iter_column_batches(self.series, query or {}, SERIES_SCHEMA, sort, batch_size)
+        return iter_batches_to_activity_arrays(from_series_columns(columns) for columns in batches)
+
+    def aggregate_consecutive_trackpoints(self, field, stages, match=None):
+        return self.series.aggregate(match_stage(match) + self.consecutive_trackpoints_pipeline(field) + stages,
+                                     allowDiskUse=True)
+
+    def distinct_in_partition(self, area, field, match=None):
+        return self.series.distinct('meta.' + field, location_area_query(area, match))
+
+    def distinct_in_box(self, box, field, match=None):
+        return self.series.distinct('meta.' + field, box_query(*box, match))
+
+    def values_in_cells(self, resolution, cells, field, match=None):
+        return cell_value_pairs(self.series.aggregate(cell_values_pipeline(resolution, cells, 'meta.' + field, match)))
+
+    def points_in_cells(self, resolution, cells, field, match=None):
+        schema = {cell_field(resolution): INTEGER, 'lat': FLOAT, 'lon': FLOAT, 'meta.' + field: STRING}
+        columns = find_columns(self.series, {cell_field(resolution): {'$in': cells}, **(match or dict())}, schema)
+        return columns[cell_field(resolution)], columns['lat'], columns['lon'], columns['meta.' + field]
+
+    def count_trackpoint_modes(self, match, transportation_modes=None):
+        return mode_count_pairs(self.series.aggregate(trackpoint_modes_pipeline(match, 'meta.user_id')))
+
+    def iter_trackpoint_modes(self, batch_size=10_000):
+        batches = iter_column_batches(self.series, labeled_selection(self.user_field), SERIES_MODE_SCHEMA,
+                                      batch_size=batch_size)
+        return (from_series_columns(columns) for columns in batches)
+
+
+def create_repository(partitions=1):
+    """
+    Returns a repository for the trackpoint layout the database was loaded with
+    """
+    connection = DbConnector()
+    layout = load_layout(connection.db)
+
+    if layout == BUCKET:
+        return BucketRepository(connection, partitions)
+    if layout == TIMESERIES:
+        return TimeSeriesRepository(connection, partitions)
+    return Repository(connection, partitions)
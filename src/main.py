@@ -1,25 +1,48 @@
 import argparse
 import time
-from datetime import datetime
-from insertData import insert_data
-from repository import Repository
+from datetime import timedelta
+from pymongo.write_concern import WriteConcern
+from insertData import insert_data, insert_data_streaming
+from updateData import insert_data_incremental
+from activitySummaries import recompute_summaries
+from indexManager import build_all_indexes
+from layoutRepository import create_repository
+from queryCache import CachedRepository
+from columnStore import ColumnStoreRepository, export_column_store
+from runQueries import run_queries
+from trackpointLayouts import DOCUMENT, LAYOUTS
+from pipelineMetrics import METRICS, enable_command_monitoring
+from simplification import parse_simplification, simplification_report
 import os
-from tabulate import tabulate
     
 
-def init_db():
+def init_db(stream=False, workers=1, update=False, writer_threads=4, write_concern=WriteConcern(w=1),
+            layout=DOCUMENT, simplification=None):
     """
     Initialize the database
     """
-    # Format the current time
+    # The wall clock is only shown, the duration is measured with a monotonic clock
     FMT = '%H:%M:%S'
     start_datetime = time.strftime(FMT)
-    insert_data()
+    with METRICS.phase("total"):
+        if update:
+            insert_data_incremental()
+        elif stream:
+            insert_data_streaming(workers=workers, writer_threads=writer_threads, write_concern=write_concern,
+                                  layout=layout, simplification=simplification)
+        else:
+            insert_data(workers, writer_threads, write_concern, layout, simplification)
     end_datetime = time.strftime(FMT)
-    # Calculate the time difference
-    total_datetime = datetime.strptime(end_datetime, FMT) - datetime.strptime(start_datetime, FMT)
+    total_datetime = timedelta(seconds=round(METRICS.durations["total"], 3))
     print(f"Started: {start_datetime}\nFinished: {end_datetime}\nTotal: {total_datetime}")
 
+def parse_write_concern(value) -> WriteConcern:
+    """
+    Parses the write concern given on the command line, either a number of nodes or a tag such as 'majority'
+    """
+    return WriteConcern(w=int(value) if value.isdigit() else value)
+
+
 def dataset_is_present() -> bool:
     if os.path.exists("../dataset"):
         return True
@@ -27,75 +50,102 @@ def dataset_is_present() -> bool:
         return False
 
 
-def main(should_init_db=False):
-
-    if should_init_db:
-        # Testing if dataset is in the correct folder
-        if dataset_is_present():
-            init_db()
-        else:
-            print("Dataset not found. Add 'dataset' to the root of the project folder")
-            return
-
-    query = Repository()
-
-    table_format = 'github' # Table format for tabulate
-
-    print("\n-------- Query 1 ----------")
-    value = query.sum_user_activity_trackpoint()
-    print(value)
+def main(should_init_db=False, stream=False, workers=1, update=False, writer_threads=4,
+         write_concern=WriteConcern(w=1), layout=DOCUMENT, only_build_indexes=False, only_summaries=False,
+         use_cache=True, refresh_cache=False, query_threads=1, metrics_path=None, only_export_column_store=False,
+         use_column_store=False, partitions=1, simplification=None, only_simplification_report=False):
 
-    print("\n-------- Query 2 ----------")
-    value = query.average_number_of_activities_per_user()
-    print(value)
+    # The listener only sees the clients created after it is registered
+    if metrics_path:
+        enable_command_monitoring()
 
-    print("\n-------- Query 3 ----------\n")
-    headers = ['nr.','user id', 'activities']
-    print(tabulate(query.top_twenty_users(), headers=headers, tablefmt=table_format))
+    if only_build_indexes:
+        build_all_indexes()
+        return
 
-    print("\n-------- Query 4 ----------")
-    headers = ['user id']
-    print("Users who have taken a taxi\n") 
-    print(tabulate(query.users_taken_taxi(), headers=headers, tablefmt=table_format))
+    if only_summaries:
+        recompute_summaries()
+        return
 
-    print("\n-------- Query 5 ----------\n")
-    headers = ['mode', 'count']
-    print(tabulate(query.activity_transport_mode_count(), headers=headers, tablefmt=table_format))
+    if only_export_column_store:
+        export_column_store()
+        return
 
-    print("\n-------- Query 6 ----------")
-    headers = ['year', 'hours']
-    print(tabulate(query.year_with_most_activities(), headers=headers, tablefmt=table_format))
+    if only_simplification_report:
+        simplification_report(*(simplification or ()))
+        return
 
-    print("\n-------- Query 7 ----------")
-    value = query.total_distance_in_km_walked_in_2008_by_userid_112()
-    print("The total distance walked in 2008 by user 112 is {:.2f} km".format(value))
-
-    print("\n-------- Query 8 ----------")
-    print("This one takes a while...\n")
-    headers = ['nr.', 'user id', 'altitude']
-    print(tabulate(query.top_20_users_gained_most_altitude_meters(), headers=headers, tablefmt=table_format))
+    if should_init_db or update:
+        # Testing if dataset is in the correct folder
+        if dataset_is_present():
+            init_db(stream, workers, update, writer_threads, write_concern, layout, simplification)
+        else:
+            print("Dataset not found. Add 'dataset' to the root of the project folder")
+            return
 
-    print("\n-------- Query 9 ----------")
-    print("This one takes a while...\n")
-    headers = ['user_id', 'invalid_activities']
-    print(tabulate(query.invalid_activities_per_user(), headers=headers, tablefmt=table_format))
+    if use_column_store:
+        # The exported column store answers the queries without the database, no cache is needed
+        query = ColumnStoreRepository()
+    else:
+        # The repository matches the trackpoint layout the database was loaded with
+        query = create_repository(partitions)
 
-    print("\n-------- Query 10 ----------")
-    values = query.users_tracked_activity_in_the_forbidden_city_beijing()
-    print(''.join(values))
+        # Results are served from the cache as long as the data has not changed since they were computed
+        if use_cache:
+            query = CachedRepository(query, refresh=refresh_cache)
 
-    print("\n-------- Query 11 ----------\n")
-    headers = ['user id', 'transportation mode', 'count']
-    print(tabulate(query.most_used_transportation_mode_per_user(), headers=headers, tablefmt=table_format))
+    run_queries(query, query_threads)
 
     # Close the connection after all queries are executed
     query.connection.close_connection()
 
+    if metrics_path:
+        METRICS.print_report()
+        METRICS.write(metrics_path)
+
 
 if __name__ == "__main__":
     # Enables flag to initialize database
     parser = argparse.ArgumentParser()
     parser.add_argument("-i", "--init_database", action="store_true", help="Initialize the database")
+    parser.add_argument("-s", "--stream", action="store_true",
+                        help="Insert the data in bounded batches while the files are parsed")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="Number of worker processes used to parse the dataset")
+    parser.add_argument("-u", "--update", action="store_true",
+                        help="Only load the files that were added, changed or removed since the last ingest")
+    parser.add_argument("--writers", type=int, default=4,
+                        help="Number of threads writing to the database during the initial load")
+    parser.add_argument("--write-concern", type=parse_write_concern, default=WriteConcern(w=1),
+                        help="Write concern of the initial load, e.g. 0, 1 or majority")
+    parser.add_argument("--layout", choices=LAYOUTS, default=DOCUMENT,
+                        help="How the trackpoints are stored: one document per trackpoint, "
+                             "one bucket per activity or a time series collection")
+    parser.add_argument("--build-indexes", action="store_true",
+                        help="Only build the indexes of an already loaded database")
+    parser.add_argument("--summaries", action="store_true",
+                        help="Only recompute the activity summaries from the stored trackpoints")
+    parser.add_argument("--no-cache", action="store_true", help="Run the queries without the result cache")
+    parser.add_argument("--refresh", action="store_true", help="Run the queries again and replace their cached results")
+    parser.add_argument("-q", "--query-threads", type=int, default=1,
+                        help="Number of threads running the queries concurrently, results are printed in order")
+    parser.add_argument("--metrics", metavar="PATH",
+                        help="Write the ingest and query metrics to PATH, as Prometheus text when it ends with .prom "
+                             "and as JSON otherwise")
+    parser.add_argument("--export-column-store", action="store_true",
+                        help="Only export the trackpoints of the database to memory-mapped column files")
+    parser.add_argument("--column-store", action="store_true",
+                        help="Run the queries on the exported column files instead of the database")
+    parser.add_argument("-p", "--partitions", type=int, default=1,
+                        help="Number of user id ranges the heavy trackpoint queries are split into and run concurrently")
+    parser.add_argument("--simplify", type=parse_simplification, metavar="METHOD:TOLERANCE",
+                        help="Also store simplified trackpoints in TrackPointSimplified during the initial load, "
+                             "dp:METERS for Douglas-Peucker or time:SECONDS for time downsampling")
+    parser.add_argument("--simplification-report", action="store_true",
+                        help="Only compare the answers of queries 7, 8 and 9 on simplified and full trackpoints")
     args = parser.parse_args()
 
-    main(args.init_database)
\ No newline at end of file
+    main(args.init_database, args.stream, args.workers, args.update, args.writers, args.write_concern,
+         args.layout, args.build_indexes, args.summaries, not args.no_cache, args.refresh, args.query_threads,
+         args.metrics, args.export_column_store, args.column_store,
+         args.partitions, args.simplify, args.simplification_report)
\ No newline at end of file
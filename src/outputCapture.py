@@ -0,0 +1,50 @@
+import io
+import sys
+import threading
+from contextlib import contextmanager
+
+
+class ThreadLocalStdout:
+    """
+    Stands in for sys.stdout and sends what a thread prints to the buffer the thread is capturing into,
+    or to the real stdout when it is not capturing
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def buffers(self):
+        if not hasattr(self.local, "buffers"):
+            self.local.buffers = []
+        return self.local.buffers
+
+    def write(self, text):
+        buffers = self.buffers()
+        if buffers:
+            return buffers[-1].write(text)
+        return self.stream.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+@contextmanager
+def capture_output():
+    """
+    Captures what the current thread prints into the yielded StringIO, while other threads keep printing normally.
+    Unlike contextlib.redirect_stdout it is safe to use from several threads at once
+    """
+    if not isinstance(sys.stdout, ThreadLocalStdout):
+        sys.stdout = ThreadLocalStdout(sys.stdout)
+
+    buffers = sys.stdout.buffers()
+    output = io.StringIO()
+    buffers.append(output)
+    try:
+        yield output
+    finally:
+        buffers.pop()
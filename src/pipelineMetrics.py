@@ -0,0 +1,224 @@
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pymongo import monitoring
+from tabulate import tabulate
+
+# Phases of the ingest in the order they run
+PHASES = ["walk", "parse", "build", "simplify", "insert", "index"]
+
+
+class PipelineMetrics:
+    """
+    Collects the durations of the pipeline phases, measured with a monotonic clock, and counters of the work done.
+    Durations of the same phase add up, so phases that run on several worker processes report their summed time
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.durations = defaultdict(float)
+            self.counters = defaultdict(int)
+            self.latencies = dict()
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Adds the time spent inside the block to the duration of the phase
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_duration(name, time.perf_counter() - start)
+
+    def add_duration(self, name, seconds):
+        with self.lock:
+            self.durations[name] += seconds
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def record_query(self, name, seconds):
+        with self.lock:
+            self.latencies[name] = seconds
+
+    def merge(self, other):
+        """
+        Adds the durations and counters of a dictionary made by to_dict, such as the metrics of a worker process
+        """
+        with self.lock:
+            for name, seconds in other["durations"].items():
+                self.durations[name] += seconds
+            for name, value in other["counters"].items():
+                self.counters[name] += value
+
+    def rates(self):
+        """
+        Returns the throughput of the ingest over its total wall time
+        """
+        total = self.durations.get("total")
+        if not total:
+            return dict()
+        return {
+            "files_per_second": self.counters.get("files", 0) / total,
+            "points_per_second": self.counters.get("trackpoints", 0) / total,
+            "megabytes_per_second": self.counters.get("bytes", 0) / 1024 ** 2 / total
+        }
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "durations": dict(self.durations),
+                "counters": dict(self.counters),
+                "rates": self.rates(),
+                "queries": dict(self.latencies),
+                "commands": COMMANDS.to_dict()
+            }
+
+    def print_report(self):
+        print("\n-------- Metrics ----------\n")
+        names = [name for name in PHASES if name in self.durations]
+        names += [name for name in self.durations if name not in names]
+        rows = [[name, round(self.durations[name], 3)] for name in names]
+        print(tabulate(rows, headers=['phase', 'seconds'], tablefmt='github'))
+
+        rows = [[name, value] for name, value in self.counters.items()]
+        rows += [[name, round(value, 1)] for name, value in self.rates().items()]
+        if rows:
+            print()
+            print(tabulate(rows, headers=['measurement', 'value'], tablefmt='github'))
+
+        COMMANDS.print_report()
+
+    def write_json(self, path):
+        with open(path, "w") as file:
+            json.dump(self.to_dict(), file, indent=2)
+
+    def write_prometheus(self, path):
+        """
+        Writes the metrics in the Prometheus text format, for the node exporter textfile collector
+        """
+        metrics = self.to_dict()
+        lines = ["# TYPE geolife_phase_seconds gauge"]
+        lines += [f'geolife_phase_seconds{{phase="{name}"}} {value}' for name, value in metrics["durations"].items()]
+        lines.append("# TYPE geolife_processed_total counter")
+        lines += [f'geolife_processed_total{{item="{name}"}} {value}' for name, value in metrics["counters"].items()]
+        lines.append("# TYPE geolife_rate gauge")
+        lines += [f'geolife_rate{{rate="{name}"}} {value}' for name, value in metrics["rates"].items()]
+        lines.append("# TYPE geolife_query_seconds gauge")
+        lines += [f'geolife_query_seconds{{query="{name}"}} {value}' for name, value in metrics["queries"].items()]
+        lines.append("# TYPE geolife_command_total counter")
+        lines.append("# TYPE geolife_command_seconds_total counter")
+        lines.append("# TYPE geolife_command_failures_total counter")
+        for command in metrics["commands"]:
+            labels = 'label="{}",command="{}"'.format(command["label"], command["command"])
+            lines.append(f'geolife_command_total{{{labels}}} {command["count"]}')
+            lines.append(f'geolife_command_seconds_total{{{labels}}} {command["seconds"]}')
+            lines.append(f'geolife_command_failures_total{{{labels}}} {command["failures"]}')
+
+        with open(path, "w") as file:
+            file.write("\n".join(lines) + "\n")
+
+    def write(self, path):
+        """
+        Writes the metrics as Prometheus text when the path ends with .prom, otherwise as JSON
+        """
+        if path.endswith(".prom"):
+            self.write_prometheus(path)
+        else:
+            self.write_json(path)
+        print(f"\n{time.strftime('%H:%M:%S')} Metrics written to {path}")
+
+
+class CommandMetrics(monitoring.CommandListener):
+    """
+    Counts the server round trips of every command and their latency, grouped by the label the calling thread set.
+    Commands run on the thread that issued them, so a label set around a query covers all of its round trips.
+    Work a query hands to other threads carries the label along with carry_label
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.commands = dict()
+        self.registered = False
+
+    @contextmanager
+    def label(self, name):
+        previous = getattr(self.local, "label", None)
+        self.local.label = name
+        try:
+            yield
+        finally:
+            self.local.label = previous
+
+    def carry_label(self, function):
+        """
+        Returns the function wrapped to run under the label of the calling thread, for work submitted to a thread pool
+        """
+        label = getattr(self.local, "label", None)
+
+        def labeled(*args, **kwargs):
+            with self.label(label):
+                return function(*args, **kwargs)
+
+        return labeled
+
+    def entry(self, command_name):
+        key = (getattr(self.local, "label", None) or "other", command_name)
+        if key not in self.commands:
+            self.commands[key] = {"count": 0, "seconds": 0.0, "max_seconds": 0.0, "failures": 0}
+        return self.commands[key]
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        seconds = event.duration_micros / 1_000_000
+        with self.lock:
+            entry = self.entry(event.command_name)
+            entry["count"] += 1
+            entry["seconds"] += seconds
+            entry["max_seconds"] = max(entry["max_seconds"], seconds)
+
+    def failed(self, event):
+        with self.lock:
+            entry = self.entry(event.command_name)
+            entry["count"] += 1
+            entry["seconds"] += event.duration_micros / 1_000_000
+            entry["failures"] += 1
+
+    def to_dict(self):
+        with self.lock:
+            return [{"label": label, "command": command} | entry
+                    for (label, command), entry in sorted(self.commands.items())]
+
+    def print_report(self):
+        commands = self.to_dict()
+        if not commands:
+            return
+        print()
+        rows = [[c["label"], c["command"], c["count"], round(c["seconds"], 3), round(c["max_seconds"], 3), c["failures"]]
+                for c in commands]
+        print(tabulate(rows, headers=['label', 'command', 'round trips', 'seconds', 'max seconds', 'failures'],
+                       tablefmt='github'))
+
+
+METRICS = PipelineMetrics()
+COMMANDS = CommandMetrics()
+
+
+def enable_command_monitoring():
+    """
+    Registers the command listener, it only sees the clients created after it is registered
+    """
+    if not COMMANDS.registered:
+        monitoring.register(COMMANDS)
+        COMMANDS.registered = True
@@ -0,0 +1,161 @@
+import hashlib
+import os
+import pickle
+import threading
+from datasetGeneration import load_generation
+from outputCapture import capture_output
+
+CACHE_PATH = "../.query_cache"
+
+
+def source_version(directory=os.path.dirname(os.path.abspath(__file__))):
+    """
+    Returns a hash of the source files of the scripts. It is part of every cache key, so a result computed
+    by an earlier version of a query is never served once its code, or code it depends on, has changed
+    """
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(".py"):
+            with open(os.path.join(directory, name), "rb") as f:
+                digest.update(name.encode() + b"\0" + f.read())
+    return digest.hexdigest()
+
+
+SOURCE_VERSION = source_version()
+
+# The repository methods whose results are cached, every other attribute is passed through
+QUERY_METHODS = frozenset([
+    "sum_user_activity_trackpoint",
+    "average_number_of_activities_per_user",
+    "top_twenty_users",
+    "users_taken_taxi",
+    "activity_transport_mode_count",
+    "year_with_most_activities",
+    "total_distance_in_km_walked_in_2008_by_userid_112",
+    "distance_per_user_mode_year",
+    "top_20_users_gained_most_altitude_meters",
+    "invalid_activities_per_user",
+    "users_tracked_activity_in_the_forbidden_city_beijing",
+    "labeled_trackpoints_per_user_mode",
+    "most_used_transportation_mode_per_user",
+    "users_in_box",
+    "users_near",
+    "users_in_polygon",
+    "activities_in_box",
+    "activities_near",
+    "activities_in_polygon",
+])
+
+
+class QueryCache:
+    """
+    On-disk cache of query results keyed by method, arguments, the dataset generation and the source version.
+    Ingest stamps a new generation and the source version follows the code, so a result is never served after
+    the data or the queries changed.
+    The least recently used results are evicted when the cache grows larger than max_bytes
+    """
+
+    def __init__(self, path=CACHE_PATH, max_bytes=64 * 1024 ** 2):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+
+    def file_path(self, key):
+        return os.path.join(self.path, key + ".pickle")
+
+    def get(self, key):
+        """
+        Returns the cached entry of the key, or None if there is none
+        """
+        file_path = self.file_path(key)
+        try:
+            with open(file_path, "rb") as f:
+                entry = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+        # Marks the entry as recently used for the eviction, unless another thread evicted it meanwhile
+        try:
+            os.utime(file_path)
+        except FileNotFoundError:
+            pass
+        return entry
+
+    def put(self, key, entry):
+        file_path = self.file_path(key)
+        # Every writer has its own temporary file, since threads may store the same key at once
+        temporary_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary_path, "wb") as f:
+            pickle.dump(entry, f)
+        os.replace(temporary_path, file_path)
+
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits in max_bytes.
+        Other threads write, replace and evict entries at the same time, so files may vanish while it runs
+        """
+        entries = []
+        for name in os.listdir(self.path):
+            # Temporary files are still being written and are renamed or removed by their writer
+            if name.endswith(".tmp"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+class CachedRepository:
+    """
+    Wraps a repository and serves its query results from a QueryCache.
+    With refresh the queries are run again and their cached results replaced.
+
+    Example:
+    query = CachedRepository(create_repository())
+    query.top_twenty_users()
+    """
+
+    def __init__(self, repository, cache=None, refresh=False):
+        self.repository = repository
+        self.cache = cache or QueryCache()
+        self.refresh = refresh
+
+    def __getattr__(self, name):
+        attribute = getattr(self.repository, name)
+        if name not in QUERY_METHODS:
+            return attribute
+
+        def cached_query(*args, **kwargs):
+            # The generation is read on every call, so a long running process notices a new ingest
+            generation = load_generation(self.repository.db)
+            if generation is None:
+                return attribute(*args, **kwargs)
+
+            key = hashlib.sha256(repr((type(self.repository).__name__, name, args, sorted(kwargs.items()),
+                                       generation, SOURCE_VERSION)).encode()).hexdigest()
+
+            entry = None if self.refresh else self.cache.get(key)
+            if entry is None:
+                # Some queries print part of their answer, which is stored and printed again on a cache hit
+                with capture_output() as output:
+                    result = attribute(*args, **kwargs)
+                entry = {"result": result, "output": output.getvalue()}
+                self.cache.put(key, entry)
+
+            print(entry["output"], end="")
+            return entry["result"]
+
+        return cached_query
@@ -1,19 +1,33 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 import os
 import pandas as pd
 import time
+from datasetCatalog import read_labeled_ids, group_by_user
+from trajectory import summarize_trackpoints, to_epoch_seconds
+from labelJoin import build_label_intervals, label_modes
+from spatialGrid import CELL_FIELDS, RESOLUTIONS, cell_ids
+from pipelineMetrics import METRICS
+
+# Plot files with more rows than this are not inserted
+MAX_PLOT_ROWS = 2500
 
 
 def id_has_label(id):
     """
     Checks if the user has a label
     """
-    file = open("../dataset/labeled_ids.txt", "r")
-    labeled_ids_list = file.read().split()
-    return id in labeled_ids_list
+    return id in read_labeled_ids()
 
 
-def read_plot_file(path):
+def read_plot_file(path, entry=None):
+    """
+    Reads a plot file into a dataframe.
+    When the catalog entry of the file is given, oversized files are skipped without being read
+    """
+    if entry is not None and entry["rows"] > MAX_PLOT_ROWS:
+        return pd.DataFrame()
 
     # Reads the file
     with open(path) as f:
@@ -23,7 +37,7 @@ def read_plot_file(path):
         df = df.drop(columns=['_0', '_1'])
 
         # Dropping files containing more than 2500 rows
-        if len(df.index) > 2500:
+        if len(df.index) > MAX_PLOT_ROWS:
             # Empty dataframe
             return pd.DataFrame()
 
@@ -31,6 +45,17 @@ def read_plot_file(path):
         return df
 
 
+def read_plot_file_measured(path, entry=None):
+    """
+    Reads a plot file like read_plot_file and records the time, the file and its bytes in the pipeline metrics
+    """
+    with METRICS.phase("parse"):
+        df = read_plot_file(path, entry)
+    METRICS.count("files")
+    METRICS.count("bytes", entry["size"] if entry is not None else os.path.getsize(path))
+    return df
+
+
 def read_labels_file(path):
     # Reads the labled file
     with open(path) as f:
@@ -39,10 +64,149 @@ def read_labels_file(path):
         return df
 
 
-def open_all_files():
+def to_datetimes(series, format):
+    """
+    Parses a column of date strings at once and returns them as a list of python datetimes
+    """
+    return pd.to_datetime(series, format=format).to_numpy().astype("datetime64[us]").tolist()
+
+
+def build_label_activities(user_id, df):
+    """
+    Creates the activities described by a labels file, keyed by activity id
+    """
+    if df.empty:
+        return dict()
+
+    # The activity id is the user id followed by the start date and time without separators
+    start_parts = df["start_date_time"].str.split(" ")
+    activity_ids = (user_id + "_"
+                    + start_parts.str[0].str.replace("/", "", regex=False)
+                    + start_parts.str[1].str.replace(":", "", regex=False))
+
+    activities = zip(
+        df["transportation_mode"].tolist(),
+        to_datetimes(df["start_date_time"], "%Y/%m/%d %H:%M:%S"),
+        to_datetimes(df["end_date_time"], "%Y/%m/%d %H:%M:%S")
+    )
+
+    # Giving activity table values, later labels with the same start overwrite earlier ones
+    return {
+        activity_id: {
+            "user_id": user_id,
+            "transportation_mode": transportation_mode,
+            "start_date_time": start_date_time,
+            "end_date_time": end_date_time
+        }
+        for activity_id, (transportation_mode, start_date_time, end_date_time) in zip(activity_ids.tolist(), activities)
+    }
+
+
+def build_plot_activity(user_id, df, entry=None):
+    """
+    Creates an unlabeled activity spanning the first and last trackpoint of a plot file.
+    The start and end are taken directly from the catalog entry when it is given
+    """
+    if entry is not None:
+        start_date_time = datetime.strptime(entry["start_date_time"], "%Y-%m-%d %H:%M:%S")
+        end_date_time = datetime.strptime(entry["end_date_time"], "%Y-%m-%d %H:%M:%S")
+    else:
+        start_date_time, end_date_time = to_datetimes(
+            df["date"].iloc[[0, -1]] + " " + df["date_time"].iloc[[0, -1]], "%Y-%m-%d %H:%M:%S")
+
+    return {
+        "user_id": user_id,
+        "transportation_mode": "",
+        "start_date_time": start_date_time,
+        "end_date_time": end_date_time
+    }
+
+
+def location_point(lat, lon):
+    """
+    Returns the GeoJSON point of a coordinate, GeoJSON puts the longitude first
+    """
+    return {"type": "Point", "coordinates": [lon, lat]}
+
+
+def build_trackpoints(user_id, activity_id, df, labels=None):
+    """
+    Creates the trackpoints of a plot file, keyed by trackpoint id.
+    All columns are built on the whole dataframe at once before they are zipped into documents.
+    When the label intervals of the user are given, every trackpoint a label covers gets its transportation mode
+    """
+    if df.empty:
+        return dict()
+
+    dates = df["date"]
+    times = df["date_time"]
+
+    trackpoint_ids = (activity_id + "_"
+                      + dates.str.replace("/", "", regex=False)
+                      + times.str.replace(":", "", regex=False))
+
+    # Altitudes of -777 are invalid and stored as empty strings
+    altitudes = df["altitude"].astype(object).where(df["altitude"] != -777, "")
+
+    # Points outside the valid coordinate range can not be stored in a 2dsphere index and get no location
+    valid_locations = df["lat"].between(-90, 90) & df["long"].between(-180, 180)
+
+    # The grid cell of every point at each resolution, for the batch area lookups
+    cells = zip(*[cell_ids(df["lat"].to_numpy(), df["long"].to_numpy(), resolution).tolist()
+                  for resolution in RESOLUTIONS])
+
+    date_times = to_datetimes(dates + " " + times, "%Y-%m-%d %H:%M:%S")
+
+    # The mode of the label covering every point, '' for the points outside all labels
+    modes = label_modes(labels, to_epoch_seconds(date_times)).tolist() if labels is not None else [""] * len(df)
+
+    columns = zip(
+        df["lat"].tolist(),
+        df["long"].tolist(),
+        altitudes.tolist(),
+        dates.str.replace("-", "", regex=False).tolist(),
+        date_times,
+        valid_locations.tolist(),
+        cells,
+        modes
+    )
+
+    # Duplicated timestamps give the same id, the last trackpoint overwrites the earlier ones
+    trackpoints = {
+        trackpoint_id: {
+            "activity_id": activity_id,
+            "user_id": user_id,
+            "lat": lat,
+            "lon": lon,
+            "altitude": altitude,
+            "date_days": date_days,
+            "date_time": date_time,
+            "location": location_point(lat, lon) if valid_location else None,
+            **dict(zip(CELL_FIELDS, point_cells)),
+            # Only labeled points store a mode, which keeps the mode index small
+            **({"transportation_mode": mode} if mode else {})
+        }
+        for trackpoint_id, (lat, lon, altitude, date_days, date_time, valid_location, point_cells, mode)
+        in zip(trackpoint_ids.tolist(), columns)
+    }
+
+    # Rows with the same timestamp share one trackpoint, so each id is cleaned up once
+    for trackpoint_id in dict.fromkeys(trackpoint_ids[~valid_locations].tolist()):
+        if trackpoints[trackpoint_id]["location"] is None:
+            del trackpoints[trackpoint_id]["location"]
+            for field in CELL_FIELDS:
+                del trackpoints[trackpoint_id][field]
+
+    return trackpoints
+
+
+def open_all_files(catalog=None):
     users = dict()
+    catalog = catalog or dict()
     activities = dict()
     trackpoints = dict()
+    # The label intervals of every user, the labels file is walked before the Trajectory folder of the user
+    labels = dict()
 
     number_of_files = 18_738
 
@@ -82,61 +246,37 @@ def open_all_files():
 
             # if we are reading labels file
             if name == "labels.txt":
-                df = read_labels_file(file_path)
+                with METRICS.phase("parse"):
+                    df = read_labels_file(file_path)
+                with METRICS.phase("build"):
+                    activities.update(build_label_activities(user_id, df))
+                    labels[user_id] = build_label_intervals(df)
 
-                # iterates over all rows and adds the label to the activity
-                for _, row in df.iterrows():
-                    stripped_start_date = row["start_date_time"].split(" ")[0].replace("/", "")
-                    stripped_start_time = row["start_date_time"].split(" ")[1].replace(":", "")
+            # else we are reading plot file
+            else:
+                activity_id = user_id + "_" + name.split(".")[0]
 
-                    activity_id = user_id + "_" + stripped_start_date + stripped_start_time
+                entry = catalog.get(file_path)
+                df = read_plot_file_measured(file_path, entry)
 
-                    formatted_start_date = row["start_date_time"].replace("/", "-")
-                    formatted_end_date = row["end_date_time"].replace("/", "-")
+                with METRICS.phase("build"):
+                    # if the activity does not exist we need to create it
+                    # it may have been created from the labels file
+                    if not activity_id in activities and not df.empty:
+                        activities[activity_id] = build_plot_activity(user_id, df, entry)
 
-                    # Giving activity table values
-                    activities[activity_id] = {
-                        "user_id": user_id,
-                        "transportation_mode": row["transportation_mode"],
-                        "start_date_time": datetime.strptime(str(formatted_start_date), "%Y-%m-%d %H:%M:%S"),
-                        "end_date_time": datetime.strptime(str(formatted_end_date), "%Y-%m-%d %H:%M:%S")
-                    }
+                    file_trackpoints = build_trackpoints(user_id, activity_id, df, labels.get(user_id))
+                    trackpoints.update(file_trackpoints)
 
-            # else we are reading plot file
-            else:
-                activity_id = user_id + "_" + name.split(".")[0]
+                    # The activity is summarized from the trackpoints of its plot file
+                    if activity_id in activities:
+                        activities[activity_id].update(summarize_trackpoints(list(file_trackpoints.values())))
+                METRICS.count("trackpoints", len(file_trackpoints))
 
-                df = read_plot_file(file_path)
-
-                # if the activity does not exist we need to create it
-                # it may have been created from the labels file
-                if not activity_id in activities and not df.empty:
-                    start_date_time = df.iloc[0]["date"] + " " + df.iloc[0]["date_time"]
-                    end_date_time = df.iloc[-1]["date"] + " " + df.iloc[-1]["date_time"]
-
-                    activities[activity_id] = {
-                        "user_id": user_id,
-                        "transportation_mode": "",
-                        "start_date_time": datetime.strptime(str(start_date_time), "%Y-%m-%d %H:%M:%S"),
-                        "end_date_time": datetime.strptime(str(end_date_time), "%Y-%m-%d %H:%M:%S")
-                    }
-
-                # iterates all rows (trackpoints) in the dataframe/plot file
-                for _, row in df.iterrows():
-                    stripped_start_date = row["date"].replace("/", "")
-                    stripped_start_time = row["date_time"].replace(":", "")
-
-                    trackpoint_id = activity_id + "_" + stripped_start_date + stripped_start_time
-
-                    trackpoints[trackpoint_id] = {
-                        "activity_id": activity_id,
-                        "user_id": user_id,
-                        "lat": row["lat"],
-                        "lon": row["long"],
-                        "altitude": "" if row["altitude"] == -777 else row["altitude"],
-                        "date_days": row["date"].replace("-", ""),
-                        "date_time": datetime.strptime(str(row["date"] + " " + row["date_time"]), "%Y-%m-%d %H:%M:%S")
-                    }
+    # Labeled activities without a plot file have no trackpoints to summarize
+    for activity in activities.values():
+        if "point_count" not in activity:
+            activity.update(summarize_trackpoints([]))
 
     # prepare data for insertion, flatten the dictionaries into lists
     users_list = [{ 'id': k, 'has_labels': v } for k, v in users.items()]
@@ -144,4 +284,153 @@ def open_all_files():
     trackpoints_list = [{'id': k} | v for k, v in trackpoints.items()]
 
 
-    return users_list, activities_list, trackpoints_list
\ No newline at end of file
+    return users_list, activities_list, trackpoints_list
+
+
+def list_user_ids():
+    """
+    Returns the ids of all users in the dataset, sorted so the insertion order is deterministic
+    """
+    data_path = "../dataset/Data"
+    return sorted(name for name in os.listdir(data_path) if os.path.isdir(os.path.join(data_path, name)))
+
+
+def read_user_files(user_id, catalog=None):
+    """
+    Parses the labels and plot files of a single user.
+    Yields tuples of (users, activities, trackpoints) lists, one for each plot file
+    """
+    catalog = catalog or dict()
+    user_path = os.path.join("../dataset/Data", user_id)
+
+    yield [{'id': user_id, 'has_labels': id_has_label(user_id)}], [], []
+
+    # The labels are read first so they override the activities created from the plot files
+    label_activities = dict()
+    labels = None
+    labels_path = os.path.join(user_path, "labels.txt")
+    if os.path.exists(labels_path):
+        with METRICS.phase("parse"):
+            df = read_labels_file(labels_path)
+        with METRICS.phase("build"):
+            label_activities = build_label_activities(user_id, df)
+            labels = build_label_intervals(df)
+
+    trajectory_path = os.path.join(user_path, "Trajectory")
+    for name in sorted(os.listdir(trajectory_path)):
+        activity_id = user_id + "_" + name.split(".")[0]
+
+        file_path = os.path.join(trajectory_path, name)
+        entry = catalog.get(file_path)
+        df = read_plot_file_measured(file_path, entry)
+
+        with METRICS.phase("build"):
+            activities = dict()
+            if activity_id in label_activities:
+                activities[activity_id] = label_activities.pop(activity_id)
+            elif not df.empty:
+                activities[activity_id] = build_plot_activity(user_id, df, entry)
+
+            trackpoints = build_trackpoints(user_id, activity_id, df, labels)
+
+            # The activity is summarized from the trackpoints of its plot file
+            for activity in activities.values():
+                activity.update(summarize_trackpoints(list(trackpoints.values())))
+        METRICS.count("trackpoints", len(trackpoints))
+
+        yield [], [{'id': k} | v for k, v in activities.items()], [{'id': k} | v for k, v in trackpoints.items()]
+
+    # Labeled activities without a matching plot file are still inserted, with an empty summary
+    yield [], [{'id': k} | v | summarize_trackpoints([]) for k, v in label_activities.items()], []
+
+
+def parse_user(user_id, catalog=None):
+    """
+    Parses all files of a single user in a worker process.
+    Returns the (users, activities, trackpoints) lists of the user and the metrics of parsing them
+    """
+    # The worker process has its own metrics, they are sent back to be merged into those of the main process
+    METRICS.reset()
+
+    users, activities, trackpoints = [], [], []
+    for new_users, new_activities, new_trackpoints in read_user_files(user_id, catalog):
+        users.extend(new_users)
+        activities.extend(new_activities)
+        trackpoints.extend(new_trackpoints)
+    return users, activities, trackpoints, METRICS.to_dict()
+
+
+def merge_user_metrics(result):
+    """
+    Merges the metrics a worker process returned with a parsed user and returns the documents of the user
+    """
+    users, activities, trackpoints, metrics = result
+    METRICS.merge(metrics)
+    return users, activities, trackpoints
+
+
+def parse_users_in_parallel(user_ids, workers, catalog=None):
+    """
+    Parses the users on a pool of worker processes.
+    Yields the documents of each user in the order of user_ids, so the result is deterministic.
+    At most two users per worker are in flight, which keeps the parsed documents waiting in memory bounded
+    """
+    # Each worker only receives the catalog entries of the user it parses
+    catalog_by_user = group_by_user(catalog or dict())
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for user_id in user_ids:
+            pending.append(executor.submit(parse_user, user_id, catalog_by_user.get(user_id)))
+            if len(pending) >= workers * 2:
+                yield merge_user_metrics(pending.popleft().result())
+
+        while pending:
+            yield merge_user_metrics(pending.popleft().result())
+
+
+def print_user_progress(current_user_index, number_of_users):
+    print("{} Parsed users {:7.2f} % {:4,} / {:4,}".format(
+        time.strftime("%H:%M:%S"),
+        round(current_user_index / number_of_users * 100, 2),
+        current_user_index,
+        number_of_users
+    )
+    )
+
+
+def open_all_files_parallel(workers, catalog=None):
+    """
+    Same as open_all_files, but parses the users on a pool of worker processes
+    """
+    users_list, activities_list, trackpoints_list = [], [], []
+
+    user_ids = list_user_ids()
+
+    for index, (users, activities, trackpoints) in enumerate(parse_users_in_parallel(user_ids, workers, catalog)):
+        print_user_progress(index + 1, len(user_ids))
+        users_list.extend(users)
+        activities_list.extend(activities)
+        trackpoints_list.extend(trackpoints)
+
+    return users_list, activities_list, trackpoints_list
+
+
+def iter_file_documents(workers=1, catalog=None):
+    """
+    Walks the dataset one user at a time and yields the documents of each file as soon as it is parsed,
+    so only a single file is held in memory at once.
+    With more than one worker the users are parsed in parallel and the documents are yielded per user.
+    Yields tuples of (users, activities, trackpoints) lists ready for insertion
+    """
+    user_ids = list_user_ids()
+
+    if workers > 1:
+        for index, documents in enumerate(parse_users_in_parallel(user_ids, workers, catalog)):
+            print_user_progress(index + 1, len(user_ids))
+            yield documents
+        return
+
+    for index, user_id in enumerate(user_ids):
+        yield from read_user_files(user_id, catalog)
+        print_user_progress(index + 1, len(user_ids))
@@ -1,25 +1,796 @@
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import numpy as np
 from dbConnector import DbConnector
-from haversine import haversine
+from pipelineMetrics import COMMANDS
+from columnarResults import DATETIME, FLOAT, INTEGER, STRING, find_columns, iter_column_batches
+from spatialGrid import EARTH_RADIUS_KM, assign_edge, assign_inside, cell_batches, cell_field, plan_lookup
+from trajectory import columns_to_activity_arrays, haversine_distances, iter_batches_to_activity_arrays, years_of
+
+# The columns of the trackpoints the trajectory kernels read
+TRACKPOINT_SCHEMA = {
+    "user_id": STRING,
+    "activity_id": STRING,
+    "lat": FLOAT,
+    "lon": FLOAT,
+    "altitude": FLOAT,
+    "date_time": DATETIME
+}
+
+# The columns of the labeled trackpoints the column store export reads
+MODE_SCHEMA = {
+    "activity_id": STRING,
+    "date_time": DATETIME,
+    "transportation_mode": STRING
+}
+
+
+def polygon_area(points):
+    """
+    Returns the $geoWithin operand of a polygon given as a list of (lat, lon) points
+    """
+    # GeoJSON puts the longitude first and requires the ring to be closed
+    ring = [[lon, lat] for lat, lon in points]
+    if ring[0] != ring[-1]:
+        ring.append(ring[0])
+
+    return {
+        '$geometry': {
+            'type': 'Polygon',
+            'coordinates': [ring]
+        }
+    }
+
+
+def box_area(min_lat, max_lat, min_lon, max_lon):
+    """
+    Returns the $geoWithin operand of a latitude and longitude box
+    """
+    return polygon_area([(min_lat, min_lon), (min_lat, max_lon), (max_lat, max_lon), (max_lat, min_lon)])
+
+
+def circle_area(lat, lon, radius_km):
+    """
+    Returns the $geoWithin operand of a circle around a point
+    """
+    return {
+        '$centerSphere': [[lon, lat], radius_km / EARTH_RADIUS_KM]
+    }
+
+
+def box_query(min_lat, max_lat, min_lon, max_lon, match=None):
+    """
+    Returns the query of the trackpoints inside the box that also match. Unlike box_area the box is matched on the
+    latitude and longitude numbers with the edges included, the same rule as the column store
+    """
+    return {
+        'lat': {
+            '$gte': min_lat,
+            '$lte': max_lat
+        },
+        'lon': {
+            '$gte': min_lon,
+            '$lte': max_lon
+        },
+        **(match or dict())
+    }
+
+
+def location_area_query(area, match=None):
+    """
+    Returns the query of the trackpoints with their location inside the $geoWithin area that also match
+    """
+    return {
+        'location': {
+            '$geoWithin': area
+        },
+        **(match or dict())
+    }
+
+
+def match_stage(match):
+    """
+    Returns the $match stage of a partition to put in front of a pipeline, or no stage without a match
+    """
+    return [{'$match': match}] if match else []
+
+
+def combine_matches(*matches):
+    """
+    Returns a match of all the given matches, leaving out the empty ones, or None when all of them are empty
+    """
+    matches = [match for match in matches if match]
+    if not matches:
+        return None
+    return matches[0] if len(matches) == 1 else {'$and': matches}
+
+
+def date_time_range(start=None, end=None):
+    """
+    Returns the condition on date_time from start up to but not including end, either of them may be left open
+    """
+    condition = dict()
+    if start is not None:
+        condition['$gte'] = start
+    if end is not None:
+        condition['$lt'] = end
+    return condition
+
+
+def group_activity_trackpoints(trackpoints, fields, user_of, activity_of):
+    """
+    Groups consecutive trackpoints of the same activity into columns.
+    Yields (user_id, activity_id, columns) where columns maps every field to a list of values
+    """
+    user_id = None
+    activity_id = None
+    columns = None
+
+    for trackpoint in trackpoints:
+        next_activity_id = activity_of(trackpoint)
+
+        # A new activity starts, the previous one is complete
+        if next_activity_id != activity_id:
+            if columns is not None:
+                yield user_id, activity_id, columns
+
+            user_id = user_of(trackpoint)
+            activity_id = next_activity_id
+            columns = {field: [] for field in fields}
+
+        for field in fields:
+            columns[field].append(trackpoint[field])
+
+    if columns is not None:
+        yield user_id, activity_id, columns
+
+
+# The box around the Forbidden City of Beijing of query 10
+FORBIDDEN_CITY = (39.916, 39.917, 116.397, 116.398)
+
+# If one of the altitudes are null they were -777 before cleanup and are invalid
+VALID_ALTITUDES = {
+    '$and': [
+        {'$isNumber': '$value'},
+        {'$isNumber': '$next_value'},
+        {'$ne': ['$value', 0]},
+        {'$ne': ['$next_value', 0]}
+    ]
+}
+
+
+def activities_per_user_pipeline():
+    """
+    Query 2 - the average number of activities per user
+    """
+    return [
+        {
+            '$group': {
+                '_id': '$user_id',
+                'sum': {
+                    '$count': {}
+                }
+            }
+        }, {
+            '$group': {
+                '_id': 'null',
+                'avg': {
+                    '$avg': '$sum'
+                }
+            }
+        }
+    ]
+
+
+def top_users_pipeline():
+    """
+    Query 3 - the 20 users with the most activities
+    """
+    return [
+        {
+            '$group': {
+                '_id': '$user_id',
+                'count': {
+                    '$sum': 1
+                }
+            }
+        },
+        {
+            '$sort': {
+                'count': -1
+            }
+        },
+        {
+            '$limit': 20
+        }
+    ]
+
+
+def taxi_users_pipeline():
+    """
+    Query 4 - the users who have taken a taxi
+    """
+    return [
+        {
+            '$match': {
+                'transportation_mode': 'taxi'
+            }
+        },
+        {
+            '$group': {
+                '_id': '$user_id'
+            }
+        },
+        {
+            '$sort': {
+                '_id': 1
+            }
+        }
+    ]
+
+
+def mode_count_pipeline():
+    """
+    Query 5 - the number of activities of every transportation mode, without the unlabeled activities
+    """
+    return [
+        {
+            '$match': {
+                'transportation_mode': {
+                    '$ne': ''
+                }
+            }
+        },
+        {
+            '$group': {
+                '_id': '$transportation_mode',
+                'count': {
+                    '$sum': 1
+                }
+            }
+        },
+        {
+            '$sort': {
+                'count': -1
+            }
+        }
+    ]
+
+
+def year_activities_pipeline():
+    """
+    Query 6a - the year with the most activities
+    """
+    return [
+        {
+            '$group': {
+                '_id': {
+                    '$year': '$start_date_time'
+                },
+                'count': {
+                    '$sum': 1
+                }
+            }
+        },
+        {
+            '$sort': {
+                'count': -1
+            }
+        },
+        {
+            '$limit': 1
+        }
+    ]
+
+
+def year_hours_pipeline():
+    """
+    Query 6b - the 5 years with the most recorded hours
+    """
+    return [
+        {
+            '$group': {
+                '_id': {
+                    '$year': '$start_date_time'
+                },
+                'sum': {
+                    '$sum': {
+                        '$divide': [
+                            {
+                                '$subtract': [
+                                    '$end_date_time', '$start_date_time'
+                                ]
+                            }, 1000 * 60 * 60
+                        ]
+                    }
+                }
+            }
+        },
+        {
+            '$sort': {
+                'sum': -1
+            }
+        },
+        {
+            '$limit': 5
+        }
+    ]
+
+
+def compare_years(obj_res_6a, obj_res_6b):
+    """
+    Prints the answers of query 6 and returns the years with the most recorded hours
+    """
+    year_a = obj_res_6a[0]['_id']
+    count_a = obj_res_6a[0]['count']
+
+    print("The year {} has the most activities with {:,} activities".format(
+        year_a, count_a).replace(",", " "))
+
+    year_b = obj_res_6b[0]['_id']
+    sum_b = obj_res_6b[0]['sum']
+
+    print("The year {} has the most recorded hours with {:,} hours".format(
+        year_b, round(sum_b)).replace(",", " "))
+
+    # Testing if the year with most activities also is the year with most recorded hours
+    if year_a == year_b:
+        print("\nYes, this is also the year with most recorded hours!\n")
+    else:
+        print("\nNo, this is not the year with most recorded hours\n")
+
+    result = []
+
+    for row in obj_res_6b:
+        result.append([row['_id'], round(row['sum'])])
+
+    return result
+
+
+def altitude_sort_and_limit():
+    return [
+        {
+            '$sort': {
+                'altitude': -1,
+                '_id': 1
+            }
+        },
+        {
+            '$limit': 20
+        }
+    ]
+
+
+def summary_altitude_pipeline():
+    """
+    Query 8 on the altitude gain of every activity summarized at ingest
+    """
+    return [
+        {
+            # Only activities with two trackpoints or more can gain altitude
+            '$match': {
+                'point_count': {
+                    '$gte': 2
+                }
+            }
+        },
+        {
+            '$group': {
+                '_id': '$user_id',
+                'altitude': {
+                    '$sum': '$altitude_gain'
+                }
+            }
+        }
+    ] + altitude_sort_and_limit()
+
+
+def altitude_gain_stages():
+    """
+    Query 8 on the pairs of consecutive trackpoints, see Repository.aggregate_consecutive_trackpoints
+    """
+    return [
+        {
+            # Calculating the altitude gained for each user, every document is two trackpoints in a row.
+            # Only climbs count as gained altitude
+            '$group': {
+                '_id': '$user_id',
+                'altitude': {
+                    '$sum': {
+                        '$cond': [
+                            VALID_ALTITUDES,
+                            {'$max': [{'$subtract': ['$next_value', '$value']}, 0]},
+                            0
+                        ]
+                    }
+                }
+            }
+        }
+    ] + altitude_sort_and_limit()
+
+
+def top_altitude_users(partial_results):
+    """
+    Ranks the users of the top 20 of every partition. Every user is in a single partition,
+    so the top 20 overall are among the top 20 of the partitions
+    """
+    res = sorted((row for rows in partial_results for row in rows),
+                 key=lambda row: (-row['altitude'], row['_id']))[:20]
+
+    result = []
+
+    for i, row in enumerate(res):
+        result.append([i + 1, row['_id'], round(row['altitude'])])
+
+    return result
+
+
+def summary_invalid_pipeline():
+    """
+    Query 9 on the largest time gap of every activity summarized at ingest
+    """
+    return [
+        {
+            # We can only compare if we have two trackpoints from the same activity
+            '$match': {
+                'point_count': {
+                    '$gte': 2
+                }
+            }
+        },
+        {
+            '$group': {
+                '_id': '$user_id',
+                'invalid_activities': {
+                    '$sum': {
+                        '$cond': [{'$gt': ['$max_gap_seconds', 60 * 5]}, 1, 0]
+                    }
+                }
+            }
+        },
+        {
+            '$sort': {
+                '_id': 1
+            }
+        }
+    ]
+
+
+def invalid_activity_stages():
+    """
+    Query 9 on the pairs of consecutive trackpoints, see Repository.aggregate_consecutive_trackpoints
+    """
+    return [
+        {
+            # An activity is invalid if two trackpoints in a row are more than 5 minutes apart
+            '$group': {
+                '_id': '$activity_id',
+                'user_id': {
+                    '$first': '$user_id'
+                },
+                'invalid': {
+                    '$max': {
+                        '$gt': [{'$subtract': ['$next_value', '$value']}, 1000 * 60 * 5]
+                    }
+                }
+            }
+        },
+        {
+            '$group': {
+                '_id': '$user_id',
+                'invalid_activities': {
+                    '$sum': {
+                        '$cond': ['$invalid', 1, 0]
+                    }
+                }
+            }
+        },
+        {
+            '$sort': {
+                '_id': 1
+            }
+        }
+    ]
+
+
+def sum_invalid_activities(partial_results):
+    """
+    Adds up the counts of the partitions per user
+    """
+    invalid_activities = defaultdict(int)
+    for rows in partial_results:
+        for row in rows:
+            invalid_activities[row['_id']] += row['invalid_activities']
+
+    result = []
+
+    for user_id, count in sorted(invalid_activities.items()):
+        result.append([user_id, count])
+
+    return result
+
+
+def forbidden_city_messages(user_ids):
+    result = []
+
+    for user_id in user_ids:
+        result.append(f"User {user_id} has trackpoints in the forbidden city\n")
+
+    return result
+
+
+# Query 7 is the distance of these users, modes and period, see distance_per_user_mode_year
+WALKED_IN_2008_BY_112 = (['112'], ['walk'], datetime(2008, 1, 1), datetime(2009, 1, 1))
+
+
+def distance_activity_query(user_ids=None, transportation_modes=None):
+    """
+    Returns the query of the activities whose modes distance_per_user_mode_year reads
+    """
+    activity_query = dict()
+    if user_ids is not None:
+        activity_query['user_id'] = {'$in': list(user_ids)}
+    if transportation_modes is not None:
+        activity_query['transportation_mode'] = {'$in': list(transportation_modes)}
+    return activity_query
+
+
+def distance_selection(user_field, activity_field, modes, user_ids=None, transportation_modes=None):
+    """
+    Returns the matches of the trackpoints distance_per_user_mode_year reads, given the modes of the activities.
+    Only labeled activities have a mode, so a selection of modes is read by its activity ids
+    """
+    selection = []
+    if user_ids is not None:
+        selection.append({user_field: {'$in': list(user_ids)}})
+    if transportation_modes is not None:
+        selection.append({activity_field: {'$in': list(modes)}})
+    return selection
+
+
+def add_distances(totals, activity, mode):
+    """
+    Adds the distance between the consecutive trackpoints of the activity to the total of its user, the mode and the
+    year of the first trackpoint of every pair
+    """
+    if mode is None or len(activity.epoch) < 2:
+        return
+
+    distances = haversine_distances(activity.lat, activity.lon)
+    years = years_of(activity.epoch[:-1])
+    for year in np.unique(years).tolist():
+        totals[(activity.user_id, mode, year)] += float(distances[years == year].sum())
+
+
+def distance_totals(activities, modes):
+    """
+    Returns the distance of the activities per user, mode and year, given the modes of the selected activities
+    """
+    totals = defaultdict(float)
+    for activity in activities:
+        add_distances(totals, activity, modes.get(activity.activity_id))
+    return totals
+
+
+def sum_partial_totals(partial_totals):
+    """
+    Adds up the totals of the partitions and returns them as rows sorted by their keys
+    """
+    totals = defaultdict(int)
+    for partial in partial_totals:
+        for key, value in partial.items():
+            totals[key] += value
+
+    return [[*key, value] for key, value in sorted(totals.items())]
+
+
+def cell_values_pipeline(resolution, cells, field, match=None):
+    """
+    Returns the pipeline of the distinct (cell, value) pairs of the field among the trackpoints in the cells
+    """
+    return [
+        {
+            '$match': {
+                cell_field(resolution): {
+                    '$in': cells
+                },
+                **(match or dict())
+            }
+        },
+        {
+            '$group': {
+                '_id': {
+                    'cell': '$' + cell_field(resolution),
+                    'value': '$' + field
+                }
+            }
+        }
+    ]
+
+
+def cell_value_pairs(res):
+    return [(row['_id']['cell'], row['_id']['value']) for row in res]
+
+
+def labeled_selection(user_field, user_ids=None, transportation_modes=None):
+    """
+    Returns the match of the labeled trackpoints of the users in the modes, leaving out the users or modes includes all
+    """
+    selection = {
+        'transportation_mode': {
+            '$in': list(transportation_modes)
+        } if transportation_modes is not None else {
+            '$exists': True
+        }
+    }
+    if user_ids is not None:
+        selection[user_field] = {'$in': list(user_ids)}
+    return selection
+
+
+def trackpoint_modes_pipeline(match, user_field='user_id'):
+    """
+    Returns the pipeline counting the matching trackpoints per user and transportation mode
+    """
+    return [
+        {
+            '$match': match
+        },
+        {
+            '$group': {
+                '_id': {
+                    'user_id': '$' + user_field,
+                    'transportation_mode': '$transportation_mode'
+                },
+                'count': {
+                    '$sum': 1
+                }
+            }
+        }
+    ]
+
+
+def mode_count_pairs(res):
+    return [((row['_id']['user_id'], row['_id']['transportation_mode']), row['count']) for row in res]
+
+
+# Query 11 reads the labeled activities
+LABELED_ACTIVITIES = {
+    'transportation_mode': {
+        '$ne': ''
+    }
+}
+
+
+def most_used_modes(activities):
+    """
+    Returns every user with labeled activities, its most used transportation mode and how often it was used
+    """
+    user_transportation_mode = dict()
+
+    for activity in activities:
+        user_id = activity['user_id']
+        transportation_mode = activity['transportation_mode']
+
+        # Initialize the user_transportation_mode dict if the user_id is not in it
+        if user_id not in user_transportation_mode:
+            user_transportation_mode[user_id] = dict()
+
+        # Initialize the transportation_mode dict if the transportation_mode is not in it
+        if transportation_mode not in user_transportation_mode[user_id]:
+            user_transportation_mode[user_id][transportation_mode] = 0
+
+        # Increment the count for the given transportation_mode
+        user_transportation_mode[user_id][transportation_mode] += 1
+
+    # Sorting the dict by the date_time gained
+    sorted_user_transportation_mode = sorted(user_transportation_mode.items())
+
+    result = []
+
+    for user_id, transportation_modes in sorted_user_transportation_mode:
+        transportation_mode = max(transportation_modes, key=transportation_modes.get)
+        result.append([user_id, transportation_mode, transportation_modes[transportation_mode]])
+
+    return result
+
+
+def consecutive_trackpoints_pipeline(field, activity_field='activity_id', user_field='user_id'):
+    """
+    Returns the pipeline stages that pair every trackpoint with the next one in the same activity, sorted by time.
+    Each resulting document has the user_id, activity_id, value and next_value of the field
+    """
+    return [
+        {
+            '$setWindowFields': {
+                'partitionBy': '$' + activity_field,
+                'sortBy': {
+                    'date_time': 1
+                },
+                'output': {
+                    'next_value': {
+                        '$shift': {
+                            'output': '$' + field,
+                            'by': 1
+                        }
+                    }
+                }
+            }
+        },
+        {
+            # The last trackpoint of an activity has no next trackpoint
+            '$match': {
+                'next_value': {
+                    '$ne': None
+                }
+            }
+        },
+        {
+            '$project': {
+                '_id': False,
+                'user_id': '$' + user_field,
+                'activity_id': '$' + activity_field,
+                'value': '$' + field,
+                'next_value': True
+            }
+        }
+    ]
+
+
+def trackpoint_query(start=None, end=None, match=None):
+    """
+    Returns the query of the trackpoints from start up to end that also match, or None to read all of them
+    """
+    query = dict(match or dict())
+    if start is not None or end is not None:
+        query = combine_matches(query, {'date_time': date_time_range(start, end)})
+    return query or None
+
+
+def user_ranges(user_ids, partitions):
+    """
+    Splits the sorted user ids into contiguous ranges with about the same number of users, one for each partition.
+    The first and last range are open, so users that are not in the User collection are still covered
+    """
+    bounds = sorted({user_ids[len(user_ids) * i // partitions] for i in range(1, partitions)}
+                    if user_ids else set())
+
+    ranges = []
+    for lower, upper in zip([None] + bounds, bounds + [None]):
+        user_range = dict()
+        if lower is not None:
+            user_range['$gte'] = lower
+        if upper is not None:
+            user_range['$lt'] = upper
+        ranges.append(user_range)
+    return ranges
 
 
 class Repository:
     """
-    Class for querying the MongoDB database
+    Class for querying the MongoDB database.
+    With more than one partition the heavy trackpoint queries are split into user_id ranges that run concurrently
     """
 
-    def __init__(self):
-        self.connection = DbConnector()
+    # The fields of the trackpoints that hold the user and activity ids
+    user_field = 'user_id'
+    activity_field = 'activity_id'
+
+    def __init__(self, connection=None, partitions=1):
+        self.connection = connection or DbConnector()
         self.client = self.connection.client
         self.db = self.connection.db
+        self.partitions = partitions
 
     def sum_user_activity_trackpoint(self):
         """
         Query 1 - Finding how many users, activities and trackpoints are there in the dataset
         """
 
-        user_sum = self.db.User.count()
-        activity_sum = self.db.Activity.count()
-        trackpoint_sum = self.db.TrackPoint.count()
+        user_sum = self.db.User.estimated_document_count()
+        activity_sum = self.db.Activity.estimated_document_count()
+        trackpoint_sum = self.count_trackpoints()
         return "There are {} users, {:,} activities and {:,} trackpoints in the dataset".format(
             user_sum, activity_sum, trackpoint_sum).replace(",", " ")
 
@@ -27,23 +798,7 @@ class Repository:
         """
         Query 2 - Find the average number of activities per user.
         """
-        res = self.db.Activity.aggregate([
-            {
-                '$group': {
-                    '_id': '$user_id',
-                    'sum': {
-                        '$count': {}
-                    }
-                }
-            }, {
-                '$group': {
-                    '_id': 'null',
-                    'avg': {
-                        '$avg': '$sum'
-                    }
-                }
-            }
-        ])
+        res = self.db.Activity.aggregate(activities_per_user_pipeline())
 
         return 'The average number of activities per user is {:.2f}'.format(list(res)[0]['avg'])
 
@@ -52,24 +807,7 @@ class Repository:
         Query 3 - Find the top 20 users with the highest number of activities.
         """
 
-        res = self.db.Activity.aggregate([
-            {
-                '$group': {
-                    '_id': '$user_id',
-                    'count': {
-                        '$sum': 1
-                    }
-                }
-            },
-            {
-                '$sort': {
-                    'count': -1
-                }
-            },
-            {
-                '$limit': 20
-            }
-        ])
+        res = self.db.Activity.aggregate(top_users_pipeline())
 
         result = []
         counter = 0
@@ -84,23 +822,7 @@ class Repository:
         Query 4 - Find all users who have taken a taxi.
         """
 
-        res = self.db.Activity.aggregate([
-            {
-                '$match': {
-                    'transportation_mode': 'taxi'
-                }
-            },
-            {
-                '$group': {
-                    '_id': '$user_id'
-                }
-            },
-            {
-                '$sort': {
-                    '_id': 1
-                }
-            }
-        ])
+        res = self.db.Activity.aggregate(taxi_users_pipeline())
 
         result = []
         for row in res:
@@ -115,28 +837,7 @@ class Repository:
         Does not count the rows where the mode is null.
         """
 
-        res = self.db.Activity.aggregate([
-            {
-                '$match': {
-                    'transportation_mode': {
-                        '$ne': ''
-                    }
-                }
-            },
-            {
-                '$group': {
-                    '_id': '$transportation_mode',
-                    'count': {
-                        '$sum': 1
-                    }
-                }
-            },
-            {
-                '$sort': {
-                    'count': -1
-                }
-            }
-        ])
+        res = self.db.Activity.aggregate(mode_count_pipeline())
 
         result = []
         for row in res:
@@ -150,272 +851,299 @@ class Repository:
         Query 6 - Find the year with the most activities. Testing if this also is the year with most recorded hours
         """
         # Query a - Find the year with the most activities.
-        res6a = self.db.Activity.aggregate([
-            {
-                '$group': {
-                    '_id': {
-                        '$year': '$start_date_time'
-                    },
-                    'count': {
-                        '$sum': 1
-                    }
-                }
-            },
-            {
-                '$sort': {
-                    'count': -1
-                }
-            },
-            {
-                '$limit': 1
-            }
-        ])
+        obj_res_6a = list(self.db.Activity.aggregate(year_activities_pipeline()))
 
-        obj_res_6a = list(res6a)
-        year_a = obj_res_6a[0]['_id']
-        count_a = obj_res_6a[0]['count']
+        # Query b - Testing if this also is the year with most recorded hours
+        obj_res_6b = list(self.db.Activity.aggregate(year_hours_pipeline()))
 
-        print("The year {} has the most activities with {:,} activities".format(
-            year_a, count_a).replace(",", " "))
+        return compare_years(obj_res_6a, obj_res_6b)
 
-        # Query b - Testing if this also is the year with most recorded hours
-        res6b = self.db.Activity.aggregate([
-            {
-                '$group': {
-                    '_id': {
-                        '$year': '$start_date_time'
-                    },
-                    'sum': {
-                        '$sum': {
-                            '$divide': [
-                                {
-                                    '$subtract': [
-                                        '$end_date_time', '$start_date_time'
-                                    ]
-                                }, 1000 * 60 * 60
-                            ]
-                        }
-                    }
-                }
-            },
-            {
-                '$sort': {
-                    'sum': -1
-                }
-            },
-            {
-                '$limit': 5
-            }
-        ])
+    def total_distance_in_km_walked_in_2008_by_userid_112(self):
+        """ 
+        Query 7 - Find the total distance (in km) walked in 2008, by user with id = 112
+        """
+        rows = self.distance_per_user_mode_year(*WALKED_IN_2008_BY_112)
+        return float(sum(distance for _, _, _, distance in rows))
 
-        obj_res_6b = list(res6b)
-        year_b = obj_res_6b[0]['_id']
-        sum_b = obj_res_6b[0]['sum']
+    def distance_per_user_mode_year(self, user_ids=None, transportation_modes=None, start=None, end=None):
+        """
+        Returns the distance in km covered by every combination of user, transportation mode and year
+        as [user_id, transportation_mode, year, distance] rows, sorted by user, mode and year.
+        Leaving out the users or modes includes all of them, activities without a label have the mode ''.
+        Only the trackpoints from start up to end are read, filtered in the server, and the distance between two
+        consecutive trackpoints counts for the year of the first. All combinations are summed in one streamed pass
+        """
+        modes = {activity['id']: activity['transportation_mode']
+                 for activity in self.db.Activity.find(distance_activity_query(user_ids, transportation_modes),
+                                                       {'_id': False, 'id': True, 'transportation_mode': True})}
+        selection = distance_selection(self.user_field, self.activity_field, modes, user_ids, transportation_modes)
 
-        print("The year {} has the most recorded hours with {:,} hours".format(
-            year_b, round(sum_b)).replace(",", " "))
+        def run(match):
+            return distance_totals(self.iter_activity_arrays(start=start, end=end,
+                                                             match=combine_matches(match, *selection)), modes)
 
-        # Testing if the year with most activities also is the year with most recorded hours
-        if year_a == year_b:
-            print("\nYes, this is also the year with most recorded hours!\n")
-        else:
-            print("\nNo, this is not the year with most recorded hours\n")
+        return sum_partial_totals(self.fan_out(run))
 
-        result = []
+    def top_20_users_gained_most_altitude_meters(self):
+        """
+        Query 8 - Find the top 20 users who have gained the most altitude meters.
+        """
 
-        for row in obj_res_6b:
-            result.append([row['_id'], round(row['sum'])])
-        
-        return result
+        # The altitude gain of every activity is summarized at ingest
+        if self.has_activity_summaries():
+            return top_altitude_users([self.db.Activity.aggregate(summary_altitude_pipeline())])
 
-    def total_distance_in_km_walked_in_2008_by_userid_112(self):
-        """ 
-        Query 7 - Find the total distance (in km) walked in 2008, by user with id = 112
+        return top_altitude_users(self.fan_out(
+            lambda match: list(self.aggregate_consecutive_trackpoints('altitude', altitude_gain_stages(), match))))
+
+    def invalid_activities_per_user(self):
+        """
+        Query 9 - Find all users who have invalid activities, and the number of invalid activities per user
         """
 
-        # Get all activity ids for user 112 in 2008 with transportation mode walk
-        res_activities = self.db.Activity.find({
-            "user_id": "112",
-            "transportation_mode": "walk"
-        }, {
-            "_id": False,
-            "id": True
-        })
+        # The largest time gap of every activity is summarized at ingest
+        if self.has_activity_summaries():
+            return sum_invalid_activities([self.db.Activity.aggregate(summary_invalid_pipeline())])
 
-        activities_list = [x['id'] for x in res_activities]
+        return sum_invalid_activities(self.fan_out(
+            lambda match: list(self.aggregate_consecutive_trackpoints('date_time', invalid_activity_stages(), match))))
 
-        # Use the activity ids to get the related trackpoints
-        res_trackpoints = self.db.TrackPoint.find({
-            "activity_id": {
-                "$in": activities_list
-            }
-        }, {
-            "_id": False,
-            "id": True,
-            "activity_id": True,
-            "lat": True,
-            "lon": True
-        })
+    def users_tracked_activity_in_the_forbidden_city_beijing(self):
+        """
+        Query 10 - Find the users who have tracked an activity in the Forbidden City of Beijing.
+        """
 
-        trackpoints_list = list(res_trackpoints)
+        return forbidden_city_messages(self.users_with_trackpoints_in_box(*FORBIDDEN_CITY))
 
-        distance = 0
+    def has_activity_summaries(self):
+        """
+        Checks if the activities carry the summaries computed at ingest, see trajectory.summarize.
+        Databases loaded before the summaries existed fall back to reading the trackpoints
+        """
+        return self.db.Activity.find_one({'point_count': {'$exists': True}}, {'_id': True}) is not None
 
-        # Loop through the trackpoints and calculate the distance between each point
-        for i in range(len(trackpoints_list) - 1):
-            activity_id = trackpoints_list[i]['activity_id']
-            next_activity_id = trackpoints_list[i + 1]['activity_id']
+    def count_trackpoints(self):
+        """
+        Returns the number of trackpoints in the dataset
+        """
+        return self.db.TrackPoint.estimated_document_count()
 
-            # If the next trackpoint is not in the same activity we skip
-            # as we only want to calculate the distance between trackpoints in the same activity
-            if activity_id != next_activity_id:
-                continue
-            
-            lat1 = trackpoints_list[i]['lat']
-            lon1 = trackpoints_list[i]['lon']
-            lat2 = trackpoints_list[i + 1]['lat']
-            lon2 = trackpoints_list[i + 1]['lon']
+    def consecutive_trackpoints_pipeline(self, field):
+        """
+        Returns the pipeline stages that pair every trackpoint with the next one in the same activity, sorted by time.
+        Each resulting document has the user_id, activity_id, value and next_value of the field
+        """
+        return consecutive_trackpoints_pipeline(field, self.activity_field, self.user_field)
+
+    def aggregate_consecutive_trackpoints(self, field, stages, match=None):
+        """
+        Runs the stages inside the server on every pair of consecutive trackpoints of the same activity.
+        With a match only the trackpoints of one partition are read
+        """
+        return self.db.TrackPoint.aggregate(match_stage(match) + self.consecutive_trackpoints_pipeline(field) + stages,
+                                            allowDiskUse=True)
+
+    def user_ranges(self):
+        """
+        Splits the user ids into contiguous ranges with about the same number of users, one for each partition
+        """
+        return user_ranges(sorted(self.db.User.distinct('id')), self.partitions)
 
-            # Calculate the distance between the two points using haversine
-            distance += haversine((lat1, lon1), (lat2, lon2))
+    def fan_out(self, run):
+        """
+        Calls run with the match of every user range partition on a thread pool and returns their results in order.
+        The commands of the pool threads are counted under the label of the calling query.
+        With a single partition run is called once without a match
+        """
+        if self.partitions <= 1:
+            return [run(None)]
 
-        return distance
+        matches = [{self.user_field: user_range} if user_range else None for user_range in self.user_ranges()]
+        with ThreadPoolExecutor(max_workers=len(matches)) as executor:
+            return list(executor.map(COMMANDS.carry_label(run), matches))
 
-    def top_20_users_gained_most_altitude_meters(self):
+    def iter_activity_trackpoints(self, fields, activity_ids=None, batch_size=10_000):
         """
-        Query 8 - Find the top 20 users who have gained the most altitude meters.
+        Yields the trackpoints of one activity at a time as (user_id, activity_id, trackpoints),
+        where trackpoints maps each of the fields to the list of its values in time order.
+        Only the activities in activity_ids are read if it is given
         """
+        query = {} if activity_ids is None else {'activity_id': {'$in': activity_ids}}
 
-        res = self.db.TrackPoint.find({}, {
+        # Sorting on the (activity_id, date_time) index keeps the trackpoints of an activity together
+        res = self.db.TrackPoint.find(query, {
             '_id': False,
             'user_id': True,
             'activity_id': True,
-            'altitude': True  
-        })
-
-        trackpoint_altitudes = list(res)
-        user_altitude = dict()
+            **{field: True for field in fields}
+        }).sort([('activity_id', 1), ('date_time', 1)]).batch_size(batch_size)
 
-        # Calculating the altitude gained for each user
-        for index in range(len(trackpoint_altitudes)):
-            # Breaking if the last trackpoint is reached
-            if index == len(trackpoint_altitudes) - 1:
-                break
+        return group_activity_trackpoints(res, fields, lambda x: x['user_id'], lambda x: x['activity_id'])
 
-            user_id = trackpoint_altitudes[index]['user_id']
-            activity_id = trackpoint_altitudes[index]['activity_id']
-            next_activity_id = trackpoint_altitudes[index + 1]['activity_id']
+    def find_columns(self, collection, query, schema, sort=None, batch_size=10_000):
+        """
+        Returns the result of a find on the collection as NumPy columns instead of documents, see columnarResults
+        """
+        return find_columns(self.db[collection], query, schema, sort, batch_size)
 
-            # We can only calculate the altitude gain if we have two trackpoints from the same activity
-            if activity_id != next_activity_id:
-                continue
+    def iter_activity_arrays(self, activity_ids=None, batch_size=10_000, start=None, end=None, match=None):
+        """
+        Yields the trackpoints of one activity at a time as trajectory.ActivityArrays, read as columns.
+        A selection of activities is read at once, a scan of all activities is read one batch at a time
+        so memory only grows with the batch size and the largest activity.
+        Only the trackpoints from start up to end that also match are read if they are given
+        """
+        sort = [('activity_id', 1), ('date_time', 1)]
+        query = trackpoint_query(start, end, match)
 
-            # Initialize the user_altitude dict if the user_id is not in it
-            if user_id not in user_altitude:
-                user_altitude[user_id] = 0
+        if activity_ids is not None:
+            columns = self.find_columns('TrackPoint', combine_matches(query, {'activity_id': {'$in': activity_ids}}),
+                                        TRACKPOINT_SCHEMA, sort, batch_size)
+            return columns_to_activity_arrays(columns)
 
-            altitude = trackpoint_altitudes[index]['altitude']
-            next_altitude = trackpoint_altitudes[index + 1]['altitude']
+        return iter_batches_to_activity_arrays(
+            iter_column_batches(self.db.TrackPoint, query or {}, TRACKPOINT_SCHEMA, sort, batch_size))
 
-            # If one of the altitudes are null they were -777 before cleanup and are invalid
-            if not altitude or not next_altitude:
-                continue
+    def users_with_trackpoints_in_box(self, min_lat, max_lat, min_lon, max_lon):
+        """
+        Returns the ids of the users with at least one trackpoint inside the box, edges included.
+        Query 10 keeps the inclusive latitude and longitude match it always had, while users_in_box
+        matches the geodesic polygon of the box on the 2dsphere index, where points on the edges can fall outside
+        """
+        box = (min_lat, max_lat, min_lon, max_lon)
+        return sorted(set().union(*self.fan_out(lambda match: self.distinct_in_box(box, 'user_id', match))))
 
-            altitude_diff = next_altitude - altitude
-            user_altitude[user_id] += altitude_diff
+    def distinct_in_box(self, box, field, match=None):
+        """
+        Returns the distinct values of the field among the trackpoints inside the box that also match
+        """
+        return self.db.TrackPoint.distinct(field, box_query(*box, match))
 
-        # Sorting the dict by the altitude gained
-        user_altitude_array = sorted(
-            user_altitude.items(), key=lambda x: x[1], reverse=True)
+    def distinct_in_area(self, area, field):
+        """
+        Returns the sorted distinct values of the field among the trackpoints inside the area.
+        The area is a $geoWithin operand, see box_area, circle_area and polygon_area.
+        The values found in the partitions are joined
+        """
+        return sorted(set().union(*self.fan_out(lambda match: self.distinct_in_partition(area, field, match))))
 
-        result = []
+    def distinct_in_partition(self, area, field, match=None):
+        """
+        Returns the distinct values of the field among the trackpoints inside the area that also match
+        """
+        return self.db.TrackPoint.distinct(field, location_area_query(area, match))
 
-        for i, (user_id, altitude) in enumerate(user_altitude_array[:20]):
-            result.append([i + 1, user_id, round(altitude)])
-        
-        return result
+    def users_in_box(self, min_lat, max_lat, min_lon, max_lon):
+        """
+        Returns the ids of the users with trackpoints inside the box
+        """
+        return self.distinct_in_area(box_area(min_lat, max_lat, min_lon, max_lon), 'user_id')
 
-    def invalid_activities_per_user(self):
+    def users_near(self, lat, lon, radius_km):
         """
-        Query 9 - Find all users who have invalid activities, and the number of invalid activities per user
+        Returns the ids of the users with trackpoints within radius_km of the point
         """
+        return self.distinct_in_area(circle_area(lat, lon, radius_km), 'user_id')
 
-        res = self.db.TrackPoint.find({}, {
-            '_id': False,
-            'user_id': True,
-            'activity_id': True,
-            'date_time': True
-        })
+    def users_in_polygon(self, points):
+        """
+        Returns the ids of the users with trackpoints inside the polygon given as a list of (lat, lon) points
+        """
+        return self.distinct_in_area(polygon_area(points), 'user_id')
 
-        trackpoints = list(res)
-        invalid_user_activities = dict()
+    def activities_in_box(self, min_lat, max_lat, min_lon, max_lon):
+        """
+        Returns the ids of the activities with trackpoints inside the box
+        """
+        return self.distinct_in_area(box_area(min_lat, max_lat, min_lon, max_lon), 'activity_id')
 
-        # Comparing every two trackpoints to see if they are invalid
-        for index in range(len(trackpoints)):
-            # Breaking if the last trackpoint is reached
-            if index == len(trackpoints) - 1:
-                break
+    def activities_near(self, lat, lon, radius_km):
+        """
+        Returns the ids of the activities with trackpoints within radius_km of the point
+        """
+        return self.distinct_in_area(circle_area(lat, lon, radius_km), 'activity_id')
 
-            user_id = trackpoints[index]['user_id']
-            activity_id = trackpoints[index]['activity_id']
-            next_activity_id = trackpoints[index + 1]['activity_id']
+    def activities_in_polygon(self, points):
+        """
+        Returns the ids of the activities with trackpoints inside the polygon given as a list of (lat, lon) points
+        """
+        return self.distinct_in_area(polygon_area(points), 'activity_id')
 
-            # We can only compare if we have two trackpoints from the same activity
-            if activity_id != next_activity_id:
-                continue
+    def values_in_areas(self, areas, field):
+        """
+        Returns the sorted distinct values of the field among the trackpoints inside each of the areas, in one pass.
+        The areas are spatialGrid circles and polygons. Every area is covered by grid cells: the values of the cells
+        completely inside it are read from the cell index and only the points in the cells on its edge are checked,
+        so the work grows with the trackpoints found rather than with the areas times the trackpoints
+        """
+        plan = plan_lookup(areas)
 
-            # Initialize the invalid_activities dict if the user_id is not in it
-            if user_id not in invalid_user_activities:
-                invalid_user_activities[user_id] = set()
+        def run(match):
+            results = [set() for _ in areas]
+            for resolution, (inside, edge) in plan.items():
+                for cells in cell_batches(inside):
+                    assign_inside(results, inside, self.values_in_cells(resolution, cells, field, match))
+                for cells in cell_batches(edge):
+                    assign_edge(results, areas, edge, *self.points_in_cells(resolution, cells, field, match))
+            return results
 
-            date_time = trackpoints[index]['date_time']
-            next_date_time = trackpoints[index + 1]['date_time']
+        partial_results = self.fan_out(run)
+        return [sorted(set().union(*(results[index] for results in partial_results))) for index in range(len(areas))]
 
-            date_time_diff = next_date_time - date_time
-            if date_time_diff.seconds > 60 * 5:
-                invalid_user_activities[user_id].add(activity_id)
+    def values_in_cells(self, resolution, cells, field, match=None):
+        """
+        Returns the distinct (cell, value) pairs of the field among the trackpoints in the cells
+        """
+        return cell_value_pairs(self.db.TrackPoint.aggregate(cell_values_pipeline(resolution, cells, field, match)))
 
-        # Sorting the dict by the date_time gained
-        sorted_invalid_activities = sorted(invalid_user_activities.items())
+    def points_in_cells(self, resolution, cells, field, match=None):
+        """
+        Returns the cells, coordinates and values of the field of the trackpoints in the cells, as columns
+        """
+        schema = {cell_field(resolution): INTEGER, 'lat': FLOAT, 'lon': FLOAT, field: STRING}
+        columns = self.find_columns('TrackPoint', {cell_field(resolution): {'$in': cells}, **(match or dict())}, schema)
+        return columns[cell_field(resolution)], columns['lat'], columns['lon'], columns[field]
 
-        result = []
+    def users_in_areas(self, areas):
+        """
+        Returns the ids of the users with trackpoints inside each of the areas, such as thousands of points of interest
+        given as spatialGrid circles, in the order of the areas
+        """
+        return self.values_in_areas(areas, 'user_id')
 
-        for user_id, activities in sorted_invalid_activities:
-            result.append([user_id, len(activities)])
-        
-        return result
+    def activities_in_areas(self, areas):
+        """
+        Returns the ids of the activities with trackpoints inside each of the areas, in the order of the areas
+        """
+        return self.values_in_areas(areas, 'activity_id')
 
-    def users_tracked_activity_in_the_forbidden_city_beijing(self):
+    def labeled_trackpoints_per_user_mode(self, user_ids=None, transportation_modes=None):
         """
-        Query 10 - Find the users who have tracked an activity in the Forbidden City of Beijing.
+        Returns the number of trackpoints every user recorded in each transportation mode as
+        [user_id, transportation_mode, trackpoints] rows, sorted by user and mode. Leaving out the users or modes
+        includes all of them. The modes are those of the labels covering the trackpoints, joined at ingest,
+        so the trackpoints are matched on the mode index directly instead of through the labeled activities
         """
+        selection = labeled_selection(self.user_field, user_ids, transportation_modes)
 
-        res = self.db.TrackPoint.aggregate([
-            {
-                '$match': {
-                'lat': {
-                    '$gte': 39.916,
-                    '$lte': 39.917
-                },
-                'lon': {
-                    '$gte': 116.397,
-                    '$lte': 116.398
-                }
-                }
-            },
-            {
-                '$group': {
-                '_id': '$user_id',
-                }
-            }
-        ])
+        def run(match):
+            return dict(self.count_trackpoint_modes(combine_matches(match, selection), transportation_modes))
 
-        result = []
+        return sum_partial_totals(self.fan_out(run))
 
-        for row in list(res):
-            result.append(f"User {row['_id']} has trackpoints in the forbidden city\n")
+    def count_trackpoint_modes(self, match, transportation_modes=None):
+        """
+        Returns the number of matching trackpoints per user and transportation mode as ((user_id, mode), count) pairs
+        """
+        return mode_count_pairs(self.db.TrackPoint.aggregate(trackpoint_modes_pipeline(match)))
 
-        return result
+    def iter_trackpoint_modes(self, batch_size=10_000):
+        """
+        Yields the activity_id, date_time and transportation_mode of the labeled trackpoints as columns,
+        one batch at a time in no particular order
+        """
+        return iter_column_batches(self.db.TrackPoint, labeled_selection(self.user_field), MODE_SCHEMA,
+                                   batch_size=batch_size)
 
     def most_used_transportation_mode_per_user(self):
         """
@@ -423,42 +1151,10 @@ class Repository:
         """
 
         # Getting all users who have registered a transportation_mode
-        res = self.db.Activity.find({
-            'transportation_mode': {
-                '$ne': ''
-            }
-        }, {
+        res = self.db.Activity.find(LABELED_ACTIVITIES, {
             '_id': False,
             'user_id': True,
             'transportation_mode': True
         })
 
-        activities = list(res)
-
-        user_transportation_mode = dict()
-
-        for activity in activities:
-            user_id = activity['user_id']
-            transportation_mode = activity['transportation_mode']
-
-            # Initialize the user_transportation_mode dict if the user_id is not in it
-            if user_id not in user_transportation_mode:
-                user_transportation_mode[user_id] = dict()
-
-            # Initialize the transportation_mode dict if the transportation_mode is not in it
-            if transportation_mode not in user_transportation_mode[user_id]:
-                user_transportation_mode[user_id][transportation_mode] = 0
-
-            # Increment the count for the given transportation_mode
-            user_transportation_mode[user_id][transportation_mode] += 1
-
-        # Sorting the dict by the date_time gained
-        sorted_user_transportation_mode = sorted(user_transportation_mode.items())
-
-        result = []
-
-        for user_id, transportation_modes in sorted_user_transportation_mode:
-            transportation_mode = max(transportation_modes, key=transportation_modes.get)
-            result.append([user_id, transportation_mode, transportation_modes[transportation_mode]])
-        
-        return result
+        return most_used_modes(res)
@@ -0,0 +1,125 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from tabulate import tabulate
+from outputCapture import capture_output
+from pipelineMetrics import METRICS, COMMANDS
+
+table_format = 'github' # Table format for tabulate
+
+
+def query_1(query):
+    print("\n-------- Query 1 ----------")
+    value = query.sum_user_activity_trackpoint()
+    print(value)
+
+
+def query_2(query):
+    print("\n-------- Query 2 ----------")
+    value = query.average_number_of_activities_per_user()
+    print(value)
+
+
+def query_3(query):
+    print("\n-------- Query 3 ----------\n")
+    headers = ['nr.','user id', 'activities']
+    print(tabulate(query.top_twenty_users(), headers=headers, tablefmt=table_format))
+
+
+def query_4(query):
+    print("\n-------- Query 4 ----------")
+    headers = ['user id']
+    print("Users who have taken a taxi\n") 
+    print(tabulate(query.users_taken_taxi(), headers=headers, tablefmt=table_format))
+
+
+def query_5(query):
+    print("\n-------- Query 5 ----------\n")
+    headers = ['mode', 'count']
+    print(tabulate(query.activity_transport_mode_count(), headers=headers, tablefmt=table_format))
+
+
+def query_6(query):
+    print("\n-------- Query 6 ----------")
+    headers = ['year', 'hours']
+    print(tabulate(query.year_with_most_activities(), headers=headers, tablefmt=table_format))
+
+
+def query_7(query):
+    print("\n-------- Query 7 ----------")
+    value = query.total_distance_in_km_walked_in_2008_by_userid_112()
+    print("The total distance walked in 2008 by user 112 is {:.2f} km".format(value))
+
+
+def query_8(query):
+    print("\n-------- Query 8 ----------\n")
+    headers = ['nr.', 'user id', 'altitude']
+    print(tabulate(query.top_20_users_gained_most_altitude_meters(), headers=headers, tablefmt=table_format))
+
+
+def query_9(query):
+    print("\n-------- Query 9 ----------\n")
+    headers = ['user_id', 'invalid_activities']
+    print(tabulate(query.invalid_activities_per_user(), headers=headers, tablefmt=table_format))
+
+
+def query_10(query):
+    print("\n-------- Query 10 ----------")
+    values = query.users_tracked_activity_in_the_forbidden_city_beijing()
+    print(''.join(values))
+
+
+def query_11(query):
+    print("\n-------- Query 11 ----------\n")
+    headers = ['user id', 'transportation mode', 'count']
+    print(tabulate(query.most_used_transportation_mode_per_user(), headers=headers, tablefmt=table_format))
+
+
+QUERIES = [query_1, query_2, query_3, query_4, query_5, query_6, query_7, query_8, query_9, query_10, query_11]
+
+
+def timed_query(query_function, query):
+    """
+    Runs a query while capturing what it prints, returns the output and the latency in seconds
+    """
+    start = time.perf_counter()
+    with capture_output() as output:
+        with COMMANDS.label(query_function.__name__):
+            query_function(query)
+    return output.getvalue(), time.perf_counter() - start
+
+
+def run_queries(query, threads=1):
+    """
+    Runs all queries and prints their results in order.
+    With more than one thread the queries run concurrently over the shared client of the repository,
+    and each result is printed as soon as it and all queries before it have finished.
+    Returns the latency of every query in seconds
+    """
+    start = time.perf_counter()
+    latencies = []
+
+    if threads > 1:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            futures = [executor.submit(timed_query, query_function, query) for query_function in QUERIES]
+            for future in futures:
+                output, latency = future.result()
+                print(output, end="")
+                latencies.append(latency)
+    else:
+        for query_function in QUERIES:
+            query_start = time.perf_counter()
+            with COMMANDS.label(query_function.__name__):
+                query_function(query)
+            latencies.append(time.perf_counter() - query_start)
+
+    total = time.perf_counter() - start
+
+    for query_function, latency in zip(QUERIES, latencies):
+        METRICS.record_query(query_function.__name__, latency)
+
+    print("\n-------- Latency ----------\n")
+    rows = [[i + 1, round(latency, 3)] for i, latency in enumerate(latencies)]
+    print(tabulate(rows, headers=['query', 'seconds'], tablefmt=table_format))
+    print("\nTotal wall time {:.3f} s, sum of latencies {:.3f} s".format(total, sum(latencies)))
+
+    return latencies
@@ -0,0 +1,294 @@
+import time
+from collections import defaultdict
+import numpy as np
+from pymongo import ASCENDING, IndexModel
+from tabulate import tabulate
+from columnarResults import iter_column_batches
+from layoutRepository import create_repository, epoch_bounds
+from repository import TRACKPOINT_SCHEMA, WALKED_IN_2008_BY_112, add_distances, distance_activity_query
+from trajectory import (MEAN_EARTH_RADIUS_KM, ActivityArrays, iter_batches_to_activity_arrays, summarize,
+                        to_epoch_seconds, within_period)
+
+# The simplified trackpoints are stored like the document layout, in a collection of their own
+SIMPLIFIED_COLLECTION = "TrackPointSimplified"
+
+SIMPLIFIED_INDEXES = [
+    IndexModel([("activity_id", ASCENDING), ("date_time", ASCENDING)]),
+    IndexModel([("user_id", ASCENDING)]),
+]
+
+# Douglas-Peucker keeps the points that deviate more than the tolerance in meters from the simplified line,
+# time downsampling keeps the first point of every interval of the tolerance in seconds
+DOUGLAS_PEUCKER = "dp"
+DOWNSAMPLE = "time"
+METHODS = [DOUGLAS_PEUCKER, DOWNSAMPLE]
+
+# Tolerances the accuracy report compares when none is given
+TOLERANCES = {
+    DOUGLAS_PEUCKER: [1, 5, 10, 25, 50],
+    DOWNSAMPLE: [5, 10, 30, 60, 120]
+}
+
+
+def parse_simplification(value):
+    """
+    Parses a simplification given on the command line as method:tolerance, such as dp:10 or time:30
+    """
+    method, _, tolerance = value.partition(":")
+    if method not in METHODS or not tolerance:
+        raise ValueError(f"Expected one of {', '.join(METHODS)} followed by :tolerance, got {value}")
+    return method, float(tolerance)
+
+
+def douglas_peucker(lat, lon, tolerance_m):
+    """
+    Returns a mask of the points Douglas-Peucker keeps at a tolerance in meters.
+    The points are projected to a local plane in meters, and the distances of a whole segment are computed at once
+    """
+    count = len(lat)
+    keep = np.zeros(count, dtype=bool)
+    if count <= 2:
+        keep[:] = True
+        return keep
+
+    lat_radians = np.radians(lat)
+    x = MEAN_EARTH_RADIUS_KM * 1000 * np.radians(lon) * np.cos(lat_radians.mean())
+    y = MEAN_EARTH_RADIUS_KM * 1000 * lat_radians
+
+    keep[0] = keep[-1] = True
+    segments = [(0, count - 1)]
+    while segments:
+        start, end = segments.pop()
+        if end - start < 2:
+            continue
+
+        # Distance of every point between start and end to the line through them
+        dx, dy = x[end] - x[start], y[end] - y[start]
+        px, py = x[start + 1:end] - x[start], y[start + 1:end] - y[start]
+        length = np.hypot(dx, dy)
+        if length == 0:
+            distances = np.hypot(px, py)
+        else:
+            distances = np.abs(dx * py - dy * px) / length
+
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance_m:
+            middle = start + 1 + farthest
+            keep[middle] = True
+            segments.append((start, middle))
+            segments.append((middle, end))
+
+    return keep
+
+
+def downsample(epoch, interval_seconds):
+    """
+    Returns a mask keeping the first point of every interval of the given length and the last point
+    """
+    keep = np.zeros(len(epoch), dtype=bool)
+    if len(epoch) == 0:
+        return keep
+
+    intervals = np.floor((epoch - epoch[0]) / interval_seconds)
+    keep[0] = True
+    keep[1:] = intervals[1:] != intervals[:-1]
+    keep[-1] = True
+    return keep
+
+
+def simplify_mask(lat, lon, epoch, method, tolerance):
+    if method == DOUGLAS_PEUCKER:
+        return douglas_peucker(lat, lon, tolerance)
+    return downsample(epoch, tolerance)
+
+
+def simplify_activity(activity, method, tolerance):
+    """
+    Returns the ActivityArrays with only the points the simplification keeps
+    """
+    keep = simplify_mask(activity.lat, activity.lon, activity.epoch, method, tolerance)
+    return ActivityArrays(activity.user_id, activity.activity_id, activity.lat[keep], activity.lon[keep],
+                          activity.altitude[keep], activity.epoch[keep])
+
+
+def simplify_trackpoints(trackpoints, method, tolerance):
+    """
+    Returns the trackpoint documents the simplification keeps.
+    The documents are simplified per run of consecutive trackpoints of the same activity, which is one plot file
+    """
+    simplified = []
+    start = 0
+    for end in range(1, len(trackpoints) + 1):
+        if end < len(trackpoints) and trackpoints[end]["activity_id"] == trackpoints[start]["activity_id"]:
+            continue
+
+        run = trackpoints[start:end]
+        keep = simplify_mask(
+            np.array([trackpoint["lat"] for trackpoint in run], dtype=np.float64),
+            np.array([trackpoint["lon"] for trackpoint in run], dtype=np.float64),
+            to_epoch_seconds([trackpoint["date_time"] for trackpoint in run]),
+            method,
+            tolerance
+        )
+        simplified.extend(trackpoint for trackpoint, kept in zip(run, keep) if kept)
+        start = end
+
+    return simplified
+
+
+def prepare_simplified_collection(db):
+    """
+    Removes the simplified tier of an earlier load
+    """
+    db[SIMPLIFIED_COLLECTION].drop()
+    db.Metadata.delete_one({"_id": "simplification"})
+
+
+def finish_simplified_collection(db, method, tolerance):
+    """
+    Indexes the simplified tier and records how it was simplified
+    """
+    db[SIMPLIFIED_COLLECTION].create_indexes(SIMPLIFIED_INDEXES)
+    db.Metadata.replace_one({"_id": "simplification"},
+                            {"_id": "simplification", "method": method, "tolerance": tolerance}, upsert=True)
+
+
+def load_simplification(db):
+    """
+    Returns the (method, tolerance) of the stored simplified tier, or None when there is none
+    """
+    document = db.Metadata.find_one({"_id": "simplification"})
+    return (document["method"], document["tolerance"]) if document else None
+
+
+def timed(activities):
+    """
+    Yields every activity of the iterator with the seconds spent reading it, so only the scan counts as scan time
+    and not the work done on the activities in between
+    """
+    activities = iter(activities)
+    while True:
+        start = time.perf_counter()
+        activity = next(activities, None)
+        seconds = time.perf_counter() - start
+        if activity is None:
+            return
+        yield activity, seconds
+
+
+def query_answers(summaries, activities, distances):
+    """
+    Answers queries 8 and 9 from the summaries of the activities, keyed by activity id,
+    and query 7 from the distances summed like distance_per_user_mode_year
+    """
+    altitude = dict()
+    invalid = dict()
+
+    for activity in activities:
+        summary = summaries.get(activity["id"])
+        if summary is None:
+            continue
+
+        if summary["point_count"] >= 2:
+            user_id = activity["user_id"]
+            altitude[user_id] = altitude.get(user_id, 0.0) + summary["altitude_gain"]
+            invalid[user_id] = invalid.get(user_id, 0) + (summary["max_gap_seconds"] > 60 * 5)
+
+    top_users = [user_id for user_id, _ in sorted(altitude.items(), key=lambda item: (-item[1], item[0]))[:20]]
+    return {
+        "distance": sum(distances.values()),
+        "altitude": sum(altitude.values()),
+        "top_users": top_users,
+        "invalid": sum(invalid.values())
+    }
+
+
+def relative_error(value, reference):
+    return abs(value - reference) / reference if reference else 0.0
+
+
+def report_row(name, points, full_points, answers, full_answers, scan_seconds):
+    return [
+        name,
+        "{:.1%}".format(points / full_points if full_points else 0),
+        round(scan_seconds, 2) if scan_seconds is not None else "",
+        "{:.2%}".format(relative_error(answers["distance"], full_answers["distance"])),
+        "{:.2%}".format(relative_error(answers["altitude"], full_answers["altitude"])),
+        "{}/20".format(len(set(answers["top_users"]) & set(full_answers["top_users"]))),
+        answers["invalid"] - full_answers["invalid"]
+    ]
+
+
+def simplification_report(method=DOUGLAS_PEUCKER, tolerance=None):
+    """
+    Compares the answers of queries 7, 8 and 9 on the full trackpoints with those on simplified trackpoints.
+    The full tier is read once and simplified in memory at every tolerance, and the stored simplified tier
+    is read from its collection, so the share of points kept and the scan time can be weighed against the error
+    """
+    tolerances = sorted(set(TOLERANCES[method]) | ({tolerance} if tolerance is not None else set()))
+    repository = create_repository()
+    db = repository.db
+
+    print(f"\n{time.strftime('%H:%M:%S')} Comparing simplified trackpoints with the full trackpoints...")
+
+    activities = list(db.Activity.find({}, {'_id': False, 'id': True, 'user_id': True, 'transportation_mode': True}))
+
+    # Query 7 is answered on every tier like distance_per_user_mode_year, from the points of its period
+    user_ids, transportation_modes, start, end = WALKED_IN_2008_BY_112
+    modes = {activity['id']: activity['transportation_mode']
+             for activity in db.Activity.find(distance_activity_query(user_ids, transportation_modes),
+                                              {'_id': False, 'id': True, 'transportation_mode': True})}
+    lower, upper = epoch_bounds(start, end)
+
+    def add_activity(summaries, distances, activity):
+        summaries[activity.activity_id] = summarize(activity)
+        add_distances(distances, within_period(activity, lower, upper), modes.get(activity.activity_id))
+
+    full_summaries = dict()
+    full_distances = defaultdict(float)
+    simplified_summaries = {tolerance: dict() for tolerance in tolerances}
+    simplified_distances = {tolerance: defaultdict(float) for tolerance in tolerances}
+    simplified_points = {tolerance: 0 for tolerance in tolerances}
+
+    # Only the time spent reading the activities counts as scan time, not the simplification in between
+    full_seconds = 0.0
+    for activity, seconds in timed(repository.iter_activity_arrays()):
+        full_seconds += seconds
+        add_activity(full_summaries, full_distances, activity)
+        for tolerance in tolerances:
+            simplified = simplify_activity(activity, method, tolerance)
+            add_activity(simplified_summaries[tolerance], simplified_distances[tolerance], simplified)
+            simplified_points[tolerance] += len(simplified.epoch)
+
+    full_points = sum(summary["point_count"] for summary in full_summaries.values())
+    full_answers = query_answers(full_summaries, activities, full_distances)
+
+    rows = [report_row("full", full_points, full_points, full_answers, full_answers, full_seconds)]
+    for tolerance in tolerances:
+        answers = query_answers(simplified_summaries[tolerance], activities, simplified_distances[tolerance])
+        rows.append(report_row(f"{method}:{tolerance:g}", simplified_points[tolerance], full_points, answers,
+                               full_answers, None))
+
+    stored = load_simplification(db)
+    if stored is not None:
+        stored_summaries = dict()
+        stored_distances = defaultdict(float)
+
+        # The stored tier is read and timed the same way as the full tier
+        stored_seconds = 0.0
+        batches = iter_column_batches(db[SIMPLIFIED_COLLECTION], {}, TRACKPOINT_SCHEMA,
+                                      [('activity_id', 1), ('date_time', 1)])
+        for activity, seconds in timed(iter_batches_to_activity_arrays(batches)):
+            stored_seconds += seconds
+            add_activity(stored_summaries, stored_distances, activity)
+
+        stored_points = sum(summary["point_count"] for summary in stored_summaries.values())
+        rows.append(report_row("stored {}:{:g}".format(*stored), stored_points, full_points,
+                               query_answers(stored_summaries, activities, stored_distances), full_answers,
+                               stored_seconds))
+
+    print(tabulate(rows, headers=['tier', 'points kept', 'scan seconds', 'query 7 error', 'query 8 error',
+                                  'query 8 top 20', 'query 9 difference'], tablefmt='github'))
+
+    repository.connection.close_connection()
+    return rows
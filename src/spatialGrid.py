@@ -0,0 +1,256 @@
+import math
+from collections import defaultdict, namedtuple
+import numpy as np
+
+# Radius of the earth in kilometers, used to convert distances to radians
+EARTH_RADIUS_KM = 6378.1
+
+# Every trackpoint is assigned a grid cell at each resolution, a resolution of r gives cells of 10^-r degrees,
+# about 11 km, 1.1 km and 110 m in latitude
+RESOLUTIONS = [1, 2, 3]
+
+# The cells an activity covers are stored at about 1 km
+ACTIVITY_RESOLUTION = 2
+
+# An area is looked up at the finest resolution that covers its bounding box with at most this many cells
+MAX_CELLS_PER_AREA = 4096
+
+# Cells are sent to the server in batches of this size, so a large batch of areas stays within the document limit
+CELL_BATCH_SIZE = 10_000
+
+# The areas a batch lookup takes, a circle with a radius in kilometers or a polygon of (lat, lon) points
+Circle = namedtuple("Circle", ["lat", "lon", "radius_km"])
+Polygon = namedtuple("Polygon", ["points"])
+
+
+def box(min_lat, max_lat, min_lon, max_lon):
+    """
+    Returns the polygon of a latitude and longitude box
+    """
+    return Polygon([(min_lat, min_lon), (min_lat, max_lon), (max_lat, max_lon), (max_lat, min_lon)])
+
+
+def cell_field(resolution):
+    """
+    Returns the trackpoint field that holds the cell at the resolution
+    """
+    return f"cell_{resolution}"
+
+
+CELL_FIELDS = [cell_field(resolution) for resolution in RESOLUTIONS]
+
+
+def cell_ids(lat, lon, resolution):
+    """
+    Returns the cell of every point at the resolution, or -1 for points outside the valid coordinate range.
+    A cell is numbered by its row from the south pole times the number of columns plus its column from the antimeridian
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    scale = 10 ** resolution
+
+    valid = (lat >= -90) & (lat <= 90) & (lon >= -180) & (lon <= 180)
+    with np.errstate(invalid="ignore"):
+        rows = np.floor((np.where(valid, lat, 0) + 90) * scale).astype(np.int64)
+        columns = np.floor((np.where(valid, lon, 0) + 180) * scale).astype(np.int64)
+    return np.where(valid, rows * (360 * scale) + columns, -1)
+
+
+def covered_cells(lat, lon, resolution):
+    """
+    Returns the sorted distinct cells of the valid points as a list
+    """
+    cells = np.unique(cell_ids(lat, lon, resolution))
+    return cells[cells >= 0].tolist()
+
+
+def within_radius(lat, lon, center_lat, center_lon, radius_km):
+    """
+    Returns a mask of the points within radius_km of the center, with the same earth radius as $centerSphere
+    """
+    lats = np.radians(lat)
+    lons = np.radians(lon)
+    center_lat = np.radians(center_lat)
+
+    a = (np.sin((lats - center_lat) / 2) ** 2
+         + np.cos(center_lat) * np.cos(lats) * np.sin((lons - np.radians(center_lon)) / 2) ** 2)
+    return 2 * np.arcsin(np.sqrt(np.clip(a, 0, 1))) <= radius_km / EARTH_RADIUS_KM
+
+
+def points_in_polygon(lat, lon, points):
+    """
+    Returns a mask of the points inside the polygon given as a list of (lat, lon) points, by ray casting
+    """
+    inside = np.zeros(len(lat), dtype=bool)
+    ring = list(points) if points[0] == points[-1] else list(points) + [points[0]]
+
+    for (lat_a, lon_a), (lat_b, lon_b) in zip(ring[:-1], ring[1:]):
+        crosses = (lat_a > lat) != (lat_b > lat)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            lon_at_lat = lon_a + (lat - lat_a) * (lon_b - lon_a) / (lat_b - lat_a)
+        inside ^= crosses & (lon < lon_at_lat)
+    return inside
+
+
+def contains(area, lat, lon):
+    """
+    Returns a mask of the points inside the area
+    """
+    if isinstance(area, Circle):
+        return within_radius(lat, lon, area.lat, area.lon, area.radius_km)
+    return points_in_polygon(lat, lon, area.points)
+
+
+def area_bounds(area):
+    """
+    Returns the (min_lat, max_lat, min_lon, max_lon) bounding box of the area
+    """
+    if isinstance(area, Polygon):
+        lats = [lat for lat, _ in area.points]
+        lons = [lon for _, lon in area.points]
+        return min(lats), max(lats), min(lons), max(lons)
+
+    angle = area.radius_km / EARTH_RADIUS_KM
+    spread_lat = math.degrees(angle)
+    # The widest point of the circle is not on the parallel of the center, and circles around a pole span every longitude
+    if math.sin(angle) < math.cos(math.radians(area.lat)):
+        spread_lon = math.degrees(math.asin(math.sin(angle) / math.cos(math.radians(area.lat))))
+    else:
+        spread_lon = 180
+    return area.lat - spread_lat, area.lat + spread_lat, area.lon - spread_lon, area.lon + spread_lon
+
+
+def bounding_cells(area, resolution):
+    """
+    Returns the rows and columns of the cells that overlap the bounding box of the area
+    """
+    min_lat, max_lat, min_lon, max_lon = area_bounds(area)
+    scale = 10 ** resolution
+
+    rows = np.arange(math.floor((max(min_lat, -90) + 90) * scale), math.floor((min(max_lat, 90) + 90) * scale) + 1)
+    columns = np.arange(math.floor((max(min_lon, -180) + 180) * scale),
+                        math.floor((min(max_lon, 180) + 180) * scale) + 1)
+    rows, columns = np.meshgrid(rows, columns, indexing="ij")
+    return rows.ravel(), columns.ravel()
+
+
+def lookup_resolution(area):
+    """
+    Returns the finest resolution that covers the area with at most MAX_CELLS_PER_AREA cells
+    """
+    min_lat, max_lat, min_lon, max_lon = area_bounds(area)
+    for resolution in sorted(RESOLUTIONS, reverse=True):
+        scale = 10 ** resolution
+        if ((max_lat - min_lat) * scale + 2) * ((max_lon - min_lon) * scale + 2) <= MAX_CELLS_PER_AREA:
+            return resolution
+    return min(RESOLUTIONS)
+
+
+def segment_crosses_rectangles(lat_a, lon_a, lat_b, lon_b, min_lat, max_lat, min_lon, max_lon):
+    """
+    Returns a mask of the rectangles the segment from a to b touches, by clipping the segment to every rectangle
+    """
+    start = np.zeros(len(min_lat))
+    end = np.ones(len(min_lat))
+
+    for origin, delta, low, high in ((lat_a, lat_b - lat_a, min_lat, max_lat), (lon_a, lon_b - lon_a, min_lon, max_lon)):
+        if delta == 0:
+            end = np.where((origin < low) | (origin > high), -1.0, end)
+        else:
+            enter = (low - origin) / delta
+            leave = (high - origin) / delta
+            start = np.maximum(start, np.minimum(enter, leave))
+            end = np.minimum(end, np.maximum(enter, leave))
+
+    return start <= end
+
+
+def cover(area, resolution):
+    """
+    Returns the cells at the resolution that lie completely inside the area and the cells on its edge.
+    Every point in a cell inside the area is inside it, only the points in edge cells have to be checked
+    """
+    rows, columns = bounding_cells(area, resolution)
+    scale = 10 ** resolution
+    min_lat = rows / scale - 90
+    max_lat = (rows + 1) / scale - 90
+    min_lon = columns / scale - 180
+    max_lon = (columns + 1) / scale - 180
+
+    if isinstance(area, Circle):
+        # Along a parallel or a meridian the distance to the center has no maximum between the ends,
+        # so a cell is inside the circle when its four corners are
+        inside = np.ones(len(rows), dtype=bool)
+        for lat, lon in ((min_lat, min_lon), (min_lat, max_lon), (max_lat, min_lon), (max_lat, max_lon)):
+            inside &= contains(area, lat, lon)
+        edge = ~inside
+    else:
+        # A cell that no side of the polygon touches is either completely inside or completely outside
+        ring = list(area.points) if area.points[0] == area.points[-1] else list(area.points) + [area.points[0]]
+        edge = np.zeros(len(rows), dtype=bool)
+        for (lat_a, lon_a), (lat_b, lon_b) in zip(ring[:-1], ring[1:]):
+            edge |= segment_crosses_rectangles(lat_a, lon_a, lat_b, lon_b, min_lat, max_lat, min_lon, max_lon)
+        inside = ~edge & contains(area, (min_lat + max_lat) / 2, (min_lon + max_lon) / 2)
+
+    cells = rows * (360 * scale) + columns
+    return cells[inside], cells[edge]
+
+
+def plan_lookup(areas):
+    """
+    Covers every area with cells and returns, for every resolution used, the areas each cell is inside of
+    and the areas each cell is on the edge of, as {resolution: (inside, edge)} mapping cells to area indexes
+    """
+    plan = dict()
+    for index, area in enumerate(areas):
+        resolution = lookup_resolution(area)
+        inside, edge = plan.setdefault(resolution, (defaultdict(list), defaultdict(list)))
+        inside_cells, edge_cells = cover(area, resolution)
+        for cell in inside_cells.tolist():
+            inside[cell].append(index)
+        for cell in edge_cells.tolist():
+            edge[cell].append(index)
+    return plan
+
+
+def cell_batches(cells):
+    cells = sorted(cells)
+    for start in range(0, len(cells), CELL_BATCH_SIZE):
+        yield cells[start:start + CELL_BATCH_SIZE]
+
+
+def assign_inside(results, inside, pairs):
+    """
+    Adds the values found in cells inside areas, given as (cell, value) pairs, to the results of those areas
+    """
+    for cell, value in pairs:
+        for index in inside[cell]:
+            results[index].add(value)
+
+
+def assign_edge(results, areas, edge, cells, lat, lon, values):
+    """
+    Adds the values of the points in edge cells to the results of the areas the points are actually inside of.
+    The points are sorted by cell once, so every area only checks the points in its own edge cells
+    """
+    cells = np.asarray(cells, dtype=np.int64)
+    order = np.argsort(cells, kind="stable")
+    sorted_cells = cells[order]
+    values = np.asarray(values, dtype=object)
+
+    area_cells = defaultdict(list)
+    for cell, indexes in edge.items():
+        for index in indexes:
+            area_cells[index].append(cell)
+
+    for index, wanted in area_cells.items():
+        wanted = np.array(wanted, dtype=np.int64)
+        starts = np.searchsorted(sorted_cells, wanted, side="left")
+        ends = np.searchsorted(sorted_cells, wanted, side="right")
+        points = [order[start:end] for start, end in zip(starts, ends) if end > start]
+        if not points:
+            continue
+
+        points = np.concatenate(points)
+        inside = contains(areas[index], lat[points], lon[points])
+        results[index].update(values[points[inside]].tolist())
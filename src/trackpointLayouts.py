@@ -0,0 +1,151 @@
+import time
+from spatialGrid import CELL_FIELDS, RESOLUTIONS, cell_field
+
+# Every GPS fix is its own document, as described in the assignment
+DOCUMENT = "document"
+# One document per activity with the trackpoints stored as columnar arrays
+BUCKET = "bucket"
+# A MongoDB time series collection with the user and activity as metadata
+TIMESERIES = "timeseries"
+
+LAYOUTS = (DOCUMENT, BUCKET, TIMESERIES)
+
+TRACKPOINT_COLLECTIONS = {
+    DOCUMENT: "TrackPoint",
+    BUCKET: "TrackPointBucket",
+    TIMESERIES: "TrackPointSeries"
+}
+
+
+def bucket_cell_field(resolution):
+    """
+    Returns the bucket field that holds the distinct cells of its trackpoints at the resolution
+    """
+    return f"cells_{resolution}"
+
+
+# The arrays of a bucket that hold one value for every point
+POINT_ARRAYS = ["lat", "lon", "altitude", "date_time", "transportation_mode"]
+
+
+def to_buckets(trackpoints):
+    """
+    Groups trackpoint documents into one bucket document per activity.
+    The points of every bucket are sorted by time, whatever the order of the input,
+    since the queries pair every point with the next one in the arrays
+    """
+    buckets = dict()
+    for trackpoint in trackpoints:
+        bucket = buckets.get(trackpoint["activity_id"])
+        if bucket is None:
+            bucket = buckets[trackpoint["activity_id"]] = {
+                "activity_id": trackpoint["activity_id"],
+                "user_id": trackpoint["user_id"],
+                "count": 0,
+                "lat": [],
+                "lon": [],
+                "altitude": [],
+                "date_time": [],
+                "transportation_mode": [],
+                "locations": {"type": "MultiPoint", "coordinates": []},
+                **{bucket_cell_field(resolution): set() for resolution in RESOLUTIONS}
+            }
+
+        bucket["count"] += 1
+        bucket["lat"].append(trackpoint["lat"])
+        bucket["lon"].append(trackpoint["lon"])
+        bucket["altitude"].append(trackpoint["altitude"])
+        bucket["date_time"].append(trackpoint["date_time"])
+        bucket["transportation_mode"].append(trackpoint.get("transportation_mode", ""))
+        if "location" in trackpoint:
+            bucket["locations"]["coordinates"].append(trackpoint["location"]["coordinates"])
+            for resolution in RESOLUTIONS:
+                bucket[bucket_cell_field(resolution)].add(trackpoint[cell_field(resolution)])
+
+    # The time span and bounding box let queries skip buckets without reading the arrays
+    for bucket in buckets.values():
+        # A stable sort keeps points with the same time in input order
+        order = sorted(range(bucket["count"]), key=bucket["date_time"].__getitem__)
+        for field in POINT_ARRAYS:
+            bucket[field] = [bucket[field][index] for index in order]
+
+        bucket["start_date_time"] = min(bucket["date_time"])
+        bucket["end_date_time"] = max(bucket["date_time"])
+        bucket["min_lat"] = min(bucket["lat"])
+        bucket["max_lat"] = max(bucket["lat"])
+        bucket["min_lon"] = min(bucket["lon"])
+        bucket["max_lon"] = max(bucket["lon"])
+        for resolution in RESOLUTIONS:
+            bucket[bucket_cell_field(resolution)] = sorted(bucket[bucket_cell_field(resolution)])
+
+        # An empty MultiPoint can not be stored in a 2dsphere index
+        if not bucket["locations"]["coordinates"]:
+            del bucket["locations"]
+
+        # Like the trackpoints, only buckets with labeled points store the modes, one for every point
+        if not any(bucket["transportation_mode"]):
+            del bucket["transportation_mode"]
+
+    return list(buckets.values())
+
+
+def to_timeseries(trackpoints):
+    """
+    Moves the user and activity of every trackpoint into the metadata field of the time series collection
+    """
+    return [
+        {
+            "date_time": trackpoint["date_time"],
+            "meta": {
+                "user_id": trackpoint["user_id"],
+                "activity_id": trackpoint["activity_id"]
+            },
+            "lat": trackpoint["lat"],
+            "lon": trackpoint["lon"],
+            "altitude": trackpoint["altitude"]
+        } | ({"location": trackpoint["location"]} if "location" in trackpoint else {})
+        | {field: trackpoint[field] for field in CELL_FIELDS + ["transportation_mode"] if field in trackpoint}
+        for trackpoint in trackpoints
+    ]
+
+
+def to_layout(layout, trackpoints):
+    """
+    Converts trackpoint documents to the documents stored by the layout
+    """
+    if layout == BUCKET:
+        return to_buckets(trackpoints)
+    if layout == TIMESERIES:
+        return to_timeseries(trackpoints)
+    return trackpoints
+
+
+def prepare_trackpoint_collections(db, layout):
+    """
+    Empties the trackpoint collections of every layout and creates the collection of the chosen one
+    """
+    print(f"\n{time.strftime('%H:%M:%S')} Preparing {layout} trackpoint layout...")
+
+    db.TrackPoint.delete_many({})
+    db.drop_collection(TRACKPOINT_COLLECTIONS[BUCKET])
+    # Time series collections only support limited deletes, so it is dropped and created again
+    db.drop_collection(TRACKPOINT_COLLECTIONS[TIMESERIES])
+
+    if layout == TIMESERIES:
+        db.create_collection(TRACKPOINT_COLLECTIONS[TIMESERIES], timeseries={
+            "timeField": "date_time",
+            "metaField": "meta",
+            "granularity": "seconds"
+        })
+
+
+def save_layout(db, layout):
+    db.Metadata.replace_one({"_id": "trackpoint_layout"}, {"_id": "trackpoint_layout", "value": layout}, upsert=True)
+
+
+def load_layout(db):
+    """
+    Returns the trackpoint layout the database was loaded with
+    """
+    document = db.Metadata.find_one({"_id": "trackpoint_layout"})
+    return document["value"] if document else DOCUMENT
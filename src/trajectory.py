@@ -0,0 +1,199 @@
+from collections import namedtuple
+import numpy as np
+from spatialGrid import ACTIVITY_RESOLUTION, covered_cells
+
+# Mean radius of the earth in kilometers, the same as the haversine package uses
+MEAN_EARTH_RADIUS_KM = 6371.0088
+
+# The trackpoints of one activity as contiguous arrays in time order.
+# Invalid altitudes are NaN and the times are seconds since the epoch
+ActivityArrays = namedtuple("ActivityArrays", ["user_id", "activity_id", "lat", "lon", "altitude", "epoch"])
+
+ARRAY_FIELDS = ["lat", "lon", "altitude", "date_time"]
+
+
+def to_float_array(values):
+    """
+    Converts a list of numbers where invalid values are empty strings to a float array with NaN for the invalid values
+    """
+    array = np.array(values, dtype=object)
+    array[array == ""] = np.nan
+    return array.astype(np.float64)
+
+
+def to_epoch_seconds(date_times):
+    """
+    Converts a list of naive UTC datetimes to seconds since the epoch
+    """
+    return np.array(date_times, dtype="datetime64[us]").astype(np.int64) / 1_000_000
+
+
+def to_activity_arrays(user_id, activity_id, columns):
+    """
+    Converts the columns of one activity, as yielded by Repository.iter_activity_trackpoints, to arrays
+    """
+    return ActivityArrays(
+        user_id,
+        activity_id,
+        np.array(columns["lat"], dtype=np.float64),
+        np.array(columns["lon"], dtype=np.float64),
+        to_float_array(columns["altitude"]),
+        to_epoch_seconds(columns["date_time"])
+    )
+
+
+def within_period(activity, lower=-np.inf, upper=np.inf):
+    """
+    Returns the ActivityArrays of the points of the activity from lower up to but not including upper,
+    in seconds since the epoch
+    """
+    if lower == -np.inf and upper == np.inf:
+        return activity
+
+    within = (activity.epoch >= lower) & (activity.epoch < upper)
+    return ActivityArrays(activity.user_id, activity.activity_id, activity.lat[within], activity.lon[within],
+                          activity.altitude[within], activity.epoch[within])
+
+
+def columns_to_activity_arrays(columns):
+    """
+    Splits columns of trackpoints sorted by activity, as returned by columnarResults, into one ActivityArrays per activity.
+    The columns hold user_id, activity_id, lat, lon, altitude and date_time
+    """
+    activity_ids = columns["activity_id"]
+    if len(activity_ids) == 0:
+        return
+
+    epoch = columns["date_time"].astype("datetime64[us]").astype(np.int64) / 1_000_000
+
+    # Every activity starts where the activity id changes
+    starts = np.flatnonzero(activity_ids[1:] != activity_ids[:-1]) + 1
+    bounds = zip(np.concatenate([[0], starts]), np.concatenate([starts, [len(activity_ids)]]))
+
+    for start, end in bounds:
+        yield ActivityArrays(
+            columns["user_id"][start],
+            activity_ids[start],
+            columns["lat"][start:end],
+            columns["lon"][start:end],
+            columns["altitude"][start:end],
+            epoch[start:end]
+        )
+
+
+def split_complete_activities(pending, columns):
+    """
+    Joins a batch of columns sorted by activity to the activity held back from the previous batch, or None.
+    The last activity of the batch may continue in the next one, so it is held back until the activity is complete.
+    Returns the columns of the complete activities and of the held back activity
+    """
+    if pending is not None:
+        columns = {field: np.concatenate([pending[field], values]) for field, values in columns.items()}
+
+    # The held back activity starts after the last change of activity id
+    activity_ids = columns["activity_id"]
+    changes = np.flatnonzero(activity_ids[1:] != activity_ids[:-1])
+    last_start = changes[-1] + 1 if len(changes) else 0
+
+    return ({field: values[:last_start] for field, values in columns.items()},
+            {field: values[last_start:] for field, values in columns.items()})
+
+
+def iter_batches_to_activity_arrays(batches):
+    """
+    Yields one ActivityArrays per activity from batches of columns sorted by activity
+    """
+    pending = None
+    for columns in batches:
+        complete, pending = split_complete_activities(pending, columns)
+        yield from columns_to_activity_arrays(complete)
+
+    if pending is not None:
+        yield from columns_to_activity_arrays(pending)
+
+
+def years_of(epoch):
+    """
+    Returns the calendar year of every time given in seconds since the epoch
+    """
+    return np.floor(epoch).astype(np.int64).astype("datetime64[s]").astype("datetime64[Y]").astype(np.int64) + 1970
+
+
+def haversine_distances(lat, lon):
+    """
+    Returns the distance in kilometers between every two consecutive points
+    """
+    lat = np.radians(lat)
+    lon = np.radians(lon)
+
+    d_lat = np.diff(lat)
+    d_lon = np.diff(lon)
+
+    a = np.sin(d_lat / 2) ** 2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(d_lon / 2) ** 2
+    return 2 * MEAN_EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def altitude_differences(altitude):
+    """
+    Returns the altitude difference between every two consecutive points.
+    Pairs where one of the altitudes is invalid (NaN, or 0 which also marks a missing altitude) count as 0
+    """
+    valid = ~np.isnan(altitude) & (altitude != 0)
+    differences = np.diff(altitude)
+    return np.where(valid[:-1] & valid[1:], differences, 0.0)
+
+
+def time_gaps(epoch):
+    """
+    Returns the seconds between every two consecutive points
+    """
+    return np.diff(epoch)
+
+
+def summarize(activity):
+    """
+    Returns the summary stored on an Activity document, computed from its ActivityArrays
+    """
+    if len(activity.epoch) == 0:
+        return {
+            "point_count": 0,
+            "distance_km": 0.0,
+            "altitude_gain": 0.0,
+            "max_gap_seconds": 0.0,
+            "duration_seconds": 0.0,
+            "bounding_box": None,
+            "cells": []
+        }
+
+    # The kernels compare consecutive points, so they have to be in time order
+    order = np.argsort(activity.epoch, kind="stable")
+    lat = activity.lat[order]
+    lon = activity.lon[order]
+    altitude = activity.altitude[order]
+    epoch = activity.epoch[order]
+
+    differences = altitude_differences(altitude)
+
+    return {
+        "point_count": len(epoch),
+        "distance_km": float(haversine_distances(lat, lon).sum()),
+        "altitude_gain": float(differences[differences > 0].sum()),
+        "max_gap_seconds": float(time_gaps(epoch).max(initial=0)),
+        "duration_seconds": float(epoch[-1] - epoch[0]),
+        "bounding_box": {
+            "min_lat": float(lat.min()),
+            "max_lat": float(lat.max()),
+            "min_lon": float(lon.min()),
+            "max_lon": float(lon.max())
+        },
+        # The grid cells the activity passes through, see spatialGrid
+        "cells": covered_cells(lat, lon, ACTIVITY_RESOLUTION)
+    }
+
+
+def summarize_trackpoints(trackpoints):
+    """
+    Returns the activity summary of a list of trackpoint documents
+    """
+    columns = {field: [trackpoint[field] for trackpoint in trackpoints] for field in ARRAY_FIELDS}
+    return summarize(to_activity_arrays(None, None, columns))
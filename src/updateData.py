@@ -0,0 +1,259 @@
+import os
+import time
+from pymongo import ReplaceOne
+from dbConnector import DbConnector
+from datasetGeneration import new_generation
+from datasetCatalog import load_catalog, group_by_user
+from indexManager import build_indexes
+from pipelineMetrics import METRICS
+from simplification import load_simplification, prepare_simplified_collection
+from trackpointLayouts import DOCUMENT, load_layout
+from trajectory import summarize_trackpoints
+from labelJoin import build_label_intervals
+from readFiles import (id_has_label, list_user_ids, read_labels_file, read_plot_file_measured,
+                       build_label_activities, build_plot_activity, build_trackpoints)
+
+# Collection with one checkpoint per user and per plot file that has been inserted
+CHECKPOINTS = "IngestState"
+
+
+def labels_fingerprint(user_id):
+    """
+    Returns the size and modification time of the labels file of the user, or None if the user has no labels file
+    """
+    labels_path = os.path.join("../dataset/Data", user_id, "labels.txt")
+    if not os.path.exists(labels_path):
+        return None
+
+    stat = os.stat(labels_path)
+    return [stat.st_size, stat.st_mtime]
+
+
+def read_user_labels(user_id):
+    """
+    Returns the labeled activities of the user with an empty summary, which is replaced when the activity has a plot file,
+    and the label intervals the trackpoints are joined with, or None when the user has no labels file
+    """
+    labels_path = os.path.join("../dataset/Data", user_id, "labels.txt")
+    if not os.path.exists(labels_path):
+        return dict(), None
+
+    df = read_labels_file(labels_path)
+    label_activities = build_label_activities(user_id, df)
+    return {k: v | summarize_trackpoints([]) for k, v in label_activities.items()}, build_label_intervals(df)
+
+
+def user_checkpoint(user_id):
+    return {
+        "_id": "user:" + user_id,
+        "type": "user",
+        "user_id": user_id,
+        "has_labels": id_has_label(user_id),
+        "labels": labels_fingerprint(user_id)
+    }
+
+
+def file_checkpoint(path, entry):
+    return {
+        "_id": path,
+        "type": "file",
+        "user_id": entry["user_id"],
+        "activity_id": activity_id_of_path(entry["user_id"], path),
+        "size": entry["size"],
+        "mtime": entry["mtime"]
+    }
+
+
+def activity_id_of_path(user_id, path):
+    return user_id + "_" + os.path.basename(path).split(".")[0]
+
+
+def record_checkpoints(db, catalog):
+    """
+    Marks every file in the catalog as inserted, used after a full load so later updates are incremental
+    """
+    db[CHECKPOINTS].delete_many({})
+
+    checkpoints = [user_checkpoint(user_id) for user_id in list_user_ids()]
+    checkpoints += [file_checkpoint(path, entry) for path, entry in catalog.items()]
+
+    if checkpoints:
+        db[CHECKPOINTS].insert_many(checkpoints)
+
+
+def upsert_documents(collection, documents):
+    """
+    Idempotently writes the documents, replacing the existing ones with the same id
+    """
+    if documents:
+        collection.bulk_write([ReplaceOne({"id": document["id"]}, document, upsert=True)
+                               for document in documents], ordered=False)
+
+
+def sync_file(db, user_id, path, entry, label_activities, labels=None):
+    """
+    Writes the activity and trackpoints of a new or changed plot file and removes the trackpoints it no longer has.
+    Returns the activity id if the file produced an activity
+    """
+    activity_id = activity_id_of_path(user_id, path)
+
+    df = read_plot_file_measured(path, entry)
+
+    with METRICS.phase("build"):
+        trackpoints = build_trackpoints(user_id, activity_id, df, labels)
+
+        if activity_id in label_activities:
+            activity = label_activities[activity_id]
+        elif not df.empty:
+            activity = build_plot_activity(user_id, df, entry)
+        else:
+            activity = None
+
+        if activity is not None:
+            activity = activity | summarize_trackpoints(list(trackpoints.values()))
+    METRICS.count("trackpoints", len(trackpoints))
+
+    with METRICS.phase("insert"):
+        if activity is not None:
+            upsert_documents(db.Activity, [{"id": activity_id} | activity])
+        else:
+            db.Activity.delete_one({"id": activity_id})
+
+        upsert_documents(db.TrackPoint, [{"id": k} | v for k, v in trackpoints.items()])
+        db.TrackPoint.delete_many({"activity_id": activity_id, "id": {"$nin": list(trackpoints)}})
+
+    # The checkpoint is written last, so an interrupted file is processed again on the next run
+    db[CHECKPOINTS].replace_one({"_id": path}, file_checkpoint(path, entry), upsert=True)
+
+    return activity_id if activity is not None else None
+
+
+def remove_file(db, user_id, checkpoint, label_activities):
+    """
+    Removes the documents of a plot file that no longer exists.
+    A labeled activity is kept, since the label still describes it
+    """
+    activity_id = checkpoint["activity_id"]
+
+    db.TrackPoint.delete_many({"activity_id": activity_id})
+    if activity_id in label_activities:
+        upsert_documents(db.Activity, [{"id": activity_id} | label_activities[activity_id]])
+    else:
+        db.Activity.delete_one({"id": activity_id})
+
+    db[CHECKPOINTS].delete_one({"_id": checkpoint["_id"]})
+
+
+def sync_user(db, user_id, files, checkpoints):
+    """
+    Brings the documents of a user up to date with its files.
+    When the labels of the user changed every file of the user is processed again, otherwise only new,
+    changed and removed files are. Returns the number of files that were written or removed
+    """
+    current_checkpoint = user_checkpoint(user_id)
+    previous_checkpoint = checkpoints.get(current_checkpoint["_id"])
+    user_changed = previous_checkpoint is None \
+        or previous_checkpoint["has_labels"] != current_checkpoint["has_labels"] \
+        or previous_checkpoint["labels"] != current_checkpoint["labels"]
+
+    changed = []
+    for path, entry in files.items():
+        checkpoint = checkpoints.get(path)
+        if user_changed or checkpoint is None \
+                or checkpoint["size"] != entry["size"] or checkpoint["mtime"] != entry["mtime"]:
+            changed.append(path)
+
+    removed = [checkpoint for checkpoint in checkpoints.values()
+               if checkpoint["type"] == "file" and checkpoint["user_id"] == user_id and checkpoint["_id"] not in files]
+
+    if not user_changed and not changed and not removed:
+        return 0
+
+    print(f"{time.strftime('%H:%M:%S')} Updating user {user_id}: {len(changed)} changed and {len(removed)} removed files")
+
+    # A changed labels file processes every file of the user again, so the modes of the trackpoints follow the labels
+    label_activities, labels = read_user_labels(user_id)
+
+    db.User.replace_one({"id": user_id}, {"id": user_id, "has_labels": current_checkpoint["has_labels"]}, upsert=True)
+
+    for checkpoint in removed:
+        remove_file(db, user_id, checkpoint, label_activities)
+
+    file_activity_ids = set()
+    for path in changed:
+        activity_id = sync_file(db, user_id, path, files[path], label_activities, labels)
+        if activity_id is not None:
+            file_activity_ids.add(activity_id)
+
+    if user_changed:
+        # Every file was processed again, so anything not produced by the files or the labels is stale
+        upsert_documents(db.Activity, [{"id": k} | v for k, v in label_activities.items()
+                                       if k not in file_activity_ids])
+        activity_ids = list(file_activity_ids | set(label_activities))
+        db.Activity.delete_many({"user_id": user_id, "id": {"$nin": activity_ids}})
+        db.TrackPoint.delete_many({"user_id": user_id, "activity_id": {"$nin": activity_ids}})
+        db[CHECKPOINTS].replace_one({"_id": current_checkpoint["_id"]}, current_checkpoint, upsert=True)
+
+    return len(changed) + len(removed)
+
+
+def remove_user(db, user_id):
+    print(f"{time.strftime('%H:%M:%S')} Removing user {user_id}")
+    db.TrackPoint.delete_many({"user_id": user_id})
+    db.Activity.delete_many({"user_id": user_id})
+    db.User.delete_many({"id": user_id})
+    db[CHECKPOINTS].delete_many({"user_id": user_id})
+
+
+def insert_data_incremental():
+    """
+    Updates the database with the new, changed and removed files since the last ingest instead of reloading it.
+    Progress is checkpointed per user and per file, so an interrupted update resumes where it stopped
+    """
+
+    connection = DbConnector()
+    db = connection.db
+
+    layout = load_layout(db)
+    if layout != DOCUMENT:
+        print(f"Incremental updates only support the {DOCUMENT} trackpoint layout, the database uses {layout}. "
+              "Run with -i to reload it")
+        connection.close_connection()
+        return
+
+    # The simplified tier is only written by a full load, it would go stale as soon as a file changes
+    if load_simplification(db) is not None:
+        print("Removing the simplified trackpoints, run with -i and --simplify to store them again")
+        prepare_simplified_collection(db)
+
+    # The upserts and deletes look documents up by id, activity id and user id
+    with METRICS.phase("index"):
+        build_indexes(db, layout)
+    db[CHECKPOINTS].create_index("user_id")
+
+    # Cached query results may be invalid as soon as the first document changes
+    new_generation(db)
+
+    with METRICS.phase("walk"):
+        catalog = load_catalog()
+    catalog_by_user = group_by_user(catalog)
+    checkpoints = {checkpoint["_id"]: checkpoint for checkpoint in db[CHECKPOINTS].find()}
+
+    user_ids = list_user_ids()
+
+    updated_files = 0
+    for user_id in user_ids:
+        updated_files += sync_user(db, user_id, catalog_by_user.get(user_id, dict()), checkpoints)
+
+    # Users whose directory disappeared are removed with all their documents
+    known_user_ids = set(db.User.distinct("id")) | set(db[CHECKPOINTS].distinct("user_id"))
+    removed_user_ids = sorted(known_user_ids - set(user_ids))
+    for user_id in removed_user_ids:
+        remove_user(db, user_id)
+
+    if updated_files or removed_user_ids:
+        new_generation(db)
+
+    connection.close_connection()
+
+    print("\nUpdated {:,} files and removed {:,} users".format(updated_files, len(removed_user_ids)))
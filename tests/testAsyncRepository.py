@@ -0,0 +1,205 @@
+import asyncio
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+from datetime import datetime
+from types import SimpleNamespace
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import MongoClient
+from asyncRepository import ASYNC_REPOSITORIES, QUERY_NAMES
+from datasetCatalog import read_labeled_ids
+from dbConnector import client_options, connection_uri
+from generateDataset import BEIJING, FORBIDDEN_CITY, generate_dataset
+from indexManager import build_indexes
+from layoutRepository import BucketRepository, TimeSeriesRepository
+from readFiles import list_user_ids, parse_user
+from repository import (Repository, altitude_gain_stages, invalid_activity_stages, sum_invalid_activities,
+                        top_altitude_users)
+from spatialGrid import Circle, box
+from trackpointLayouts import (BUCKET, DOCUMENT, TIMESERIES, TRACKPOINT_COLLECTIONS, prepare_trackpoint_collections,
+                               to_layout)
+
+# The tests load a small generated dataset into the database named after the one in .env with a _test suffix,
+# on the server in .env, and drop it when they are done. They are skipped when the server can not be reached
+REPOSITORIES = {
+    DOCUMENT: Repository,
+    BUCKET: BucketRepository,
+    TIMESERIES: TimeSeriesRepository
+}
+
+# A box around the whole generated dataset and areas around the start of some of its trajectories
+BEIJING_BOX = (BEIJING[0] - 0.5, BEIJING[0] + 0.5, BEIJING[1] - 0.5, BEIJING[1] + 0.5)
+AREAS = [Circle(*FORBIDDEN_CITY, 2), box(39.8, 40.0, 116.3, 116.5), Circle(BEIJING[0] + 0.2, BEIJING[1] - 0.2, 10)]
+
+uri = None
+database = None
+client = None
+
+
+def load_dataset(db):
+    """
+    Generates a small dataset and loads it into the database in every trackpoint layout, with the indexes of each
+    """
+    with tempfile.TemporaryDirectory() as root:
+        generate_dataset(os.path.join(root, "dataset"), users=6, files=6, points=300, labeled_share=0.5, seed=1)
+
+        # The dataset is read relative to the src folder, like the scripts do
+        os.mkdir(os.path.join(root, "src"))
+        cwd = os.getcwd()
+        os.chdir(os.path.join(root, "src"))
+        read_labeled_ids.cache_clear()
+        try:
+            users, activities, trackpoints = [], [], []
+            for user_id in list_user_ids():
+                new_users, new_activities, new_trackpoints, _ = parse_user(user_id)
+                users.extend(new_users)
+                activities.extend(new_activities)
+                trackpoints.extend(new_trackpoints)
+        finally:
+            read_labeled_ids.cache_clear()
+            os.chdir(cwd)
+
+    # Every layout is built before anything is inserted, since inserting adds an _id to the documents
+    layouts = {layout: to_layout(layout, [dict(trackpoint) for trackpoint in trackpoints]) for layout in REPOSITORIES}
+
+    prepare_trackpoint_collections(db, TIMESERIES)
+    db.User.insert_many(users)
+    db.Activity.insert_many(activities)
+    for layout, documents in layouts.items():
+        db[TRACKPOINT_COLLECTIONS[layout]].insert_many(documents)
+        build_indexes(db, layout)
+
+
+def setUpModule():
+    global uri, database, client
+    try:
+        uri, database = connection_uri()
+        client = MongoClient(uri, **(client_options() | {"serverSelectionTimeoutMS": 2000}))
+        client.admin.command("ping")
+    except Exception as e:
+        raise unittest.SkipTest(f"No MongoDB server to test against: {e}")
+
+    database += "_test"
+    client.drop_database(database)
+    with contextlib.redirect_stdout(io.StringIO()):
+        load_dataset(client[database])
+
+
+def tearDownModule():
+    client.drop_database(database)
+    client.close()
+
+
+def rounded(value):
+    """
+    Rounds the floats in a result, so sums taken in another order still compare equal
+    """
+    if isinstance(value, float):
+        return round(value, 6)
+    if isinstance(value, (list, tuple)):
+        return [rounded(item) for item in value]
+    return value
+
+
+class AsyncRepositoryTest(unittest.IsolatedAsyncioTestCase):
+    """
+    Checks that every query of the async repository returns what the repository returns, on the document layout
+    """
+
+    layout = DOCUMENT
+
+    async def asyncSetUp(self):
+        # The test loop runs in debug mode, which warns about every answer of the sync repository blocking it
+        asyncio.get_running_loop().slow_callback_duration = 60
+
+        # A motor client belongs to the event loop it was created on, and every test runs on a new one
+        self.async_client = AsyncIOMotorClient(uri, **client_options())
+        self.query = self.async_repository()
+        self.repository = REPOSITORIES[self.layout](SimpleNamespace(client=client, db=client[database]))
+
+    async def asyncTearDown(self):
+        self.async_client.close()
+
+    def async_repository(self, partitions=1, timeout=60):
+        connection = SimpleNamespace(client=self.async_client, db=self.async_client[database])
+        return ASYNC_REPOSITORIES[self.layout](connection, partitions, timeout)
+
+    async def test_queries(self):
+        for name in QUERY_NAMES:
+            with self.subTest(name):
+                self.assertEqual(rounded(await getattr(self.query, name)()), rounded(getattr(self.repository, name)()))
+
+    async def test_distance_per_user_mode_year(self):
+        for args in [(), (None, ["walk", "bus"]), (["000", "002"], None, datetime(2007, 6, 1), datetime(2008, 6, 1))]:
+            with self.subTest(args=args):
+                rows = await self.query.distance_per_user_mode_year(*args)
+                self.assertEqual(rounded(rows), rounded(self.repository.distance_per_user_mode_year(*args)))
+
+        self.assertTrue(await self.query.distance_per_user_mode_year())
+
+    async def test_labeled_trackpoints_per_user_mode(self):
+        for args in [(), (None, ["walk", "bus"]), (["000", "002"], None)]:
+            with self.subTest(args=args):
+                self.assertEqual(await self.query.labeled_trackpoints_per_user_mode(*args),
+                                 self.repository.labeled_trackpoints_per_user_mode(*args))
+
+        self.assertTrue(await self.query.labeled_trackpoints_per_user_mode())
+
+    async def test_spatial_queries(self):
+        self.assertEqual(await self.query.users_with_trackpoints_in_box(*BEIJING_BOX),
+                         self.repository.users_with_trackpoints_in_box(*BEIJING_BOX))
+        self.assertEqual(await self.query.users_in_box(*BEIJING_BOX), self.repository.users_in_box(*BEIJING_BOX))
+        self.assertEqual(await self.query.activities_near(*FORBIDDEN_CITY, 2),
+                         self.repository.activities_near(*FORBIDDEN_CITY, 2))
+        self.assertEqual(await self.query.users_in_areas(AREAS), self.repository.users_in_areas(AREAS))
+        self.assertEqual(await self.query.activities_in_areas(AREAS), self.repository.activities_in_areas(AREAS))
+
+    async def test_consecutive_trackpoints(self):
+        # Queries 8 and 9 read the summaries of the activities, this is the pipeline they fall back to without them
+        altitudes = await self.query.aggregate_consecutive_trackpoints("altitude", altitude_gain_stages())
+        self.assertEqual(rounded(top_altitude_users([altitudes])), rounded(top_altitude_users(
+            [list(self.repository.aggregate_consecutive_trackpoints("altitude", altitude_gain_stages()))])))
+
+        gaps = await self.query.aggregate_consecutive_trackpoints("date_time", invalid_activity_stages())
+        self.assertEqual(sum_invalid_activities([gaps]), sum_invalid_activities(
+            [list(self.repository.aggregate_consecutive_trackpoints("date_time", invalid_activity_stages()))]))
+
+    async def test_iter_activity_arrays(self):
+        def points(activity):
+            return activity.user_id, activity.activity_id, activity.epoch.tolist(), activity.lat.tolist()
+
+        # Small batches split the trackpoints of most activities over several batches
+        activities = [points(activity) async for activity in self.query.iter_activity_arrays(batch_size=100)]
+        self.assertEqual(activities, [points(activity) for activity in self.repository.iter_activity_arrays()])
+
+    async def test_partitions(self):
+        query = self.async_repository(partitions=3)
+
+        self.assertEqual(rounded(await query.distance_per_user_mode_year()),
+                         rounded(await self.query.distance_per_user_mode_year()))
+        self.assertEqual(await query.labeled_trackpoints_per_user_mode(),
+                         await self.query.labeled_trackpoints_per_user_mode())
+        self.assertEqual(await query.users_with_trackpoints_in_box(*BEIJING_BOX),
+                         await self.query.users_with_trackpoints_in_box(*BEIJING_BOX))
+        self.assertEqual(await query.users_in_areas(AREAS), await self.query.users_in_areas(AREAS))
+
+    async def test_timeout(self):
+        with self.assertRaises(asyncio.TimeoutError):
+            await self.query.distance_per_user_mode_year(timeout=0.000001)
+
+        # The cancelled query leaves the client usable for the next one
+        self.assertEqual(await self.query.top_twenty_users(), self.repository.top_twenty_users())
+
+
+class AsyncBucketRepositoryTest(AsyncRepositoryTest):
+    layout = BUCKET
+
+
+class AsyncTimeSeriesRepositoryTest(AsyncRepositoryTest):
+    layout = TIMESERIES
+
+
+if __name__ == "__main__":
+    unittest.main()
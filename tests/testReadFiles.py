@@ -0,0 +1,50 @@
+import unittest
+import pandas as pd
+from readFiles import build_trackpoints
+from spatialGrid import CELL_FIELDS
+
+
+def plot_dataframe(lats, times):
+    """
+    Returns the dataframe of a plot file with a row for every latitude and time, on the same day
+    """
+    return pd.DataFrame({
+        "lat": lats,
+        "long": [116.4] * len(lats),
+        "altitude": [100] * len(lats),
+        "date": ["2008-10-23"] * len(lats),
+        "date_time": times
+    })
+
+
+class BuildTrackpointsTest(unittest.TestCase):
+
+    def test_duplicate_rows_with_invalid_coordinates(self):
+        df = plot_dataframe([999, 999, 1], ["10:00:00", "10:00:00", "10:00:01"])
+
+        trackpoints = build_trackpoints("000", "000_20081023100000", df)
+
+        # The two rows at 10:00:00 share an id and give one trackpoint
+        self.assertEqual(len(trackpoints), 2)
+        invalid, valid = trackpoints.values()
+        self.assertEqual(invalid["lat"], 999)
+        self.assertNotIn("location", invalid)
+        for field in CELL_FIELDS:
+            self.assertNotIn(field, invalid)
+        self.assertEqual(valid["location"], {"type": "Point", "coordinates": [116.4, 1]})
+        for field in CELL_FIELDS:
+            self.assertIn(field, valid)
+
+    def test_duplicate_rows_keep_the_last_location(self):
+        # The last row with a timestamp overwrites the earlier ones, a valid location included
+        df = plot_dataframe([999, 1, 2], ["10:00:00", "10:00:00", "10:00:01"])
+        trackpoints = build_trackpoints("000", "000_20081023100000", df)
+        self.assertEqual(next(iter(trackpoints.values()))["location"]["coordinates"], [116.4, 1])
+
+        df = plot_dataframe([1, 999, 2], ["10:00:00", "10:00:00", "10:00:01"])
+        trackpoints = build_trackpoints("000", "000_20081023100000", df)
+        self.assertNotIn("location", next(iter(trackpoints.values())))
+
+
+if __name__ == "__main__":
+    unittest.main()